@@ -0,0 +1,380 @@
+"""Local stand-ins for Marketo, OpenAI, Telnyx and Google Sheets, for load tests.
+
+Each fake is a threaded HTTP/1.1 server on 127.0.0.1 with its own latency,
+error rate and 429 rate, and counts the calls it answered. The OpenAI fake
+also streams (SSE), counts the answer tokens it sent and runs Batch jobs
+(files + batches endpoints). The Marketo fake only receives callbacks and
+records when each lead's result arrived."""
+import email.parser
+import email.policy
+import json
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass
+class Behaviour:
+    latency_ms: float = 0.0        # mean added latency per call
+    jitter_ms: float = 0.0         # ± uniform jitter around it
+    error_rate: float = 0.0        # share of calls answered 500
+    ratelimit_rate: float = 0.0    # share of calls answered 429
+
+    def outcome(self) -> int:
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        roll = random.random()
+        if roll < self.ratelimit_rate:
+            return 429
+        if roll < self.ratelimit_rate + self.error_rate:
+            return 500
+        return 200
+
+
+@dataclass
+class Counters:
+    calls: int = 0
+    rate_limited: int = 0
+    errors: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def count(self, status: int):
+        with self.lock:
+            self.calls += 1
+            self.rate_limited += status == 429
+            self.errors += status >= 500
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"calls": self.calls, "429": self.rate_limited, "errors": self.errors}
+
+    def reset(self):
+        with self.lock:
+            self.calls = self.rate_limited = self.errors = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"        # keep-alive, like the real APIs
+    fake: "Fake"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            return _form(content_type, raw)
+        return json.loads(raw) if raw else {}
+
+    def _send(self, status: int, payload, headers: dict | None = None):
+        # bytes go out as they are (file downloads), anything else as JSON
+        raw = isinstance(payload, bytes)
+        body = payload if raw else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream" if raw else "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, str(v))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.fake.get(self)
+
+    def do_POST(self):
+        body = self._body()
+        status = self.fake.behaviour.outcome()
+        self.fake.counters.count(status)
+        if status == 200:
+            self.fake.respond(self, body)
+        else:
+            self._send(status, *self.fake.failure(status))
+
+
+def _form(content_type: str, raw: bytes) -> dict:
+    """name → value of a multipart/form-data body; file parts stay bytes."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + raw)
+    return {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+            for part in message.iter_parts()}
+
+
+class Fake:
+    name = ""
+
+    def __init__(self, behaviour: Behaviour | None = None):
+        self.behaviour = behaviour or Behaviour()
+        self.counters = Counters()
+        handler = type(f"{type(self).__name__}Handler", (_Handler,), {"fake": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, name=f"fake-{self.name}", daemon=True).start()
+
+    def get(self, handler: _Handler):
+        handler._send(200, {"ok": True})
+
+    def respond(self, handler: _Handler, body: dict):
+        handler._send(200, *self.answer(handler.path, body, handler.headers))
+
+    def answer(self, path: str, body: dict, headers) -> tuple:    # noqa: ARG002 - overridden per fake
+        return {}, None
+
+    def failure(self, status: int) -> tuple:
+        return {"error": {"message": f"fake {status}"}}, {"Retry-After": 1} if status == 429 else None
+
+    def reset(self):
+        self.counters.reset()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class FakeOpenAI(Fake):
+    """POST /v1/chat/completions; answers echo the prompt length, padded to
+    `words` words and cut at max_tokens (one token per word), generated at one
+    token every `token_ms`. Streamed answers are sent token by token; `tokens`
+    counts those actually sent.
+
+    Batch jobs: POST /v1/files, POST /v1/batches, GET /v1/batches (newest
+    first), GET /v1/batches/<id> (in progress for the first `batch_polls`
+    retrievals, then completed) and GET /v1/files/<id>/content. Every request in a batch gets a normal answer."""
+    name = "openai"
+    LIMITS = {"x-ratelimit-limit-requests": 10_000, "x-ratelimit-remaining-requests": 9_999,
+              "x-ratelimit-limit-tokens": 10_000_000, "x-ratelimit-remaining-tokens": 9_999_000}
+
+    def __init__(self, behaviour=None, words: int = 0, token_ms: float = 0.0):
+        super().__init__(behaviour)
+        self.words = words
+        self.token_ms = token_ms
+        self.tokens = 0
+        self.batch_polls = 1
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+
+    def reset(self):
+        super().reset()
+        self.tokens = 0
+        self.files.clear()
+        self.batches.clear()
+
+    def get(self, handler):
+        parts = handler.path.split("?")[0].strip("/").split("/")      # v1, batches|files[, id[, content]]
+        if parts[1:] == ["batches"]:
+            batches = [self._public(b) for b in reversed(self.batches.values())]
+            return handler._send(200, {"object": "list", "data": batches, "has_more": False})
+        if parts[1:2] == ["batches"] and parts[2:3] and parts[2] in self.batches:
+            return handler._send(200, self._retrieve(parts[2]))
+        if parts[1:2] == ["files"] and parts[3:4] == ["content"] and parts[2] in self.files:
+            return handler._send(200, self.files[parts[2]])
+        handler._send(404, {"error": {"message": f"No such object: {handler.path}"}})
+
+    def _upload(self, form: dict) -> dict:
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = form["file"]
+        return {"id": file_id, "object": "file", "bytes": len(form["file"]), "created_at": int(time.time()),
+                "filename": "batch.jsonl", "purpose": form.get("purpose", b"batch").decode(), "status": "processed"}
+
+    def _create_batch(self, body: dict) -> dict:
+        lines = []
+        for line in self.files[body["input_file_id"]].splitlines():
+            request = json.loads(line)
+            answer, _ = self.answer(request["url"], request["body"], {})
+            lines.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                                     "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                                  "body": answer},
+                                     "error": None}))
+        output_id = f"file-{uuid.uuid4().hex}"
+        self.files[output_id] = "\n".join(lines).encode("utf-8")
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": body["endpoint"],
+                 "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                 "created_at": int(time.time()), "status": "validating", "output_file_id": None,
+                 "error_file_id": None, "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+                 "metadata": body.get("metadata"), "_output": output_id, "_polls_left": self.batch_polls}
+        self.batches[batch["id"]] = batch
+        return self._public(batch)
+
+    @staticmethod
+    def _public(batch: dict) -> dict:
+        return {k: v for k, v in batch.items() if not k.startswith("_")}
+
+    def _retrieve(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        with self.counters.lock:
+            if batch["_polls_left"] > 0:
+                batch["_polls_left"] -= 1
+                batch["status"] = "in_progress"
+            else:
+                batch.update(status="completed", output_file_id=batch["_output"])
+                batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+        return self._public(batch)
+
+    def _tokens(self, body: dict) -> tuple[list[str], str]:
+        """The answer's tokens and its finish_reason."""
+        user = next((m["content"] for m in body.get("messages", []) if m["role"] == "user"), "")
+        words = f"Fake answer to a {len(user)}-character prompt.".split()
+        words += ["lorem"] * (self.words - len(words))
+        tokens = [w if i == 0 else " " + w for i, w in enumerate(words)]
+        limit = body.get("max_tokens") or len(tokens)
+        return tokens[:limit], "length" if len(tokens) > limit else "stop"
+
+    def _count(self, n: int):
+        with self.counters.lock:
+            self.tokens += n
+
+    def answer(self, path, body, headers):    # noqa: ARG002
+        user = next((m["content"] for m in body.get("messages", []) if m["role"] == "user"), "")
+        tokens, finish = self._tokens(body)
+        time.sleep(len(tokens) * self.token_ms / 1000)         # generated before anything is sent
+        self._count(len(tokens))
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "finish_reason": finish,
+                         "message": {"role": "assistant", "content": "".join(tokens)}}],
+            "usage": {"prompt_tokens": len(user) // 4, "completion_tokens": len(tokens),
+                      "total_tokens": len(user) // 4 + len(tokens)},
+        }, self.LIMITS
+
+    def respond(self, handler, body):
+        if handler.path.startswith("/v1/files"):
+            return handler._send(200, self._upload(body))
+        if handler.path.startswith("/v1/batches"):
+            return handler._send(200, self._create_batch(body))
+        if not body.get("stream"):
+            return super().respond(handler, body)
+        tokens, finish = self._tokens(body)
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": body.get("model", "gpt-4o-mini")}
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        for k, v in self.LIMITS.items():
+            handler.send_header(k, str(v))
+        handler.end_headers()
+
+        def event(data) -> bytes:
+            line = f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n".encode("utf-8")
+            return f"{len(line):x}\r\n".encode() + line + b"\r\n"
+
+        try:
+            for token in tokens:
+                if self.token_ms:
+                    time.sleep(self.token_ms / 1000)
+                handler.wfile.write(event(base | {"choices": [
+                    {"index": 0, "delta": {"content": token}, "finish_reason": None}]}))
+                handler.wfile.flush()
+                self._count(1)
+            handler.wfile.write(event(base | {"choices": [{"index": 0, "delta": {}, "finish_reason": finish}]})
+                                + event("[DONE]") + b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):     # the client stopped reading early
+            handler.close_connection = True
+
+    def failure(self, status):
+        if status == 429:
+            return ({"error": {"message": "Rate limit reached", "type": "requests",
+                               "code": "rate_limit_exceeded"}}, {"retry-after": 1})
+        return {"error": {"message": "The server had an error", "type": "server_error"}}, None
+
+
+class FakeTelnyx(Fake):
+    """POST /v2/messages."""
+    name = "telnyx"
+
+    def answer(self, path, body, headers):    # noqa: ARG002
+        return {"data": {"id": str(uuid.uuid4()), "record_type": "message", "type": "SMS",
+                         "direction": "outbound", "text": body.get("text"),
+                         "from": {"phone_number": body.get("from")},
+                         "to": [{"phone_number": body.get("to"), "status": "queued"}]}}, None
+
+    def failure(self, status):
+        title = "Too many requests" if status == 429 else "Internal error"
+        return {"errors": [{"code": str(status), "title": title}]}, None
+
+
+class FakeSheets(Fake):
+    """POST /v4/spreadsheets/<id>/values/<range>:append."""
+    name = "sheets"
+
+    def __init__(self, behaviour=None):
+        super().__init__(behaviour)
+        self.rows = 0
+
+    def answer(self, path, body, headers):    # noqa: ARG002
+        n = len(body.get("values", []))
+        with self.counters.lock:
+            self.rows += n
+        return {"updates": {"updatedRows": n}}, None
+
+    def reset(self):
+        super().reset()
+        self.rows = 0
+
+    def failure(self, status):
+        return {"error": {"code": status, "message": f"fake {status}",
+                          "status": "RESOURCE_EXHAUSTED" if status == 429 else "INTERNAL"}}, None
+
+
+class FakeMarketo(Fake):
+    """Callback receiver: arrival time of every lead, per Marketo token, and
+    the callback objects themselves with keep_objects set."""
+    name = "marketo"
+
+    def __init__(self, behaviour=None, keep_objects: bool = False):
+        super().__init__(behaviour)
+        self.keep_objects = keep_objects
+        self.arrivals: dict[str, list[float]] = {}
+        self.failed: dict[str, int] = {}
+        self.objects: dict[str, list[dict]] = {}
+        self.changed = threading.Condition()
+
+    def answer(self, path, body, headers):    # noqa: ARG002
+        now = time.monotonic()
+        token = headers.get("x-callback-token", "")
+        objects = body.get("objectData", [])
+        with self.changed:
+            self.arrivals.setdefault(token, []).extend([now] * len(objects))
+            self.failed[token] = self.failed.get(token, 0) + sum(
+                1 for o in objects if not o.get("activityData", {}).get("success", True))
+            if self.keep_objects:
+                self.objects.setdefault(token, []).extend(objects)
+            self.changed.notify_all()
+        return {"success": True}, None
+
+    def received(self, token: str) -> int:
+        with self.changed:
+            return len(self.arrivals.get(token, []))
+
+    def wait(self, expected: dict[str, int], timeout: float) -> bool:
+        """Block until every token has `expected[token]` leads back, or timeout."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while any(len(self.arrivals.get(t, [])) < n for t, n in expected.items()):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.changed.wait(left)
+        return True
+
+    def reset(self):
+        with self.changed:
+            self.arrivals.clear()
+            self.failed.clear()
+            self.objects.clear()
+        self.counters.reset()
+
+
+def start_all(behaviours: dict[str, Behaviour]) -> dict[str, Fake]:
+    return {
+        "openai": FakeOpenAI(behaviours.get("openai")),
+        "telnyx": FakeTelnyx(behaviours.get("telnyx")),
+        "sheets": FakeSheets(behaviours.get("sheets")),
+        "marketo": FakeMarketo(behaviours.get("marketo")),
+    }
@@ -0,0 +1,327 @@
+"""Load test main.py's app against local fakes of every paid API.
+
+    python -m bench.run --leads 1,100,1000,10000 --save bench/baselines/local.json
+    python -m bench.run --leads 1000 --openai-latency 400 --openai-429 0.05 --compare bench/baselines/local.json
+    python -m bench.run --services gptCompletion --openai-words 200 --openai-token-ms 10 --env GPT_MAX_LENGTH=255
+
+The app runs as a subprocess (gunicorn + gevent like production, main_asgi
+under uvicorn, or the Flask dev server) with OPENAI_BASE_URL, TELNYX_API_BASE and SHEETS_API_ENDPOINT
+pointed at the fakes and TMPDIR at a scratch directory, so rate-limit state,
+ledgers and outboxes never touch the real ones. For every service and batch
+size it reports ack and per-lead latency percentiles, leads/sec, peak RSS of
+the app's process tree, provider call counts and the answer tokens OpenAI sent."""
+import argparse
+import base64
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import requests
+
+from bench import fakes_functions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("gptCompletion", "sendSMS", "calcFormula")
+USER, PASSWORD = "bench", "bench"
+
+# per-service metric that may get worse by this much before --compare fails
+REGRESSION_TOLERANCE = 0.15
+
+
+# ---------- synthetic batches ----------
+def _lead(service: str, i: int, args) -> dict:
+    if service == "gptCompletion":
+        step = {"system": "You are terse.", "user": f"Write a one-line greeting for lead {i}.",
+                "model": "gpt-4o-mini", "temperature": 0.2, "output-tokens": 64, "field": "gptAnswer"}
+    elif service == "sendSMS":
+        step = {"from_phone": args.sms_from, "to_phone": f"+1415555{i % 10000:04d}",
+                "message": f"Hi lead {i}, thanks for signing up."}
+    else:
+        # half constant formulas, half a shared template with per-lead inputs
+        step = ({"formula": f"=ROUND({i}*1.07, 2)", "data_type": "float", "field": "calc"} if i % 2 else
+                {"formula": "=IF(score>50, score*2, score)", "data_type": "float", "field": "calc",
+                 "inputs": json.dumps({"score": i % 100})})
+    return {"objectContext": {"id": i}, "flowStepContext": step}
+
+
+def _batch(service: str, size: int, callback_url: str, args) -> dict:
+    return {"token": uuid.uuid4().hex, "callbackUrl": callback_url, "apiCallBackKey": "bench",
+            "objectData": [_lead(service, i, args) for i in range(size)]}
+
+
+# ---------- app process ----------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _tree_rss_mb(pid: int) -> float:
+    """Resident memory of pid and all its descendants (Linux /proc)."""
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        try:
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+            for task in os.listdir(f"/proc/{p}/task"):
+                with open(f"/proc/{p}/task/{task}/children") as f:
+                    stack.extend(int(c) for c in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, StopIteration):
+            continue
+    return total / 1024
+
+
+class App:
+    def __init__(self, fakes: dict, args):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.scratch = tempfile.mkdtemp(prefix="ssfs-bench-")
+        env = os.environ | {
+            "PORT": str(self.port), "TMPDIR": self.scratch,
+            "MARKETO_USER": USER, "MARKETO_PASSWORD": PASSWORD,
+            "OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": f"{fakes['openai'].url}/v1",
+            "TELNYX_API_KEY": "bench", "TELNYX_API_BASE": fakes["telnyx"].url,
+            "SHEETS_API_ENDPOINT": fakes["sheets"].url,
+            "SHEETS_LOG_FLUSH_SECONDS": "1",
+        } | dict(kv.split("=", 1) for kv in args.env)
+        if args.server == "gunicorn":
+            cmd = [sys.executable, "-m", "gunicorn", "-w", str(args.workers), "-k", "gevent",
+                   "--bind", f"127.0.0.1:{self.port}", "main:app"]
+        elif args.server == "uvicorn":
+            cmd = [sys.executable, "-m", "uvicorn", "--workers", str(args.workers), "--no-access-log",
+                   "--host", "127.0.0.1", "--port", str(self.port), "main_asgi:app"]
+        else:
+            cmd = [sys.executable, "main.py"]
+        self.proc = subprocess.Popen(cmd, cwd=ROOT, env=env, start_new_session=True,
+                                     stdout=None if args.verbose else subprocess.DEVNULL,
+                                     stderr=None if args.verbose else subprocess.DEVNULL)
+        self.peak_rss = 0.0
+        self._sampling = threading.Event()
+        threading.Thread(target=self._sample_rss, daemon=True).start()
+        self._wait_ready()
+
+    def _wait_ready(self, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"app exited with {self.proc.returncode} (rerun with --verbose)")
+            try:
+                if requests.get(f"{self.url}/gptCompletion/status", auth=(USER, PASSWORD), timeout=1).ok:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError("app did not come up")
+
+    def _sample_rss(self):
+        while self.proc.poll() is None:
+            if self._sampling.is_set():
+                self.peak_rss = max(self.peak_rss, _tree_rss_mb(self.proc.pid))
+            time.sleep(0.1)
+
+    def measure_rss(self):
+        self.peak_rss = _tree_rss_mb(self.proc.pid)
+        self._sampling.set()
+
+    def stop(self):
+        os.killpg(self.proc.pid, signal.SIGTERM)
+        try:
+            self.proc.wait(30)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+
+# ---------- one scenario ----------
+def _pct(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[p - 1]
+
+
+def _summary(values_s: list[float]) -> dict:
+    ms = [v * 1000 for v in values_s]
+    return {"p50": round(_pct(ms, 50), 2), "p95": round(_pct(ms, 95), 2), "p99": round(_pct(ms, 99), 2),
+            "max": round(max(ms, default=0.0), 2)}
+
+
+def _settle(sheets, quiet: float = 2.0, limit: float = 30.0):
+    # Sheets rows trail the callbacks by up to SHEETS_LOG_FLUSH_SECONDS; wait for
+    # them so they're counted in this scenario, not the next one
+    deadline = time.monotonic() + limit
+    last, since = sheets.rows, time.monotonic()
+    while time.monotonic() < deadline and time.monotonic() - since < quiet:
+        time.sleep(0.1)
+        if sheets.rows != last:
+            last, since = sheets.rows, time.monotonic()
+
+
+def run_scenario(app: App, fakes: dict, service: str, size: int, args) -> dict:
+    for fake in fakes.values():
+        fake.reset()
+    # keep the total lead count per scenario roughly constant
+    batches = max(1, args.total_leads // size) if args.total_leads else args.batches
+    payloads = [_batch(service, size, fakes["marketo"].url, args) for _ in range(batches)]
+    bodies = [json.dumps(p).encode("utf-8") for p in payloads]
+    auth = "Basic " + base64.b64encode(f"{USER}:{PASSWORD}".encode()).decode()
+
+    submitted: dict[str, float] = {}
+    acks: list[float] = []
+    rejected = 0
+    lock = threading.Lock()
+    queue = list(zip(payloads, bodies, strict=True))
+
+    def submitter():
+        nonlocal rejected
+        session = requests.Session()
+        while True:
+            with lock:
+                if not queue:
+                    return
+                payload, body = queue.pop()
+            start = time.monotonic()
+            r = session.post(f"{app.url}/{service}/submitAsyncAction", data=body, timeout=120,
+                             headers={"Content-Type": "application/json", "Authorization": auth})
+            with lock:
+                if r.status_code == 202:
+                    submitted[payload["token"]] = start
+                    acks.append(time.monotonic() - start)
+                else:
+                    rejected += 1
+
+    app.measure_rss()
+    began = time.monotonic()
+    threads = [threading.Thread(target=submitter) for _ in range(min(args.submitters, batches))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    done = fakes["marketo"].wait(dict.fromkeys(submitted, size), timeout=args.timeout)
+    finished = time.monotonic()
+    _settle(fakes["sheets"])
+
+    lead_latency = [arrived - submitted[t] for t in submitted for arrived in fakes["marketo"].arrivals.get(t, [])]
+    leads_back = len(lead_latency)
+    last = max((max(a) for a in fakes["marketo"].arrivals.values() if a), default=finished)
+
+    return {
+        "service": service, "batch_size": size, "batches": batches, "rejected": rejected,
+        "leads_expected": size * len(submitted), "leads_back": leads_back, "timed_out": not done,
+        "failed_leads": sum(fakes["marketo"].failed.values()),
+        "ack_ms": _summary(acks), "lead_ms": _summary(lead_latency),
+        "leads_per_sec": round(leads_back / max(last - began, 1e-9), 1),
+        "duration_s": round(finished - began, 2),
+        "peak_rss_mb": round(app.peak_rss, 1),
+        "provider_calls": {name: fake.counters.snapshot() for name, fake in fakes.items()}
+                          | {"sheets_rows": fakes["sheets"].rows, "openai_tokens": fakes["openai"].tokens},
+    }
+
+
+# ---------- baselines ----------
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return ""
+
+
+def compare(results: list[dict], baseline_path: str) -> list[str]:
+    """Human-readable regressions of `results` against a saved baseline."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["service"], r["batch_size"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        old = baseline.get((r["service"], r["batch_size"]))
+        if old is None:
+            continue
+        checks = [("lead_ms.p95", old["lead_ms"]["p95"], r["lead_ms"]["p95"], True),
+                  ("ack_ms.p95", old["ack_ms"]["p95"], r["ack_ms"]["p95"], True),
+                  ("leads_per_sec", old["leads_per_sec"], r["leads_per_sec"], False),
+                  ("peak_rss_mb", old["peak_rss_mb"], r["peak_rss_mb"], True)]
+        for name, before, now, lower_is_better in checks:
+            if not before:
+                continue
+            change = (now - before) / before
+            if (change if lower_is_better else -change) > REGRESSION_TOLERANCE:
+                regressions.append(f"{r['service']} x{r['batch_size']}: {name} {before} → {now} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--services", default=",".join(SERVICES))
+    ap.add_argument("--leads", default="1,100,1000,10000", help="batch sizes to run")
+    ap.add_argument("--batches", type=int, default=1, help="batches per size (ignored with --total-leads)")
+    ap.add_argument("--total-leads", type=int, default=0, help="size × batches ≈ this for every size")
+    ap.add_argument("--submitters", type=int, default=8, help="concurrent submitAsyncAction callers")
+    ap.add_argument("--timeout", type=float, default=600, help="seconds to wait for all callbacks")
+    ap.add_argument("--server", choices=("gunicorn", "uvicorn", "flask"), default="gunicorn")
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--sms-from", default="55555", help="sending number; its type sets the SMS rate limit")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app environment")
+    for name in ("openai", "telnyx", "sheets", "marketo"):
+        ap.add_argument(f"--{name}-latency", type=float, default=0.0, metavar="MS")
+        ap.add_argument(f"--{name}-jitter", type=float, default=0.0, metavar="MS")
+        ap.add_argument(f"--{name}-errors", type=float, default=0.0, metavar="RATE")
+        ap.add_argument(f"--{name}-429", type=float, default=0.0, metavar="RATE")
+    ap.add_argument("--openai-words", type=int, default=0, help="pad fake answers to this many words (tokens)")
+    ap.add_argument("--openai-token-ms", type=float, default=0.0, metavar="MS", help="delay per streamed token")
+    ap.add_argument("--save", help="write results as a JSON baseline")
+    ap.add_argument("--compare", help="baseline JSON; exit 1 on a >15%% regression")
+    ap.add_argument("--verbose", action="store_true", help="show the app's output")
+    args = ap.parse_args(argv)
+
+    opts = vars(args)
+    behaviours = {name: fakes_functions.Behaviour(opts[f"{name}_latency"], opts[f"{name}_jitter"],
+                                                  opts[f"{name}_errors"], opts[f"{name}_429"])
+                  for name in ("openai", "telnyx", "sheets", "marketo")}
+    fakes = fakes_functions.start_all(behaviours)
+    fakes["openai"].words, fakes["openai"].token_ms = args.openai_words, args.openai_token_ms
+    app = App(fakes, args)
+
+    results = []
+    try:
+        for service in args.services.split(","):
+            for size in (int(n) for n in args.leads.split(",")):
+                r = run_scenario(app, fakes, service, size, args)
+                results.append(r)
+                print(f"{service:14} x{size:<6} {r['leads_per_sec']:>9} leads/s  "
+                      f"lead p50/p95/p99 {r['lead_ms']['p50']}/{r['lead_ms']['p95']}/{r['lead_ms']['p99']} ms  "
+                      f"ack p95 {r['ack_ms']['p95']} ms  rss {r['peak_rss_mb']} MB  "
+                      f"back {r['leads_back']}/{r['leads_expected']}{'  TIMED OUT' if r['timed_out'] else ''}")
+    finally:
+        app.stop()
+
+    report = {"created": datetime.now(timezone.utc).isoformat(timespec="seconds"), "commit": _git_commit(),
+              "config": {k: v for k, v in opts.items() if k not in ("save", "compare", "verbose")},
+              "results": results}
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("baseline written to", args.save)
+
+    if args.compare:
+        regressions = compare(results, args.compare)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_key(*parts) -> str:
+    """Stable hash of the inputs that decide the cached value."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """LRU + TTL cache private to this worker process."""
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.misses = 0
+        self._data: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or (self.ttl and time.time() - item[0] > self.ttl):
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+class SQLiteCache:
+    """LRU + TTL cache in a local SQLite file, shared by every worker on the instance.
+
+    Values must be JSON-serialisable. Eviction runs every `evict_every` writes,
+    so the table can briefly hold up to that many rows over `max_size`."""
+
+    def __init__(self, path: str, max_size: int = 10_000, ttl: float = 3600, evict_every: int = 100):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evict_every = evict_every
+        self.hits = self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                                created REAL NOT NULL, used REAL NOT NULL)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache(used)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE cache SET used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(value), now, now))
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        if self.ttl:
+            self._db.execute("DELETE FROM cache WHERE created < ?", (now - self.ttl,))
+        self._db.execute("""DELETE FROM cache WHERE key IN (
+                                SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)""",
+                         (self.max_size,))
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return {"backend": "sqlite", "size": size, "hits": self.hits, "misses": self.misses}
+
+
+def make_cache(backend: str, max_size: int, ttl: float, path: str = ""):
+    """'memory' | 'sqlite' → cache instance; '' / 'off' → None (caching disabled)."""
+    backend = (backend or "").lower()
+    if backend in ("", "off", "none", "0"):
+        return None
+    if backend == "memory":
+        return MemoryCache(max_size, ttl)
+    if backend == "sqlite":
+        return SQLiteCache(path, max_size, ttl)
+    raise ValueError(f"Unsupported cache backend: {backend}")
@@ -1,54 +1,261 @@
+import atexit
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+import httplib2
+from google.auth.credentials import AnonymousCredentials
 from google.oauth2.service_account import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-import time
-import pandas as pd
+from googleapiclient.errors import HttpError
+
+import metrics_functions
+import ratelimit_functions
+import tracing_functions
 
-MAX_REQUESTS_PER_MINUTE = 60
-TIME_INTERVAL = 60 / MAX_REQUESTS_PER_MINUTE
+MAX_REQUESTS_PER_MINUTE = int(os.getenv("SHEETS_MAX_REQUESTS_PER_MINUTE", 60))   # write quota per service account
+MAX_RETRIES = 5
+RETRYABLE_STATUS = (429, 500, 503)
 SERVICE_ACCOUNT_FILE = 'inbound-footing-xxx-123.json'
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+HTTP_TIMEOUT = 30
+# e.g. a local fake Sheets API for load tests; requests then go out unauthenticated
+SHEETS_API_ENDPOINT = os.getenv("SHEETS_API_ENDPOINT", "")
+
+# ---------- buffered log sink ----------
+LOG_FLUSH_ROWS      = int(os.getenv("SHEETS_LOG_FLUSH_ROWS", 500))       # flush a sheet at this many rows
+LOG_FLUSH_SECONDS   = float(os.getenv("SHEETS_LOG_FLUSH_SECONDS", 10))   # … or when its oldest row is this old
+LOG_BUFFER_MAX_ROWS = int(os.getenv("SHEETS_LOG_BUFFER_MAX_ROWS", 20_000))
+LOG_OVERFLOW        = os.getenv("SHEETS_LOG_OVERFLOW", "spill")          # "spill" to disk or "drop"
+LOG_SPILL_FILE      = os.getenv("SHEETS_LOG_SPILL_FILE",
+                                os.path.join(tempfile.gettempdir(), "ssfs-sheets-spill.jsonl"))
+LOG_SPILL_MAX_BYTES = int(os.getenv("SHEETS_LOG_SPILL_MAX_BYTES", 100 * 1024 * 1024))   # each of spill and .dead
+# rows Sheets refused for good (400/403/404: renamed tab, wrong spreadsheet id …) – kept, never replayed
+LOG_DEAD_FILE       = LOG_SPILL_FILE + ".dead"
+
+_creds = None
+_creds_lock = threading.Lock()
+_local = threading.local()
+
+def _get_credentials():
+    # parsed once per process; AuthorizedHttp refreshes the token when it expires
+    global _creds
+    if _creds is None:
+        with _creds_lock:
+            if _creds is None and SHEETS_API_ENDPOINT:
+                _creds = AnonymousCredentials()
+            elif _creds is None:
+                _creds = Credentials.from_service_account_file(
+                    SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return _creds
 
 def _get_service():
-    creds = Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    return build('sheets', 'v4', credentials=creds)
+    # httplib2.Http isn't thread-safe, so each thread builds its client once and
+    # then reuses it (and its keep-alive connection) for every later write
+    service = getattr(_local, "service", None)
+    if service is None:
+        http = AuthorizedHttp(_get_credentials(), http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        options = {"api_endpoint": SHEETS_API_ENDPOINT} if SHEETS_API_ENDPOINT else None
+        service = _local.service = build('sheets', 'v4', http=http, cache_discovery=False,
+                                         client_options=options)
+    return service
+
 
+# shared by every worker process: bursts up to the quota, waits only when it's spent
+_limiter = ratelimit_functions.TokenBucket("sheets-writes", {"requests": MAX_REQUESTS_PER_MINUTE})
 
-def writeDF2Sheet(df: pd.DataFrame, sheet_name: str, spreadsheet_id: str):
+def _append_values(values: list[list], sheet_name: str, spreadsheet_id: str) -> dict:
+    body = {"values": values}
+    for attempt in range(MAX_RETRIES + 1):
+        _limiter.acquire(requests=1)
+        try:
+            with metrics_functions.provider_call("sheets"), \
+                 tracing_functions.span("sheets.append", sheet=sheet_name, rows=len(values), attempt=attempt):
+                return _get_service().spreadsheets().values().append(
+                    spreadsheetId=spreadsheet_id,
+                    range=f"{sheet_name}!A2",
+                    valueInputOption='RAW',
+                    insertDataOption='INSERT_ROWS',
+                    body=body
+                ).execute()
+        except HttpError as e:
+            if e.resp.status == 429:
+                metrics_functions.rate_limited("sheets")
+            if e.resp.status not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                raise
+            if e.resp.status == 429:
+                _limiter.drain()           # quota is gone for everyone, not just this worker
+            time.sleep(ratelimit_functions.backoff(attempt, base=2, cap=60))
 
+def rows2values(rows: list, columns: list[str] | None = None) -> list[list[str]]:
+    """Row dicts (or lists) → list of string lists for the Sheets API.
+
+    Dict rows are aligned on `columns`, or on the union of their keys in
+    first-seen order (what pd.DataFrame(rows) used to do); missing cells are ""."""
+    if not rows:
+        return []
+    if not isinstance(rows[0], dict):
+        return [["" if v is None else str(v) for v in row] for row in rows]
+    if columns is None:
+        columns = list(dict.fromkeys(k for row in rows for k in row))
+    return [["" if row.get(c) is None else str(row.get(c)) for c in columns] for row in rows]
+
+def writeRows2Sheet(rows: list, sheet_name: str, spreadsheet_id: str, columns: list[str] | None = None):
+    values = rows2values(rows, columns)
+    if values:
+        _append_values(values, sheet_name, spreadsheet_id)
+
+def logRows2Sheet(rows: list, sheet_name: str, spreadsheet_id: str, columns: list[str] | None = None):
+    """Non-blocking writeRows2Sheet: rows go to the background sink."""
+    enqueueRows(rows2values(rows, columns), sheet_name, spreadsheet_id)
+
+def writeDF2Sheet(df, sheet_name: str, spreadsheet_id: str):
+    # kept for callers that already have a DataFrame; pandas itself isn't imported here
     if df.empty:
         return
 
-    time.sleep(TIME_INTERVAL)
-    body = {"values": df.astype(str).values.tolist()}
-    _get_service().spreadsheets().values().append(
-        spreadsheetId=spreadsheet_id,
-        range=f"{sheet_name}!A2",
-        valueInputOption='RAW',
-        insertDataOption='INSERT_ROWS',
-        body=body
-    ).execute()
+    _append_values(df.astype(str).values.tolist(), sheet_name, spreadsheet_id)
 
 def writeRow2Sheet(row, sheet_name, spreadsheet_id ):
-    time.sleep(TIME_INTERVAL)
-    
-    service = _get_service()
-
-    row_data = row.values.tolist()
-    values = [row_data]
-
-    range_name = f'{sheet_name}!A2'
-
-    # Call the Sheets API
-    sheet = service.spreadsheets()
-    body = {
-        'values': values
-    }
-    result = sheet.values().append(
-        spreadsheetId=spreadsheet_id,
-        range=range_name,
-        valueInputOption='RAW',
-        insertDataOption='INSERT_ROWS',
-        body=body).execute()
+    result = _append_values([row.values.tolist()], sheet_name, spreadsheet_id)
 
     print(f"{result.get('updates').get('updatedCells')} cells updated.")
+
+
+# ---------- background log sink ----------
+# Request handlers only append rows to an in-memory buffer; one thread per process
+# coalesces them per (spreadsheet, sheet) into a single values.append.
+_buffers: dict[tuple[str, str], list[list]] = {}
+_oldest: dict[tuple[str, str], float] = {}
+_buffered = 0
+_cond = threading.Condition()
+_sink: threading.Thread | None = None
+_closing = False
+
+def _spill_lock():
+    fd = os.open(LOG_SPILL_FILE + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def _append_capped(path: str, values: list[list], sheet_name: str, spreadsheet_id: str):
+    line = json.dumps({"spreadsheet_id": spreadsheet_id, "sheet_name": sheet_name, "values": values}) + "\n"
+    fd = _spill_lock()
+    try:
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size + len(line) > LOG_SPILL_MAX_BYTES:
+            print(f"{path} is full, dropped {len(values)} row(s) for {sheet_name}")
+            return
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+    finally:
+        os.close(fd)
+
+def _overflow(values: list[list], sheet_name: str, spreadsheet_id: str):
+    if LOG_OVERFLOW != "spill":
+        print(f"Sheets log buffer full, dropped {len(values)} row(s) for {sheet_name}")
+        return
+    _append_capped(LOG_SPILL_FILE, values, sheet_name, spreadsheet_id)
+
+def _replay_spill():
+    # called once the buffer is empty, so spilled rows don't jump the queue
+    if not os.path.exists(LOG_SPILL_FILE):
+        return
+    claimed = f"{LOG_SPILL_FILE}.{os.getpid()}.replay"
+    fd = _spill_lock()
+    try:
+        os.replace(LOG_SPILL_FILE, claimed)
+    except FileNotFoundError:
+        return
+    finally:
+        os.close(fd)
+    with open(claimed, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                enqueueRows(item["values"], item["sheet_name"], item["spreadsheet_id"])
+    os.remove(claimed)
+
+def enqueueRows(values: list[list], sheet_name: str, spreadsheet_id: str):
+    """Buffer rows for a sheet and return immediately."""
+    global _buffered
+    if not values:
+        return
+    _start_sink()
+    key = (spreadsheet_id, sheet_name)
+    with _cond:
+        if _buffered + len(values) > LOG_BUFFER_MAX_ROWS:
+            _overflow(values, sheet_name, spreadsheet_id)
+            return
+        _buffers.setdefault(key, []).extend(values)
+        _oldest.setdefault(key, time.monotonic())
+        _buffered += len(values)
+        if len(_buffers[key]) >= LOG_FLUSH_ROWS:
+            _cond.notify()
+
+def _take_ready(force: bool) -> list[tuple[tuple[str, str], list[list]]]:
+    global _buffered
+    now = time.monotonic()
+    ready = [k for k, rows in _buffers.items()
+             if force or len(rows) >= LOG_FLUSH_ROWS or now - _oldest[k] >= LOG_FLUSH_SECONDS]
+    out = []
+    for k in ready:
+        rows = _buffers.pop(k)
+        _oldest.pop(k, None)
+        _buffered -= len(rows)
+        out.append((k, rows))
+    return out
+
+def _write_batches(batches):
+    for (spreadsheet_id, sheet_name), rows in batches:
+        try:
+            _append_values(rows, sheet_name, spreadsheet_id)
+        except HttpError as e:
+            if e.resp.status in RETRYABLE_STATUS:
+                print("Sheets logging error:", e)
+                _overflow(rows, sheet_name, spreadsheet_id)     # keep them for the next replay
+            elif LOG_OVERFLOW == "spill":
+                # retrying won't help – set them aside instead of replaying them forever
+                print(f"Sheets refused {len(rows)} row(s) for {sheet_name} ({e.resp.status}), see {LOG_DEAD_FILE}:", e)
+                _append_capped(LOG_DEAD_FILE, rows, sheet_name, spreadsheet_id)
+            else:
+                print(f"Sheets refused {len(rows)} row(s) for {sheet_name} ({e.resp.status}), dropped:", e)
+        except Exception as e:
+            print("Sheets logging error:", e, traceback.format_exc())
+            _overflow(rows, sheet_name, spreadsheet_id)
+
+def _run_sink():
+    while True:
+        with _cond:
+            _cond.wait(timeout=LOG_FLUSH_SECONDS / 2)
+            batches = _take_ready(force=False)
+            idle = not _buffers
+        _write_batches(batches)
+        if idle:
+            try:
+                _replay_spill()
+            except Exception as e:
+                print("Sheets spill replay error:", e)
+
+def _start_sink():
+    global _sink
+    if _sink is not None:
+        return
+    with _cond:
+        if _sink is None and not _closing:
+            _sink = threading.Thread(target=_run_sink, name="sheets-log-sink", daemon=True)
+            _sink.start()
+
+def flush():
+    """Write everything still buffered (runs at interpreter exit)."""
+    global _closing
+    with _cond:
+        _closing = True
+        batches = _take_ready(force=True)
+    _write_batches(batches)
+
+atexit.register(flush)
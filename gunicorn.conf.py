@@ -0,0 +1,11 @@
+# gunicorn loads ./gunicorn.conf.py on its own, so the .replit run commands pick this up
+import metrics_functions
+
+
+def on_starting(server):    # noqa: ARG001 - gunicorn hook signature
+    # metric files from the previous deployment would otherwise be summed in
+    metrics_functions.reset()
+
+
+def child_exit(server, worker):    # noqa: ARG001 - gunicorn hook signature
+    metrics_functions.mark_process_dead(worker.pid)
@@ -0,0 +1,130 @@
+import asyncio
+import atexit
+import collections
+import os
+import queue
+import threading
+import time
+import traceback
+
+import metrics_functions
+
+# ---------- CONFIG ----------
+JOB_QUEUE_DEPTH   = int(os.getenv("JOB_QUEUE_DEPTH", 100))     # batches waiting, not leads
+JOB_WORKERS       = int(os.getenv("JOB_WORKERS", 4))           # batches processed at once
+JOB_DRAIN_SECONDS = float(os.getenv("JOB_DRAIN_SECONDS", 25))  # < gunicorn graceful_timeout
+
+# httpcore scans a whole connection pool for every queued request, so under
+# main_asgi a provider's connections are split into pools of at most this many
+ASYNC_POOL_SIZE   = int(os.getenv("ASYNC_POOL_SIZE", 50))
+
+_queue: queue.Queue = queue.Queue(maxsize=JOB_QUEUE_DEPTH)
+_workers: list[threading.Thread] = []
+_lock = threading.Lock()
+_stopping = threading.Event()
+
+
+class QueueFull(Exception):
+    """Raised when a job can't be accepted (queue full or shutting down)."""
+
+
+def _worker():
+    while True:
+        job = _queue.get()
+        metrics_functions.set_queue_depth(_queue.qsize())
+        if job is None:                       # shutdown sentinel
+            _queue.task_done()
+            return
+        fn, args, kwargs = job
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            print("Job error:", e, traceback.format_exc())
+        finally:
+            _queue.task_done()
+
+
+def _start():
+    # workers are started lazily so they live in the gunicorn worker, not the master
+    if _workers:
+        return
+    with _lock:
+        if _workers:
+            return
+        for i in range(JOB_WORKERS):
+            t = threading.Thread(target=_worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            _workers.append(t)
+
+
+def submit(fn, *args, **kwargs):
+    """Queue fn(*args, **kwargs) for a background worker. Never blocks."""
+    if _stopping.is_set():
+        raise QueueFull("job engine is shutting down")
+    _start()
+    try:
+        _queue.put_nowait((fn, args, kwargs))
+    except queue.Full:
+        raise QueueFull(f"job queue is full ({JOB_QUEUE_DEPTH} batches)") from None
+    metrics_functions.set_queue_depth(_queue.qsize())
+
+
+def imap_ordered(pool, fn, items, window: int):
+    """Like pool.map, but submits at most `window` items ahead of the consumer,
+    so results of a huge batch never all sit in memory at once."""
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+async def amap_ordered(fn, items, window: int):
+    """imap_ordered for coroutines: runs fn(item) as tasks, at most `window`
+    ahead of the consumer, and yields the results in item order."""
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(fn(item)))
+            if len(pending) >= window:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:          # consumer gave up early
+            task.cancel()
+
+
+def pool_shards(connections: int) -> int:
+    """How many pools of ASYNC_POOL_SIZE hold `connections`."""
+    return max(1, -(-connections // max(ASYNC_POOL_SIZE, 1)))
+
+
+def stopping() -> bool:
+    return _stopping.is_set()
+
+
+def depth() -> int:
+    return _queue.qsize()
+
+
+def shutdown(timeout: float = JOB_DRAIN_SECONDS):
+    """Stop accepting jobs and give queued/running ones up to `timeout` s to finish."""
+    _stopping.set()
+    if not _workers:
+        return
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if _queue.unfinished_tasks:
+        print(f"Job engine: {_queue.unfinished_tasks} job(s) still running at shutdown")
+    for _ in _workers:
+        try:
+            _queue.put_nowait(None)
+        except queue.Full:
+            break
+
+
+atexit.register(shutdown)
@@ -0,0 +1,284 @@
+"""Durable record of accepted batches, so a restarted worker finishes them.
+
+Every accepted submitAsyncAction is written to a SQLite file (WAL mode) before
+Marketo gets its 202, and every lead's (callback object, log row) is written as
+soon as that lead finishes. A batch is deleted once its last callback is sent.
+On startup each worker takes over the batches no live process holds – a batch
+is held through an flock on its lock file, which the kernel drops when the
+process dies – and runs only the leads that have no stored result, so paid
+calls are never repeated. Leads whose callback chunk already reached Marketo
+are skipped altogether.
+
+Every write goes through one writer thread on the process's one connection.
+Lead results are committed in a single transaction every JOBSTORE_FLUSH_SECONDS,
+so thousands of leads a second cost a handful of commits; up to that much
+finished work can be lost (and is re-run) if the process dies. The accepted
+batch and its "delivered" mark are committed straight away, and their callers
+wait for that commit without touching SQLite themselves.
+
+The store only protects against worker crashes and restarts on the same
+instance. Its default file under /tmp is in the instance's memory and goes
+away when Cloud Run recycles or scales in the instance. Any batch still running
+then is lost, and Marketo never gets its callback. Do not point JOBSTORE_PATH at
+a network filesystem (Cloud Storage FUSE, NFS/Filestore): SQLite's WAL mode
+needs shared memory between the processes using the file, and flock isn't
+reliable there, so instances could corrupt the store or run the same batch
+twice. Surviving a recycle needs a queue or database outside the instance,
+which this module doesn't provide. JOBSTORE_PATH="" turns the store off."""
+import atexit
+import contextlib
+import fcntl
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import jobs_functions
+import json_functions
+
+# ---------- CONFIG ----------
+JOBSTORE_PATH          = os.getenv("JOBSTORE_PATH", os.path.join(tempfile.gettempdir(), "ssfs-jobs.sqlite"))
+JOBSTORE_FLUSH_SECONDS = float(os.getenv("JOBSTORE_FLUSH_SECONDS", 0.05))   # group-commit window
+JOBSTORE_MAX_ATTEMPTS  = int(os.getenv("JOBSTORE_MAX_ATTEMPTS", 3))          # runs before a batch is given up
+
+_conn: sqlite3.Connection | None = None
+_conn_lock = threading.Lock()      # one statement or transaction at a time on _conn
+_ops: queue.Queue = queue.Queue()
+_writer: threading.Thread | None = None
+_writer_lock = threading.Lock()
+_pending = 0                       # ops queued and not yet committed
+_committed = threading.Condition()
+
+
+def _db() -> sqlite3.Connection:
+    """The process's connection; callers hold _conn_lock."""
+    # one for the process, not one per thread: under gevent every greenlet is a thread
+    global _conn
+    if _conn is None:
+        db = sqlite3.connect(JOBSTORE_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")        # survives a process crash, not a power cut
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                          id TEXT PRIMARY KEY, service TEXT NOT NULL, timestamp TEXT NOT NULL,
+                          request BLOB NOT NULL, delivered INTEGER NOT NULL DEFAULT 0,
+                          attempts INTEGER NOT NULL DEFAULT 1, created REAL NOT NULL)""")
+        db.execute("""CREATE TABLE IF NOT EXISTS results (
+                          job TEXT NOT NULL, lead INTEGER NOT NULL, result BLOB NOT NULL,
+                          PRIMARY KEY (job, lead)) WITHOUT ROWID""")
+        _conn = db
+    return _conn
+
+
+def _lock_path(job_id: str) -> str:
+    return f"{JOBSTORE_PATH}.locks/{job_id}.lock"
+
+
+def _lock(job_id: str) -> int | None:
+    """An fd holding the job's flock, or None if a live process has it."""
+    fd = os.open(_lock_path(job_id), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class Job:
+    """One accepted batch. `delivered` leads have already reached Marketo;
+    `done` holds stored results of the rest (filled when a batch is resumed)."""
+
+    def __init__(self, job_id: str, service: str, timestamp: str, request: bytes, fd: int,
+                 delivered: int = 0, attempts: int = 1, done: dict[int, tuple[dict, dict]] | None = None):
+        self.id = job_id
+        self.service = service
+        self.timestamp = timestamp
+        self.request = request
+        self.delivered = delivered
+        self.attempts = attempts
+        self.done = done or {}
+        self._fd = fd
+        self._start = delivered
+
+    def record(self, lead: int, result: tuple[dict, dict]):
+        """Store one finished lead; committed by the writer thread within JOBSTORE_FLUSH_SECONDS."""
+        _queue(("INSERT OR REPLACE INTO results (job, lead, result) VALUES (?, ?, ?)",
+                (self.id, lead, json_functions.dumps(result))))
+
+    def deliver(self, sent: int):
+        """`sent` more leads (counted from where this run started) reached Marketo.
+
+        Committed before returning – once per callback chunk – so a restart
+        never sends a chunk twice."""
+        self.delivered = self._start + sent
+        _commit(("UPDATE jobs SET delivered = ? WHERE id = ?", (self.delivered, self.id)))
+
+    def finish(self):
+        """Drop the batch once its callback is out (or it was given up)."""
+        _queue(("DELETE FROM results WHERE job = ?", (self.id,)))
+        _queue(("DELETE FROM jobs WHERE id = ?", (self.id,)))
+        _queue(self._release)           # only after the delete is committed
+
+    def _release(self):
+        if self._fd is None:
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(_lock_path(self.id))
+        os.close(self._fd)
+        self._fd = None
+
+
+def add(service: str, request: bytes, timestamp: str) -> Job | None:
+    """Record an accepted batch (committed before this returns); None with the store off."""
+    if not JOBSTORE_PATH:
+        return None
+    os.makedirs(f"{JOBSTORE_PATH}.locks", exist_ok=True)
+    job_id = uuid.uuid4().hex
+    fd = _lock(job_id)
+    _commit(("INSERT INTO jobs (id, service, timestamp, request, created) VALUES (?, ?, ?, ?, ?)",
+             (job_id, service, timestamp, request, time.time())))
+    return Job(job_id, service, timestamp, request, fd)
+
+
+def orphans(services: list[str]) -> list[Job]:
+    """Take over every unfinished batch of these services that no live process holds."""
+    if not JOBSTORE_PATH:
+        return []
+    os.makedirs(f"{JOBSTORE_PATH}.locks", exist_ok=True)
+    marks = ",".join("?" * len(services))
+    with _conn_lock:
+        ids = [r[0] for r in _db().execute(f"SELECT id FROM jobs WHERE service IN ({marks}) ORDER BY created",
+                                           services)]
+
+    jobs = []
+    for job_id in ids:
+        fd = _lock(job_id)
+        if fd is None:
+            continue
+        # finished (and unlocked) between the SELECT and the flock?
+        with _conn_lock:
+            row = _db().execute("SELECT service, timestamp, request, delivered, attempts FROM jobs WHERE id = ?",
+                                (job_id,)).fetchone()
+        if row is None:
+            os.unlink(_lock_path(job_id))
+            os.close(fd)
+            continue
+        service, timestamp, request, delivered, attempts = row
+        _commit(("UPDATE jobs SET attempts = attempts + 1 WHERE id = ?", (job_id,)))
+        with _conn_lock:
+            done = {lead: tuple(json_functions.loads(result)) for lead, result in
+                    _db().execute("SELECT lead, result FROM results WHERE job = ? AND lead >= ?",
+                                  (job_id, delivered))}
+        jobs.append(Job(job_id, service, timestamp, request, fd, delivered, attempts + 1, done))
+    return jobs
+
+
+# ---------- writer ----------
+class _Sync:
+    """Statements whose caller waits for their commit (see _commit)."""
+
+    def __init__(self, statements: tuple):
+        self.statements = statements
+        self.error: Exception | None = None
+        self._done = threading.Event()
+
+    def release(self, error: Exception | None = None):
+        if not self._done.is_set():
+            self.error = error
+            self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def _queue(op):
+    global _pending
+    _start_writer()
+    with _committed:
+        _pending += 1
+    _ops.put(op)
+
+
+def _commit(*statements):
+    """Run statements in the writer's next transaction – without waiting for the
+    group-commit window – and return once they're committed."""
+    sync = _Sync(statements)
+    _queue(sync)
+    sync.wait()
+
+
+def _write(ops: list):
+    after = []
+    with _conn_lock:
+        db = _db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for op in ops:
+                if callable(op):
+                    after.append(op)
+                elif isinstance(op, _Sync):
+                    for statement in op.statements:
+                        db.execute(*statement)
+                else:
+                    db.execute(*op)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+    for op in ops:
+        if isinstance(op, _Sync):
+            op.release()
+    for fn in after:
+        fn()
+
+
+def _run_writer():
+    global _pending
+    while True:
+        ops = [_ops.get()]
+        if not isinstance(ops[0], _Sync):
+            time.sleep(JOBSTORE_FLUSH_SECONDS)      # let a group of results pile up
+        while True:
+            try:
+                ops.append(_ops.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write(ops)
+        except Exception as e:
+            print("Job store write error:", e)
+            for op in ops:
+                if isinstance(op, _Sync):
+                    op.release(e)
+        with _committed:
+            _pending -= len(ops)
+            _committed.notify_all()
+
+
+def _start_writer():
+    global _writer
+    if _writer is not None:
+        return
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_run_writer, name="jobstore-writer", daemon=True)
+            _writer.start()
+
+
+def flush(timeout: float = 5.0) -> bool:
+    """Wait until everything queued so far is committed."""
+    with _committed:
+        return _committed.wait_for(lambda: _pending == 0, timeout)
+
+
+def _at_exit():
+    jobs_functions.shutdown()       # batches still draining record their last leads first
+    flush()
+
+
+atexit.register(_at_exit)
@@ -0,0 +1,138 @@
+"""JSON helpers: orjson when it's installed, and a lazy submitAsyncAction payload.
+
+parse_payload() reads the top-level Marketo fields into a dict but leaves
+objectData in the request bytes – it only records where each lead starts and
+ends – and Payload.leads() parses one lead at a time as the pipeline asks for
+it. Each lead is checked at submit with the same loads() that leads() uses, so
+a lead the job could not parse later is a 400 now. The request bytes are kept
+as they arrived, so logging never re-serializes them."""
+import codecs
+import json
+import re
+from array import array
+from typing import Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_decoder = json.JSONDecoder()
+_WS = re.compile(r"[ \t\n\r]*")
+
+
+def loads(text: str | bytes):
+    return orjson.loads(text) if orjson is not None else json.loads(text)
+
+
+def dumps(value) -> bytes:
+    """Compact UTF-8 JSON; values JSON can't represent are stringified."""
+    if orjson is not None:
+        return orjson.dumps(value, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(value, default=str, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class Payload(dict):
+    """The top-level fields of a submitAsyncAction body (token, callbackUrl …)
+    as a dict; the objectData leads come from leads(), one at a time."""
+
+    def __init__(self, fields: dict, raw: bytes, starts: array | None = None, ends: array | None = None):
+        super().__init__(fields)
+        self.raw = raw
+        self._starts = starts if starts is not None else array("q")
+        self._ends = ends if ends is not None else array("q")
+
+    @property
+    def lead_count(self) -> int:
+        return len(self._starts)
+
+    def leads(self, first: int = 0) -> Iterator[dict]:
+        """Leads in order, from index `first` on."""
+        raw = self.raw
+        for start, end in zip(self._starts[first:], self._ends[first:], strict=True):
+            yield loads(raw[start:end])
+
+
+class _ByteOffsets:
+    """Maps increasing char indexes of the decoded body to byte indexes into the raw body."""
+
+    def __init__(self, text: str, skip: int):
+        self.text, self.ascii = text, text.isascii()
+        self.char, self.byte = 0, skip
+
+    def __call__(self, i: int) -> int:
+        if self.ascii:
+            return self.byte + i
+        self.byte += len(self.text[self.char:i].encode("utf-8"))
+        self.char = i
+        return self.byte
+
+
+def _expect(text: str, i: int, chars: str) -> tuple[str, int]:
+    i = _WS.match(text, i).end()
+    if i >= len(text) or text[i] not in chars:
+        found = repr(text[i]) if i < len(text) else "end of input"
+        raise ValueError(f"expected {' or '.join(map(repr, chars))} at char {i}, found {found}")
+    return text[i], i + 1
+
+
+def _scan_leads(text: str, i: int, raw: bytes, offsets: _ByteOffsets) -> tuple[array, array, int]:
+    """Byte offsets in raw of every element of the array starting at text[i] ('[')
+    → (starts, ends, i after ']')."""
+    starts, ends = array("q"), array("q")
+    first, after = _expect(text, i + 1, "]{")
+    if first == "]":
+        return starts, ends, after
+    i = after - 1
+    while True:
+        i = _WS.match(text, i).end()
+        # decoded only to find where it ends – nothing is kept
+        lead, end = _decoder.raw_decode(text, i)
+        if not isinstance(lead, dict):
+            raise ValueError("objectData items must be JSON objects")
+        start_b, end_b = offsets(i), offsets(end)
+        if orjson is not None:
+            # stricter than the stdlib (lone surrogates, NaN): what it rejects now, leads() would later
+            try:
+                orjson.loads(raw[start_b:end_b])
+            except orjson.JSONDecodeError as e:
+                raise ValueError(f"objectData item {len(starts)}: {e}") from None
+        starts.append(start_b)
+        ends.append(end_b)
+        sep, i = _expect(text, end, ",]")
+        if sep == "]":
+            return starts, ends, i
+
+
+def parse_payload(raw: bytes) -> Payload:
+    """Raises ValueError if raw isn't a JSON object (or objectData isn't a list of objects)."""
+    text = raw.decode("utf-8-sig")
+    offsets = _ByteOffsets(text, len(codecs.BOM_UTF8) if raw.startswith(codecs.BOM_UTF8) else 0)
+    fields: dict = {}
+    starts = ends = None
+
+    _, i = _expect(text, 0, "{")
+    i = _WS.match(text, i).end()
+    if text.startswith("}", i):
+        i += 1
+    else:
+        while True:
+            i = _WS.match(text, i).end()
+            key, i = _decoder.raw_decode(text, i)
+            if not isinstance(key, str):
+                raise ValueError(f"expected a field name at char {i}")
+            _, i = _expect(text, i, ":")
+            i = _WS.match(text, i).end()
+            if key == "objectData":
+                if not text.startswith("[", i):
+                    raise ValueError("objectData must be a list")
+                starts, ends, i = _scan_leads(text, i, raw, offsets)
+            else:
+                fields[key], i = _decoder.raw_decode(text, i)
+            sep, i = _expect(text, i, ",}")
+            if sep == "}":
+                break
+
+    if text[i:].strip():
+        raise ValueError(f"extra data after the JSON object at char {i}")
+    return Payload(fields, raw, starts, ends)
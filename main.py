@@ -1,12 +1,14 @@
+import os
+
 from flask import Flask
-from services.gptCompletion.routes import bp as gpt_bp
-from services.sendSMS.routes import bp as sms_bp
-from services.calcFormula.routes import bp as calc_bp
+
+import ssfs_functions
+from services.calcFormula.routes import service as calc_service
+from services.gptCompletion.routes import service as gpt_service
+from services.sendSMS.routes import service as sms_service
 
 app = Flask(__name__)
-app.register_blueprint(gpt_bp)
-app.register_blueprint(sms_bp)
-app.register_blueprint(calc_bp)
+ssfs_functions.init_app(app, [gpt_service, sms_service, calc_service])
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=3000)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 3000)))
@@ -0,0 +1,145 @@
+"""ASGI entry point: the same app as main.py, with native async batches.
+
+    uvicorn main_asgi:app --host 0.0.0.0 --port $PORT
+    gunicorn -w 2 -k uvicorn.workers.UvicornWorker main_asgi:app   # keeps gunicorn.conf.py's hooks
+
+POST /<base>/submitAsyncAction for a service that implements handle_lead_async
+(gptCompletion, sendSMS) is answered here, and its batch runs as a task on this
+process's event loop. OpenAI, Telnyx and Marketo calls are awaited on pooled
+httpx connections, so one process keeps thousands of them in flight instead of
+a thread per lead. Every other route – icons, definitions, picklists, status,
+/metrics and calcFormula, whose work is CPU-bound in its sandbox – is the
+unchanged Flask app, run through asgiref's WSGI adapter on a worker thread.
+
+Needs the `asgi` extra (asgiref and uvicorn: poetry install -E asgi); main.py
+under gunicorn/gevent stays the default deployment."""
+import asyncio
+import traceback
+
+from asgiref.wsgi import WsgiToAsgi
+
+import jobs_functions
+import jobstore_functions
+import json_functions
+import marketo_functions
+import metrics_functions
+import ssfs_functions
+import tracing_functions
+from main import app as flask_app
+from services.gptCompletion import openai_functions
+from services.sendSMS import telnyx_functions
+
+_wsgi = WsgiToAsgi(flask_app)
+_batches: set[asyncio.Task] = set()      # accepted and not finished; capped at JOB_QUEUE_DEPTH
+_stopping = False
+
+
+async def _send(send, status: int, body: bytes = b"", headers: list[tuple[bytes, bytes]] | None = None):
+    tracing_functions.set_attributes(**{"http.status_code": status})
+    headers = list(headers or [])
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _error(send, status: int, message: str, headers=None):
+    await _send(send, status, json_functions.dumps({"error": message}),
+                [(b"content-type", b"application/json")] + (headers or []))
+
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("client disconnected")
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+def _native(scope) -> ssfs_functions.Service | None:
+    """The service whose submitAsyncAction this request is, if it runs on the event loop."""
+    if scope["type"] != "http" or scope["method"] != "POST":
+        return None
+    parts = scope["path"].strip("/").split("/")
+    if len(parts) != 2 or parts[1] != "submitAsyncAction":
+        return None
+    service = ssfs_functions.get_service(parts[0])
+    return service if service is not None and service.supports_async else None
+
+
+async def _run_batch(service: ssfs_functions.Service, data: json_functions.Payload, timestamp: str,
+                     job: jobstore_functions.Job | None):
+    try:
+        await service.process_batch_async(data, timestamp, job)
+    except Exception as e:
+        print("Job error:", e, traceback.format_exc())
+
+
+async def _submit(service: ssfs_functions.Service, scope, receive, send):
+    headers = dict(scope["headers"])
+    with metrics_functions.stage(service.base, "auth"), tracing_functions.span("ssfs.auth"):
+        ok = ssfs_functions.check_basic_auth(headers.get(b"authorization", b"").decode("latin-1"))
+    if not ok:
+        return await _send(send, 401, b"Authentication required",
+                           [(b"content-type", b"text/plain"),
+                            (b"www-authenticate", f"Basic realm={service.realm}".encode())])
+
+    timestamp = ssfs_functions.pacific_now()
+    data, error = service.parse_submission(await _read_body(receive))
+    if error:
+        return await _error(send, 400, error)
+
+    if _stopping:
+        return await _error(send, 503, "job engine is shutting down")
+    if len(_batches) >= jobs_functions.JOB_QUEUE_DEPTH:
+        return await _error(send, 503, f"job queue is full ({jobs_functions.JOB_QUEUE_DEPTH} batches)")
+
+    # the task copies this request's context, so the batch is traced as its child
+    with metrics_functions.stage(service.base, "enqueue"):
+        job = await asyncio.to_thread(jobstore_functions.add, service.base, data.raw, timestamp)
+        task = asyncio.create_task(_run_batch(service, data, timestamp, job))
+        _batches.add(task)
+        task.add_done_callback(_batches.discard)
+    await _send(send, 202)
+
+
+async def _shutdown():
+    global _stopping
+    _stopping = True
+    if _batches:
+        _, pending = await asyncio.wait(set(_batches), timeout=jobs_functions.JOB_DRAIN_SECONDS)
+        if pending:
+            print(f"Job engine: {len(pending)} batch(es) still running at shutdown")
+            for task in pending:
+                task.cancel()              # their finished leads are in the job store
+            await asyncio.wait(pending, timeout=5)
+    await asyncio.to_thread(jobstore_functions.flush)
+    for close in (openai_functions.close_async, telnyx_functions.close_async,
+                  marketo_functions.close_async):
+        await close()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+
+    service = _native(scope)
+    if service is None:
+        return await _wsgi(scope, receive, send)
+
+    with tracing_functions.span(f"POST /{service.base}/submitAsyncAction",
+                                **{"http.method": "POST", "http.target": scope["path"]}):
+        await _submit(service, scope, receive, send)
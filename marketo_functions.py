@@ -0,0 +1,323 @@
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import jobs_functions
+import json_functions
+import metrics_functions
+import ratelimit_functions
+import tracing_functions
+
+# ---------- CONFIG ----------
+MUNCHKIN_ID       = "123"
+CALLBACK_TIMEOUT  = float(os.getenv("CALLBACK_TIMEOUT", 10))
+CALLBACK_RETRIES  = int(os.getenv("CALLBACK_RETRIES", 4))          # in-line, with exponential backoff
+CALLBACK_POOL     = int(os.getenv("CALLBACK_POOL", jobs_functions.JOB_WORKERS * 2))
+RETRY_STATUSES    = (429, 500, 502, 503, 504)
+
+# results go back in chunks as soon as a chunk is full, so memory stays flat
+# and Marketo sees the first leads before the slowest one finishes
+CALLBACK_CHUNK_SIZE  = int(os.getenv("CALLBACK_CHUNK_SIZE", 500))           # objects per callback
+CALLBACK_CHUNK_BYTES = int(os.getenv("CALLBACK_CHUNK_BYTES", 1_000_000))    # JSON bytes per callback
+
+# callbacks that still fail are parked here and retried in the background
+OUTBOX_DIR        = os.getenv("CALLBACK_OUTBOX_DIR", os.path.join(tempfile.gettempdir(), "ssfs-callback-outbox"))
+OUTBOX_RETRY_SECONDS = float(os.getenv("CALLBACK_OUTBOX_RETRY_SECONDS", 60))
+OUTBOX_MAX_AGE    = float(os.getenv("CALLBACK_OUTBOX_MAX_AGE", 24 * 3600))   # then moved to dead/
+
+# one keep-alive session for every callback in this process; retries are
+# _retry_delay's, the same for this session and the event loop's
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=CALLBACK_POOL, max_retries=0))
+_session.mount("http://", _session.get_adapter("https://"))
+
+_async_session: httpx.AsyncClient | None = None     # main_asgi only; bound to its event loop
+
+_outbox_thread: threading.Thread | None = None
+_outbox_lock = threading.Lock()
+
+
+def _headers(api_key: str, token: str) -> dict:
+    return {
+        "x-api-key":        api_key,
+        "x-callback-token": token,
+        "Content-Type":     "application/json"
+    }
+
+
+def _callback_span(token: str, objects: int, attempt: int):
+    return tracing_functions.span("marketo.callback", **{"marketo.token": token, "ssfs.objects": objects,
+                                                         "attempt": attempt})
+
+
+def _retry_delay(attempt: int, r=None) -> float | None:
+    """Seconds to wait before trying again after response `r` (None: the request failed),
+    or None when that was the final answer. The one retry policy for every callback."""
+    if r is not None and r.status_code not in RETRY_STATUSES:
+        return None
+    if attempt == CALLBACK_RETRIES:
+        if r is not None and r.status_code == 429:
+            metrics_functions.rate_limited("marketo")
+        return None
+    retry_after = r.headers.get("retry-after", "") if r is not None else ""
+    return ratelimit_functions.backoff(attempt, base=0.5,
+                                       retry_after=float(retry_after) if retry_after.isdigit() else None)
+
+
+def _post(url: str, api_key: str, token: str, body: bytes, objects: int) -> requests.Response:
+    for attempt in range(CALLBACK_RETRIES + 1):
+        try:
+            with metrics_functions.provider_call("marketo"), _callback_span(token, objects, attempt) as span:
+                r = _session.post(url, headers=_headers(api_key, token), data=body, timeout=CALLBACK_TIMEOUT)
+                span.set_attribute("http.status_code", r.status_code)
+        except requests.RequestException:
+            delay = _retry_delay(attempt)
+            if delay is None:
+                raise
+        else:
+            delay = _retry_delay(attempt, r)
+            if delay is None:
+                return r
+        time.sleep(delay)
+
+
+async def _post_async(url: str, api_key: str, token: str, body: bytes, objects: int) -> httpx.Response:
+    for attempt in range(CALLBACK_RETRIES + 1):
+        try:
+            with metrics_functions.provider_call("marketo"), _callback_span(token, objects, attempt) as span:
+                r = await _get_async_session().post(url, headers=_headers(api_key, token), content=body,
+                                                    timeout=CALLBACK_TIMEOUT)
+                span.set_attribute("http.status_code", r.status_code)
+        except httpx.HTTPError:
+            delay = _retry_delay(attempt)
+            if delay is None:
+                raise
+        else:
+            delay = _retry_delay(attempt, r)
+            if delay is None:
+                return r
+        await asyncio.sleep(delay)
+
+
+def _body(callback_objects: list[dict | bytes]) -> bytes:
+    """The callback's JSON body; objects already encoded (bytes) are spliced in as they are."""
+    encoded = [o if isinstance(o, bytes) else json_functions.dumps(o) for o in callback_objects]
+    return b'{"munchkinId":%s,"objectData":[%s]}' % (json_functions.dumps(MUNCHKIN_ID), b",".join(encoded))
+
+
+def sendCallback(data: dict, callback_objects: list[dict | bytes]) -> requests.Response:
+    """POST results to Marketo's callbackUrl; park them in the outbox if it keeps failing.
+
+    Objects may be dicts or their JSON bytes."""
+    body = _body(callback_objects)
+    try:
+        r = _post(data["callbackUrl"], data["apiCallBackKey"], data["token"], body, len(callback_objects))
+    except requests.RequestException:
+        _to_outbox(data, body, len(callback_objects))
+        raise
+    if r.status_code in RETRY_STATUSES:
+        _to_outbox(data, body, len(callback_objects))
+    return r
+
+
+async def sendCallbackAsync(data: dict, callback_objects: list[dict | bytes]) -> httpx.Response:
+    """sendCallback for the event loop, with the same retries and outbox."""
+    body = _body(callback_objects)
+    try:
+        r = await _post_async(data["callbackUrl"], data["apiCallBackKey"], data["token"], body,
+                              len(callback_objects))
+    except httpx.HTTPError:
+        await asyncio.to_thread(_to_outbox, data, body, len(callback_objects))
+        raise
+    if r.status_code in RETRY_STATUSES:
+        await asyncio.to_thread(_to_outbox, data, body, len(callback_objects))
+    return r
+
+
+def _get_async_session() -> httpx.AsyncClient:
+    global _async_session
+    if _async_session is None:
+        _async_session = httpx.AsyncClient(limits=httpx.Limits(max_connections=CALLBACK_POOL * 8))
+    return _async_session
+
+
+async def close_async():
+    global _async_session
+    if _async_session is not None:
+        await _async_session.aclose()
+        _async_session = None
+
+
+class CallbackStream:
+    """Sends callback objects to Marketo in chunks as they become ready.
+
+    add() returns True when that object completed a chunk and it was sent."""
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.responses: list[requests.Response | httpx.Response] = []
+        self.errors: list[str] = []
+        self.sent = 0
+        self._chunk: list[bytes] = []         # each object's JSON, encoded once
+        self._bytes = 0
+
+    def add(self, callback_object: dict) -> bool:
+        if self._push(callback_object):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if not self._chunk:
+            return
+        chunk = self._take()
+        try:
+            self._record(sendCallback(self.data, chunk))
+        except requests.RequestException as e:     # already parked in the outbox
+            self.errors.append(f"Callback failed: {e}")
+
+    def close(self):
+        self.flush()
+
+    def _push(self, callback_object: dict) -> bool:
+        """Buffer one object; True once the chunk is full."""
+        encoded = json_functions.dumps(callback_object)
+        self._chunk.append(encoded)
+        self._bytes += len(encoded)
+        return len(self._chunk) >= CALLBACK_CHUNK_SIZE > 0 or self._bytes >= CALLBACK_CHUNK_BYTES > 0
+
+    def _take(self) -> list[bytes]:
+        chunk, self._chunk, self._bytes = self._chunk, [], 0
+        self.sent += len(chunk)
+        return chunk
+
+    def _record(self, r):
+        self.responses.append(r)
+        if r.status_code >= 400:
+            self.errors.append(f"Callback HTTP {r.status_code}")
+            print(f"Callback HTTP {r.status_code}:", r.text)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    @property
+    def text(self) -> str:
+        return "\n".join(r.text for r in self.responses)
+
+
+class AsyncCallbackStream(CallbackStream):
+    """CallbackStream for the event loop: add(), flush() and close() are awaited."""
+
+    async def add(self, callback_object: dict) -> bool:
+        if self._push(callback_object):
+            await self.flush()
+            return True
+        return False
+
+    async def flush(self):
+        if not self._chunk:
+            return
+        chunk = self._take()
+        try:
+            self._record(await sendCallbackAsync(self.data, chunk))
+        except httpx.HTTPError as e:               # already parked in the outbox
+            self.errors.append(f"Callback failed: {e}")
+
+    async def close(self):
+        await self.flush()
+
+
+# ---------- outbox ----------
+# items hold the apiCallBackKey and token in plain text, so only this user may read them
+def _write_item(path: str, item: dict):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(item, f)
+
+
+def _to_outbox(data: dict, body: bytes, objects: int):
+    os.makedirs(OUTBOX_DIR, mode=0o700, exist_ok=True)
+    item = {
+        "url": data["callbackUrl"], "api_key": data["apiCallBackKey"], "token": data["token"],
+        "body": body.decode("utf-8"), "objects": objects, "created": time.time(), "attempts": 0,
+    }
+    name = f"{int(time.time() * 1000)}-{uuid.uuid4().hex}"
+    tmp = os.path.join(OUTBOX_DIR, f".{name}.tmp")
+    _write_item(tmp, item)
+    os.replace(tmp, os.path.join(OUTBOX_DIR, f"{name}.json"))
+    print(f"Callback parked in outbox: {name} ({objects} object(s))")
+    _start_outbox()
+
+
+def _retry_item(path: str):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)   # another worker has it
+        except BlockingIOError:
+            return
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            item = json.load(f)
+
+        try:
+            r = _post(item["url"], item["api_key"], item["token"], item["body"].encode("utf-8"), item["objects"])
+            delivered = r.status_code not in RETRY_STATUSES
+        except requests.RequestException:
+            delivered = False
+
+        if delivered:
+            os.remove(path)
+        elif time.time() - item["created"] > OUTBOX_MAX_AGE:
+            os.makedirs(os.path.join(OUTBOX_DIR, "dead"), mode=0o700, exist_ok=True)
+            os.replace(path, os.path.join(OUTBOX_DIR, "dead", os.path.basename(path)))
+            print("Callback gave up after", OUTBOX_MAX_AGE, "s:", os.path.basename(path))
+        else:
+            item["attempts"] += 1
+            _write_item(path, item)
+    finally:
+        os.close(fd)
+
+
+def retryOutbox():
+    if not os.path.isdir(OUTBOX_DIR):
+        return
+    for name in sorted(os.listdir(OUTBOX_DIR)):
+        if name.endswith(".json"):
+            try:
+                _retry_item(os.path.join(OUTBOX_DIR, name))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print("Callback outbox error:", name, e, traceback.format_exc())
+
+
+def _run_outbox():
+    while True:
+        time.sleep(OUTBOX_RETRY_SECONDS)
+        retryOutbox()
+
+
+def _start_outbox():
+    global _outbox_thread
+    with _outbox_lock:
+        if _outbox_thread is None:
+            _outbox_thread = threading.Thread(target=_run_outbox, name="callback-outbox", daemon=True)
+            _outbox_thread.start()
+
+
+# callbacks parked by a previous process get picked up again
+if os.path.isdir(OUTBOX_DIR) and any(n.endswith(".json") for n in os.listdir(OUTBOX_DIR)):
+    _start_outbox()
@@ -0,0 +1,140 @@
+"""Prometheus metrics shared by every gunicorn worker.
+
+prometheus_client is optional: without it every helper here is a no-op and
+/metrics answers 501. Workers write to mmap'd files in PROMETHEUS_MULTIPROC_DIR
+and /metrics sums them, so whichever worker is scraped reports the whole
+instance (gunicorn.conf.py clears the directory and retires dead workers)."""
+import contextlib
+import os
+import shutil
+import tempfile
+import time
+
+# ---------- CONFIG ----------
+# must be in the environment before prometheus_client is imported
+METRICS_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR",
+                                    os.path.join(tempfile.gettempdir(), "ssfs-metrics"))
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+class _Noop:
+    def labels(self, *_args, **_kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def set(self, value):
+        pass
+
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "ssfs_stage_seconds", "Time per pipeline stage (auth, parse, enqueue, lead, batch …)",
+        ["service", "stage"], buckets=BUCKETS)
+    PROVIDER_SECONDS = prometheus_client.Histogram(
+        "ssfs_provider_seconds", "Time per outbound call (openai, telnyx, marketo, sheets, sandbox)",
+        ["provider"], buckets=BUCKETS)
+    LEADS = prometheus_client.Counter("ssfs_leads", "Leads processed", ["service"])
+    LEAD_ERRORS = prometheus_client.Counter("ssfs_lead_errors", "Leads that came back with an error", ["service"])
+    RATE_LIMITED = prometheus_client.Counter("ssfs_rate_limited", "HTTP 429s from a provider", ["provider"])
+    CACHE = prometheus_client.Counter("ssfs_cache_lookups", "Cache lookups by result", ["cache", "result"])
+    GENERATION_SECONDS = prometheus_client.Histogram(
+        "ssfs_generation_seconds", "OpenAI time to first token (streamed only) and to the whole answer",
+        ["model", "phase"], buckets=BUCKETS)
+    TRUNCATED = prometheus_client.Counter("ssfs_generation_truncated", "Answers cut short, by what cut them",
+                                          ["model", "reason"])
+    QUEUE_DEPTH = prometheus_client.Gauge("ssfs_job_queue_depth", "Batches waiting for a job worker",
+                                          multiprocess_mode="livesum")
+else:
+    STAGE_SECONDS = PROVIDER_SECONDS = LEADS = LEAD_ERRORS = RATE_LIMITED = CACHE = QUEUE_DEPTH = _Noop()
+    GENERATION_SECONDS = TRUNCATED = _Noop()
+
+# .labels() takes a lock and builds a tuple; the per-lead path looks children up here instead
+_children: dict[tuple, object] = {}
+
+
+def _child(metric, *labels):
+    key = (id(metric), labels)
+    child = _children.get(key)
+    if child is None:
+        child = _children[key] = metric.labels(*labels)
+    return child
+
+
+@contextlib.contextmanager
+def stage(service: str, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _child(STAGE_SECONDS, service, name).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def provider_call(provider: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _child(PROVIDER_SECONDS, provider).observe(time.perf_counter() - start)
+
+
+def lead_done(service: str, error: bool):
+    _child(LEADS, service).inc()
+    if error:
+        _child(LEAD_ERRORS, service).inc()
+
+
+def rate_limited(provider: str):
+    _child(RATE_LIMITED, provider).inc()
+
+
+def cache_lookup(cache: str, result: str):
+    """result: hit, miss or shared (answered by an identical call already in flight)."""
+    _child(CACHE, cache, result).inc()
+
+
+def generation(model: str, ttft_ms: float | None, total_ms: float, truncated: str):
+    """truncated: max-length, stop-pattern, output-tokens or "" (complete)."""
+    if ttft_ms is not None:
+        _child(GENERATION_SECONDS, model, "ttft").observe(ttft_ms / 1000)
+    _child(GENERATION_SECONDS, model, "total").observe(total_ms / 1000)
+    if truncated:
+        _child(TRUNCATED, model, truncated).inc()
+
+
+def set_queue_depth(depth: int):
+    QUEUE_DEPTH.set(depth)
+
+
+def render() -> tuple[bytes, str] | None:
+    """Prometheus text exposition for the whole instance, or None without prometheus_client."""
+    if prometheus_client is None:
+        return None
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+# ---------- process lifecycle (gunicorn.conf.py) ----------
+def reset():
+    """Wipe samples left by a previous run; call before any worker starts."""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+def mark_process_dead(pid: int):
+    if prometheus_client is not None:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,158 @@
+import asyncio
+import fcntl
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+# ---------- CONFIG ----------
+# one small JSON file per bucket; flock() on it makes the bucket shared by every
+# gunicorn worker on the instance instead of each worker spending the full quota
+RATELIMIT_DIR = os.getenv("RATELIMIT_DIR", os.path.join(tempfile.gettempdir(), "ssfs-ratelimit"))
+
+_BUSY = object()        # _locked(wait=False): another process holds the bucket
+
+
+class TokenBucket:
+    """Multi-dimension token bucket (e.g. requests + tokens per minute).
+
+    `limits` is the budget per `period` seconds for each dimension; a bucket
+    starts full so bursts up to the limit go straight through. Only limits an
+    API reported (update/drain) are kept in the state file – the configured
+    ones are read from `limits` on every call, so changing them takes effect."""
+
+    def __init__(self, name: str, limits: dict[str, float], period: float = 60.0):
+        os.makedirs(RATELIMIT_DIR, exist_ok=True)
+        self.name = name
+        self.period = period
+        self.path = os.path.join(RATELIMIT_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}.json")
+        self.default_limits = {k: float(v) for k, v in limits.items()}
+        # acquire_async waiters queue here, so one task per process polls the file, not thousands
+        self._async_lock = asyncio.Lock()
+
+    # ---- state file (caller holds the lock) ----
+    def _load(self, fd, now: float) -> dict:
+        raw = os.pread(fd, 1 << 16, 0)
+        try:
+            state = json.loads(raw) if raw else {}
+        except ValueError:
+            state = {}
+        learned = state.get("learned") or {}
+        limits = self.default_limits | learned
+        levels = state.get("levels") or dict(limits)
+        elapsed = max(now - state.get("updated", now), 0.0)
+        for k, cap in limits.items():
+            levels[k] = min(cap, levels.get(k, cap) + elapsed * cap / self.period)
+        return {"limits": limits, "learned": learned, "levels": levels, "updated": now}
+
+    def _save(self, fd, state: dict):
+        # limits are rebuilt by _load from the configured ones and what was learned
+        raw = json.dumps({k: v for k, v in state.items() if k != "limits"}).encode()
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, raw, 0)
+
+    def _locked(self, fn, wait: bool = True):
+        """fn(state) under the file lock; _BUSY instead if another process holds it and not `wait`."""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not wait:
+                    return _BUSY
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            state = self._load(fd, time.time())
+            result = fn(state)
+            self._save(fd, state)
+            return result
+        finally:
+            os.close(fd)          # also releases the lock
+
+    async def _locked_async(self, fn):
+        # the state file is tiny and local, so only waiting for another process's
+        # lock would block the event loop – that wait happens on a worker thread
+        result = self._locked(fn, wait=False)
+        if result is _BUSY:
+            result = await asyncio.to_thread(self._locked, fn)
+        return result
+
+    # ---- public API ----
+    def _take(self, costs: dict[str, float]):
+        def _take(state):
+            limits, levels = state["limits"], state["levels"]
+            # a single call bigger than the whole budget waits for a full bucket
+            need = {k: min(float(c), limits[k]) for k, c in costs.items() if k in limits}
+            short = {k: c - levels[k] for k, c in need.items() if levels[k] < c}
+            if not short:
+                for k, c in need.items():
+                    levels[k] -= c
+                return 0.0
+            return max(s * self.period / limits[k] for k, s in short.items())
+        return _take
+
+    def _adjust(self, limits: dict[str, float] | None, remaining: dict[str, float] | None, drain: bool = False):
+        def _adjust(state):
+            for k, v in (limits or {}).items():
+                if v > 0:
+                    state["limits"][k] = state["learned"][k] = float(v)
+                    state["levels"][k] = min(state["levels"].get(k, v), float(v))
+            for k, v in (remaining or {}).items():
+                if k in state["levels"]:
+                    state["levels"][k] = min(state["levels"][k], max(float(v), 0.0))
+            if drain:
+                for k in state["levels"]:
+                    state["levels"][k] = 0.0
+        return _adjust
+
+    def try_acquire(self, **costs: float) -> float:
+        """Take `costs` if available and return 0, else return seconds to wait."""
+        return self._locked(self._take(costs))
+
+    def acquire(self, **costs: float) -> float:
+        """Block until `costs` can be taken; returns the total time waited."""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(**costs)
+            if wait <= 0:
+                return waited
+            wait = min(wait, 5.0) * random.uniform(1.0, 1.2)   # de-sync the waiters
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, **costs: float) -> float:
+        """acquire() for the event loop: waits without blocking other tasks, first come first served."""
+        waited = 0.0
+        async with self._async_lock:
+            while True:
+                wait = await self._locked_async(self._take(costs))
+                if wait <= 0:
+                    return waited
+                wait = min(wait, 5.0) * random.uniform(1.0, 1.2)
+                await asyncio.sleep(wait)
+                waited += wait
+
+    def update(self, limits: dict[str, float] | None = None, remaining: dict[str, float] | None = None):
+        """Adopt limits reported by the API and never hold more than it says is left."""
+        if limits or remaining:
+            self._locked(self._adjust(limits, remaining))
+
+    async def update_async(self, limits: dict[str, float] | None = None, remaining: dict[str, float] | None = None):
+        if limits or remaining:
+            await self._locked_async(self._adjust(limits, remaining))
+
+    def drain(self, limits: dict[str, float] | None = None, remaining: dict[str, float] | None = None):
+        """After a 429: adopt what the API reported, then empty the bucket."""
+        self._locked(self._adjust(limits, remaining, drain=True))
+
+    async def drain_async(self, limits: dict[str, float] | None = None, remaining: dict[str, float] | None = None):
+        await self._locked_async(self._adjust(limits, remaining, drain=True))
+
+
+def backoff(attempt: int, base: float = 1.0, cap: float = 30.0, retry_after: float | None = None) -> float:
+    """Full-jitter exponential backoff, never shorter than a server Retry-After."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
@@ -1,4 +1,9 @@
+import functools
+import os
+import re
+
 import formulas
+import numpy as np
 
 TYPE_MAP = {
     "int": int,
@@ -7,12 +12,101 @@ TYPE_MAP = {
     "bool": bool
 }
 
-def compute_formula(formula, output_type):
-  
+FORMULA_CACHE_SIZE = int(os.getenv("FORMULA_CACHE_SIZE", 1024))   # distinct formulas kept compiled
+
+# results of these change between calls, so they're never served from the result cache
+VOLATILE = re.compile(r"\b(NOW|TODAY|RAND|RANDBETWEEN|RANDARRAY)\s*\(", re.IGNORECASE)
+
+# functions that work cell-by-cell on an array; anything else (SUM, MAX, AND …)
+# would aggregate across leads, so templates using it are evaluated lead by lead
+ELEMENTWISE = {"IF", "IFERROR", "ROUND", "ROUNDUP", "ROUNDDOWN", "ABS", "INT", "SQRT",
+               "EXP", "LN", "LOG10", "POWER", "MOD", "SIGN"}
+FUNCTION_CALL = re.compile(r"([A-Za-z_][A-Za-z0-9_.]*)\s*\(")
+
+
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _compile(formula: str):
+    # parsing + compiling costs far more than evaluating, so do it once per formula text
+    return formulas.Parser().ast(formula)[1].compile()
+
+
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def _evaluate_constant(formula: str):
+    return _compile(formula)()
+
+
+def cache_stats() -> dict:
+    stats = {}
+    for name, fn in (("compiled", _compile), ("constant_results", _evaluate_constant)):
+        info = fn.cache_info()
+        stats[name] = {"size": info.currsize, "max_size": info.maxsize,
+                       "hits": info.hits, "misses": info.misses}
+    return stats
+
+
+def _output_type(output_type):
     if isinstance(output_type, str):
       output_type = TYPE_MAP.get(output_type.lower())
       if output_type is None:
           raise ValueError(f"Unsupported output_type: {output_type}")
-        
-    result = formulas.Parser().ast(formula)[1].compile()()
-    return output_type(result)
\ No newline at end of file
+    return output_type
+
+
+def _scalar(value):
+    # a single-cell Excel array → its one value
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.ravel()[0]
+    return value
+
+
+def _vectorizable(formula: str) -> bool:
+    return not VOLATILE.search(formula) and \
+        all(name.upper() in ELEMENTWISE for name in FUNCTION_CALL.findall(formula))
+
+
+def compute_formula_batch(formula: str, output_type, inputs: list[dict]) -> list:
+    """Evaluate one formula template for many leads.
+
+    `inputs` holds one {name: value} dict per lead (names are case-insensitive).
+    Returns the typed result – or the Exception – for each lead, in order."""
+    output_type = _output_type(output_type)
+    func = _compile(formula)
+    names = list(func.inputs)
+    rows = [{k.upper(): v for k, v in values.items()} for values in inputs]
+
+    # one call over column arrays when every lead has every input and the
+    # template is cell-by-cell; any surprise falls back to per-lead calls
+    vector = None
+    if len(rows) > 1 and names and _vectorizable(formula) and \
+            all(n in row for row in rows for n in names):
+        try:
+            args = [np.array([[row[n]] for row in rows], dtype=object) for n in names]
+            out = np.asarray(func(*args), dtype=object).ravel()
+            if out.size == len(rows):
+                vector = out
+        except Exception:
+            vector = None
+
+    results = []
+    for i, row in enumerate(rows):
+        try:
+            if vector is not None:
+                value = vector[i]
+            else:
+                missing = [n for n in names if n not in row]
+                if missing:
+                    raise ValueError(f"Missing template input(s): {', '.join(missing)}")
+                value = func(*[row[n] for n in names])
+            results.append(output_type(_scalar(value)))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+def compute_formula(formula, output_type):
+
+    output_type = _output_type(output_type)
+
+    func = _compile(formula)
+    constant = not func.inputs and not VOLATILE.search(formula)
+    return output_type(_evaluate_constant(formula) if constant else func())
@@ -1,306 +1,250 @@
-# services/hearAbout/routes.py
-from flask import Blueprint, request, jsonify, Response, send_file, send_from_directory
-from datetime import datetime
-import os, requests, pandas as pd, json, traceback, pytz
-import googlesheets_functions
-from . import formula_functions
+# services/calcFormula/routes.py
+import json
+import os
+import traceback
 
-base = "calcFormula"
-bp = Blueprint(base, __name__, url_prefix=f"/{base}")
+import metrics_functions
+import ssfs_functions
+import tracing_functions
 
-# ---------- CONFIG ----------
-SHEET_LEADS   = f"{base}Leads"
-SHEET_BATCHES = f"{base}Batches"
-SPREADSHEET_ID = "xxx" #change this
-pacific        = pytz.timezone("America/Los_Angeles")
-MAX_CELL = 50000          # Sheets’ absolute limit
-SAFE_SLICE = 48000        # leave UTF-8 head-room
-
-# ---------- AUTH ----------
-def _check_auth(username, password):
-    return username == os.getenv("MARKETO_USER") and password == os.getenv("MARKETO_PASSWORD")
-
-def _split_long_text(col_name: str, value: str | None) -> dict[str, str]:
-    """Return {col_name: value} unless it would overflow a Sheets cell.
-       Long UTF-8 strings are sliced into N columns:  request, request_2 …"""
-    if not value:
-        return {col_name: ""}
-    b = value.encode("utf-8")
-    if len(b) <= MAX_CELL:
-        return {col_name: value}
-
-    chunks = [b[i:i+SAFE_SLICE].decode("utf-8", "ignore")
-              for i in range(0, len(b), SAFE_SLICE)]
-    return {f"{col_name}{'' if i == 0 else '_'+str(i+1)}": s
-            for i, s in enumerate(chunks)}
-
-@bp.before_app_request       # runs for every request in the whole app
-def require_basic_auth():
-    if request.path in (
-        f"/{base}/install",
-        f"/{base}/serviceIcon",
-        f"/{base}/brandIcon",
-    ):
-        return
-    if request.path.startswith(f"/{base}/status") or \
-       request.path.startswith(f"/{base}/submitAsyncAction"):
-        auth = request.authorization
-        if not auth or not _check_auth(auth.username, auth.password):
-            return Response(
-                "Authentication required",
-                401,
-                {"WWW-Authenticate": 'Basic realm=Workflow Pro GPT Completion'}
-            )
-
-# ---------- STATIC ICONS ----------
-@bp.route("/serviceIcon")
-def service_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
-
-@bp.route("/brandIcon")
-def brand_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
-
-# ---------- SSFS ENDPOINTS ----------
-@bp.route("/getPicklist", methods=["POST"])
-def get_picklist():
-
-    try:
-        payload = request.get_json(force=True) or {}
-        field_name = (payload.get("name") or "").strip()
+from . import sandbox_functions
 
-        if not field_name:
-            return jsonify({"error": "Missing 'name' in request body"}), 400
+# ---------- CONFIG ----------
+FORMULA_CHUNK_SIZE = int(os.getenv("FORMULA_CHUNK_SIZE", 256))   # template leads per sandbox task
+
+sandbox_functions.warm()
+
+def _lead_inputs(obj: dict) -> dict:
+    """Flow-step inputs for one lead."""
+    ctx = obj.get("flowStepContext", {})
+    return {
+        "lead_id":   obj.get("objectContext", {}).get("id"),
+        "formula":   ctx.get("formula", ""),
+        "data_type": ctx.get("data_type", "str"),
+        "field":     ctx.get("field"),         # **API-name** only!
+        "inputs":    ctx.get("inputs") or "",  # JSON values for a formula template
+    }
+
+def _lead_result(inp: dict, answer, error: str, timestamp: str) -> tuple[dict, dict]:
+    """(callback object, Sheets log row) for one lead."""
+    lead_id = inp["lead_id"]
+    if not error:
+        single_cb = {
+            "leadData": { "id": lead_id , inp["field"]: answer},
+            "activityData": {
+                "formula_value": inp["formula"],
+                "data_type":  inp["data_type"],
+                "field": inp["field"],
+                "answer": answer,
+                "success":   True
+            }
+        }
+    else:
+        # still send a callback entry so the step doesn’t stall
+        single_cb = {
+            "leadData": { "id": lead_id },
+            "activityData": {
+                "formula_error": error,
+                "success":   False
+            }
+        }
 
-        # ───────────── pick‑list definitions ─────────────
-        if field_name == "data_type":
-            choices = [
-                {"displayValue": {"en_US": "int"},   "submittedValue": "int"},
-                {"displayValue": {"en_US": "str"},   "submittedValue": "str"},
-                {"displayValue": {"en_US": "bool"},  "submittedValue": "bool"},
-                {"displayValue": {"en_US": "float"}, "submittedValue": "float"},
-            ]
+    # ---- (optional) log one row per lead -----------
+    row = {
+        "timestamp":    timestamp,
+        "lead_id":      ssfs_functions.lead_url(lead_id),
+        "formula":       inp["formula"],
+        "data_type":          inp["data_type"],
+        "response_field": inp["field"],
+        "answer": answer,
+        "error": error,
+        "callback_objects": str(single_cb),
+        # last, so existing Leads sheets (filled by position) keep their columns
+        "inputs":       inp["inputs"],
+    }
+
+    return single_cb, row
+
+def _format_error(e: Exception) -> str:
+    return f"{e}\n{''.join(traceback.format_exception(type(e), e, e.__traceback__))}"
+
+def _evaluate(leads: list[dict]) -> list[tuple[object, str]]:
+    """(answer, error) per lead, in lead order.
+
+    Every formula runs in the sandbox pool. Leads with template inputs are grouped
+    by (formula, data_type) and sent in chunks, so each template is compiled once
+    per worker and evaluated for a whole chunk together."""
+    results: list[tuple[object, str]] = [("", "")] * len(leads)
+    groups: dict[tuple[str, str], list[tuple[int, dict]]] = {}
+    tasks: list[tuple[str, tuple]] = []
+    owners: list[list[int]] = []          # lead indexes each task answers for
+
+    for i, inp in enumerate(leads):
+        if not inp["inputs"]:
+            tasks.append(("compute_formula", (inp["formula"], inp["data_type"])))
+            owners.append([i])
+            continue
+        try:
+            values = json.loads(inp["inputs"])
+            if not isinstance(values, dict):
+                raise ValueError("inputs must be a JSON object of name → value")
+        except Exception as e:
+            results[i] = ("", _format_error(e))
+            continue
+        groups.setdefault((inp["formula"], inp["data_type"]), []).append((i, values))
+
+    for (formula, data_type), members in groups.items():
+        for start in range(0, len(members), FORMULA_CHUNK_SIZE):
+            chunk = members[start:start + FORMULA_CHUNK_SIZE]
+            tasks.append(("compute_formula_batch", (formula, data_type, [v for _, v in chunk])))
+            owners.append([i for i, _ in chunk])
+
+    with metrics_functions.provider_call("sandbox"), \
+         tracing_functions.span("formula.evaluate", leads=len(leads), tasks=len(tasks)):
+        outcomes = sandbox_functions.run(tasks)
+
+    for (name, _), idx, outcome in zip(tasks, owners, outcomes, strict=True):
+        if isinstance(outcome, Exception):      # timeout / crashed worker / broken template
+            answers = [outcome] * len(idx)
         else:
-            return jsonify({"error": f"Unknown field name '{field_name}'"}), 400
-
-        return jsonify({"choices": choices}), 200
-
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-        
-@bp.route("/submitAsyncAction", methods=["POST"])
-def submit_async_action():
-    timestamp = datetime.now(pacific).strftime("%Y-%m-%d %H:%M:%S")
-    rows_leads: list[dict] = []        # (optional) logging
-    cb_response = ""
-    data = request.get_json(force=True)
-    
-    try:
-        
-        callback_objects: list[dict] = []
-        for obj in data.get("objectData", []):
-            octx          = obj.get("objectContext", {})
-            lead_id      = octx.get("id")
-
-            # ── flow-step inputs (all are strings except the two numerics) ──
-            ctx          = obj.get("flowStepContext", {})
-            formula   = ctx.get("formula", "")          
-            data_type   = ctx.get("data_type", "str")
-            resp_field   = ctx.get("field")      # **API-name** only!
-            answer = ""
-            error = ""
-
-            try:
-                answer = formula_functions.compute_formula(formula,data_type)
-
-                single_cb = {
-                    "leadData": { "id": lead_id , resp_field: answer},
-                    "activityData": {
-                        "formula_value": formula,
-                        "data_type":  data_type,
-                        "field": resp_field,
-                        "answer": answer,
-                        "success":   True
+            answers = outcome if name == "compute_formula_batch" else [outcome]
+        for i, answer in zip(idx, answers, strict=True):
+            results[i] = ("", _format_error(answer)) if isinstance(answer, Exception) else (answer, "")
+
+    return results
+
+# ---------- SERVICE DEFINITION ----------
+SERVICE_DEFINITION = {
+    "apiName": "calc-formula",
+    "i18n": {
+        "en_US": {
+            "name": "Calculate Formula",
+            "description": "Calculate an Excel formula",
+            "triggerName": "Formula is Calculated",
+            "filterName":  "Formula was Calculated"
+        }
+    },
+    "primaryAttribute": "formula",
+
+    "invocationPayloadDef": {
+        "flowAttributes": [
+            {
+                "apiName":  "formula",
+                "dataType": "text",
+                "description": "Open‑text field containing the formula to be calculated",
+                "i18n": {
+                    "en_US": {
+                        "name": "Formula"
                     }
                 }
-
-            except Exception as e:
-                # still send a callback entry so the step doesn’t stall
-                error = f"{e}\n{traceback.format_exc()}",
-                single_cb = {
-                    "leadData": { "id": lead_id },
-                    "activityData": {
-                        "formula_error": error,
-                        "success":   False
+            },
+            {
+                "apiName":  "data_type",
+                "dataType": "string",
+                "description": "Data type for the output",
+                "i18n": {"en_US": {"name": "Response Data Type"}},
+                "hasPicklist": True,
+                "enforcePicklistSelect": True
+                
+            },
+            {
+                "apiName":  "field",
+                "dataType": "string",
+                "description": "Field to store the result",
+                "i18n": {
+                    "en_US": {
+                        "name": "Response Field"
                     }
                 }
-
-            callback_objects.append(single_cb)
-            
-            # ---- (optional) log one row per lead -----------
-            rows_leads.append({
-                "timestamp":    timestamp,
-                "lead_id":      f"https://app-ab20.marketo.com/leadDatabase/loadLeadDetail?leadId={lead_id}",
-                "formula":       formula,
-                "data_type":          data_type,
-                "response_field": resp_field,
-                "answer": answer,
-                "error": error,
-                "callback_objects": str(single_cb)
-            })
-
-        # ─────────── ONE callback back to Marketo ────────────
-        r = requests.post(
-            data["callbackUrl"],
-            headers={
-                "x-api-key":        data["apiCallBackKey"],
-                "x-callback-token": data["token"],
-                "Content-Type":     "application/json"
             },
-            json={ "munchkinId": "123", "objectData": callback_objects },
-            timeout=10
-        )
-
-        cb_response = r.text
-
-        # -------- 3️⃣  one batch-summary row (no width-matching) -------------
-        batch_row = {
-            "timestamp":   timestamp,
-            "error":       "" if r.ok else f"Callback HTTP {r.status_code}",
-            "cb_response": cb_response
-        }
-
-        # request JSON can be huge → fan it out so every cell stays <50 kB
-        batch_row.update(_split_long_text("request", json.dumps(data)))
-
-        # ------------ (optional) write logs -----------------
-        try:
-            df_leads   = pd.DataFrame(rows_leads)
-            df_batches = pd.DataFrame([batch_row])
-            googlesheets_functions.writeDF2Sheet(df_leads,   SHEET_LEADS,   SPREADSHEET_ID)
-            googlesheets_functions.writeDF2Sheet(df_batches, SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets logging error:", gs_err)
-
-        return ("", 202) if r.ok else (jsonify({"error": r.text}), 500)
-
-    except Exception as e:
-        fail_row = {
-            "timestamp": timestamp,
-            "error": f"{e}\n{traceback.format_exc()}",
-            "cb_response": cb_response
-        }
-
-        fail_row |= _split_long_text("request", json.dumps(data, ensure_ascii=False))
-        
-        try:
-            googlesheets_functions.writeDF2Sheet(pd.DataFrame([fail_row]), SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets error while logging fatal failure:", gs_err)
-    
-        return jsonify({"error": "server error"}), 500
-
-@bp.route("/getServiceDefinition")
-def get_service_definition():
-    return jsonify({
-        "apiName": "calc-formula",
-        "i18n": {
-            "en_US": {
-                "name": "Calculate Formula",
-                "description": "Calculate an Excel formula",
-                "triggerName": "Formula is Calculated",
-                "filterName":  "Formula was Calculated"
-            }
-        },
-        "primaryAttribute": "formula",
-
-        "invocationPayloadDef": {
-            "flowAttributes": [
-                {
-                    "apiName":  "formula",
-                    "dataType": "text",
-                    "description": "Open‑text field containing the formula to be calculated",
-                    "i18n": {
-                        "en_US": {
-                            "name": "Formula"
-                        }
+            {
+                "apiName":  "inputs",
+                "dataType": "text",
+                "description": ("Optional JSON object of values for a formula template, "
+                                "e.g. {\"score\": 10, \"weight\": 0.5} for =score*weight"),
+                "i18n": {
+                    "en_US": {
+                        "name": "Template Inputs"
                     }
-                },
+                }
+            }
+        ],
+        "userDrivenMapping": False,
+        "fields": []
+    },
+
+    "callbackPayloadDef": {
+            "attributes": [                    
+                
                 {
                     "apiName":  "data_type",
                     "dataType": "string",
-                    "description": "Data type for the output",
-                    "i18n": {"en_US": {"name": "Response Data Type"}},
-                    "hasPicklist": True,
-                    "enforcePicklistSelect": True
-                    
-                },
-                {
-                    "apiName":  "field",
-                    "dataType": "string",
-                    "description": "Field to store the result",
                     "i18n": {
                         "en_US": {
-                            "name": "Response Field"
+                            "name":        "Output Data Type",
+                            "description": "Output Data Type"
                         }
                     }
-                }
-            ],
-            "userDrivenMapping": False,
-            "fields": []
-        },
-
-        "callbackPayloadDef": {
-                "attributes": [                    
-                    
-                    {
-                        "apiName":  "data_type",
-                        "dataType": "string",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "Output Data Type",
-                                "description": "Output Data Type"
-                            }
-                        }
-                    },
-                    {
-                          "apiName": "field",
-                          "dataType": "string",
-                          "i18n": { "en_US": { "name": "Response Field",
-                                               "description": "Field to store the GPT response" } }
-                        },
-                    
-                    {     "apiName": "answer",        
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "Formula result",                                                                                          
-                                              "description": "Formula result" } }
-                    },
-
-                    {     "apiName": "formula_value",        
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "Formula Value",                                                                                          
-                                              "description": "Formula Value" } }
+                },
+                {
+                      "apiName": "field",
+                      "dataType": "string",
+                      "i18n": { "en_US": { "name": "Response Field",
+                                           "description": "Field to store the GPT response" } }
                     },
-                    {     "apiName": "formula_error",        
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "Formula Error",                                                                                          
-                                              "description": "Formula Error" } }
-                    }
-
-                ],
-                "fields": [],
-                "userDrivenMapping": True
-            }
-        })
+                
+                {     "apiName": "answer",        
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "Formula result",
+                                          "description": "Formula result" } }
+                },
 
-@bp.route("/status")
-def status():
-    return jsonify({"status": "ok"})
+                {     "apiName": "formula_value",        
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "Formula Value",
+                                          "description": "Formula Value" } }
+                },
+                {     "apiName": "formula_error",        
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "Formula Error",
+                                          "description": "Formula Error" } }
+                }
 
-@bp.route("/install")
-def serve_openapi():
-    return send_from_directory(
-        directory=os.path.dirname(__file__),
-        path="swagger.json",
-        mimetype="application/json"
-    )
+            ],
+            "fields": [],
+            "userDrivenMapping": True
+        }
+    }
+
+class CalcFormula(ssfs_functions.Service):
+    base = "calcFormula"
+    realm = "Workflow Pro Calculate Formula"
+    directory = os.path.dirname(__file__)
+    definition = SERVICE_DEFINITION
+    picklists = {
+        "data_type": [
+            {"displayValue": {"en_US": "int"},   "submittedValue": "int"},
+            {"displayValue": {"en_US": "str"},   "submittedValue": "str"},
+            {"displayValue": {"en_US": "bool"},  "submittedValue": "bool"},
+            {"displayValue": {"en_US": "float"}, "submittedValue": "float"},
+        ]
+    }
+
+    def handle_lead(self, obj: dict, data: dict, timestamp: str) -> tuple[dict, dict]:    # noqa: ARG002
+        inp = _lead_inputs(obj)
+        (answer, error), = _evaluate([inp])
+        return _lead_result(inp, answer, error, timestamp)
+
+    def results(self, data: dict, timestamp: str, job=None):
+        # the whole batch goes to the sandbox at once so templates can be grouped;
+        # formulas are cheap to re-run, so a resumed job only skips leads Marketo already has
+        leads = [_lead_inputs(obj) for obj in data.leads(job.delivered if job is not None else 0)]
+        return (_lead_result(inp, answer, error, timestamp)
+                for inp, (answer, error) in zip(leads, _evaluate(leads), strict=True))
+
+    def status(self) -> dict:
+        # compiled formulas live in the sandbox workers, which report their caches with each result
+        return {"status": "ok", "cache": sandbox_functions.cache_stats()}
+
+service = CalcFormula()
+bp = service.bp
@@ -0,0 +1,217 @@
+import itertools
+import multiprocessing
+import os
+import resource
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import tracing_functions
+
+from . import formula_functions
+
+# formulas run in a pool of pre-warmed worker processes so a pathological one can
+# only take down its own sandbox, never the gevent worker serving requests.
+# Every gunicorn worker has its own pool, so keep it small: each sandbox holds a
+# full copy of the formulas library
+FORMULA_WORKERS   = int(os.getenv("FORMULA_WORKERS", min(2, os.cpu_count() or 1)))   # 0 = evaluate inline
+FORMULA_TIMEOUT   = float(os.getenv("FORMULA_TIMEOUT", 10))     # CPU seconds per task
+FORMULA_MEMORY_MB = int(os.getenv("FORMULA_MEMORY_MB", 1024))   # address-space cap per worker
+
+_pool: "_Pool | None" = None
+_pool_lock = threading.Lock()
+_task_ids = itertools.count(1)
+
+# worker side: the shared array the parent reads to tell which task a dead worker was running
+_running = None
+_slot = 0
+
+
+class FormulaTimeout(Exception):
+    pass
+
+
+class FormulaCrash(Exception):
+    pass
+
+
+# ---------- inside the worker process ----------
+def _on_alarm(_signum, _frame):
+    raise FormulaTimeout(f"Formula took longer than {FORMULA_TIMEOUT:g}s")
+
+
+def _init_worker(running, slots):
+    global _running, _slot
+    with slots.get_lock():
+        _slot = slots.value
+        slots.value += 1
+    _running = running
+    _running[2 * _slot] = os.getpid()
+    if FORMULA_MEMORY_MB > 0:
+        limit = FORMULA_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    signal.signal(signal.SIGPROF, _on_alarm)
+    formula_functions.compute_formula("=1+1", "int")      # pay the import/compile warm-up now
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _call(task_id: int, name: str, args: tuple):
+    """→ (result, start ns, end ns, pid, cache stats); the times become the parent's trace span."""
+    # ITIMER_PROF counts CPU time, so a worker waiting on the queue isn't charged.
+    # It can only interrupt Python code; RLIMIT_CPU is the backstop for a task stuck
+    # inside C, killing this worker with SIGXCPU a couple of seconds later
+    _running[2 * _slot + 1] = task_id
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(_cpu_seconds() + FORMULA_TIMEOUT) + 2
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+    signal.setitimer(signal.ITIMER_PROF, FORMULA_TIMEOUT)
+    start = time.time_ns()
+    try:
+        result = getattr(formula_functions, name)(*args)
+        return result, start, time.time_ns(), os.getpid(), formula_functions.cache_stats()
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+        _running[2 * _slot + 1] = 0
+
+
+def _noop():
+    return os.getpid()
+
+
+# ---------- in the web worker ----------
+class _Pool(ProcessPoolExecutor):
+    """The executor, which task each of its workers is running, and their cache stats."""
+
+    def __init__(self, workers: int):
+        # spawn, not fork: children must not inherit gevent's monkey-patched state
+        ctx = multiprocessing.get_context("spawn")
+        self.running = ctx.Array("q", 2 * workers, lock=False)     # (pid, task id) per worker
+        self.stats: dict[int, dict] = {}                            # pid → cache stats after its last task
+        self._crashes: dict[int, Exception] | None = None
+        super().__init__(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                         initargs=(self.running, ctx.Value("i", 0)))
+        self.workers = self._processes               # shutdown() drops the executor's own reference
+
+    def crashes(self) -> dict[int, Exception]:
+        """Once the pool is broken: task id → why the worker running it died.
+
+        Workers the executor terminated after the first death don't count."""
+        if self._crashes is None:
+            running = dict(zip(self.running[::2], self.running[1::2], strict=True))
+            crashes = {}
+            for pid, p in list(self.workers.items()):
+                if p.exitcode not in (None, 0, -signal.SIGTERM):
+                    crashes[running.get(pid, 0)] = _death(p.exitcode)
+            self._crashes = crashes
+        return self._crashes
+
+
+def _death(exitcode: int) -> Exception:
+    if exitcode > 0:
+        return FormulaCrash(f"Formula worker exited with code {exitcode}")
+    sig = signal.Signals(-exitcode)
+    if sig == signal.SIGXCPU:
+        return FormulaTimeout(f"Formula took longer than {FORMULA_TIMEOUT:g}s (stuck outside Python)")
+    if sig == signal.SIGKILL:
+        return FormulaCrash("Formula worker was killed (SIGKILL) – out of memory?")
+    return FormulaCrash(f"Formula worker was killed by {sig.name}")
+
+
+def _get_pool() -> _Pool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _Pool(FORMULA_WORKERS)
+            for _ in range(FORMULA_WORKERS):
+                _pool.submit(_noop)                      # start every process up front
+        return _pool
+
+
+def _drop_pool(pool: _Pool):
+    # a broken executor has already stopped its workers; just stop handing it out
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def warm():
+    """Start the pool in the background so the first batch doesn't pay for it."""
+    if FORMULA_WORKERS > 0 and multiprocessing.parent_process() is None:
+        threading.Thread(target=_get_pool, name="formula-pool-warm", daemon=True).start()
+
+
+def cache_stats() -> dict:
+    """formula_functions.cache_stats() summed over this process's sandbox workers,
+    as of each one's last task; the inline caches when there is no pool."""
+    totals = formula_functions.cache_stats()
+    if FORMULA_WORKERS <= 0:
+        return totals
+    for stats in totals.values():
+        stats.update(size=0, hits=0, misses=0, workers=FORMULA_WORKERS)
+    pool = _pool
+    for worker in list(pool.stats.values()) if pool is not None else []:
+        for name, stats in worker.items():
+            for key in ("size", "hits", "misses"):
+                totals[name][key] += stats[key]
+    return totals
+
+
+def run(tasks: list[tuple[str, tuple]]) -> list:
+    """Run (formula_functions function name, args) tasks across the pool.
+
+    Returns each task's result, or the Exception it raised, in task order. When a
+    worker dies only the task it was running fails; the rest of the batch – and any
+    other request's tasks caught in the same pool – are retried on a fresh pool."""
+    if FORMULA_WORKERS <= 0:
+        results = []
+        for name, args in tasks:
+            try:
+                with tracing_functions.span(f"formula.{name}", formula=args[0]):
+                    results.append(getattr(formula_functions, name)(*args))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    results: list = [None] * len(tasks)
+    pending = list(range(len(tasks)))
+    retried: set[int] = set()
+    while pending:
+        pool = _get_pool()
+        futures = []
+        try:
+            for i in pending:
+                task_id = next(_task_ids)
+                futures.append((i, task_id, pool.submit(_call, task_id, *tasks[i])))
+        except BrokenProcessPool:                       # broke between _get_pool and submit
+            _drop_pool(pool)
+            continue
+        pending = []
+        for i, task_id, fut in futures:
+            try:
+                # no wall-clock limit here: the worker enforces the CPU limit itself,
+                # so a busy machine makes a formula slower, not failed
+                results[i], start, end, pid, stats = fut.result()
+                pool.stats[pid] = stats
+                tracing_functions.record(f"formula.{tasks[i][0]}", start, end, formula=tasks[i][1][0])
+            except BrokenProcessPool as e:
+                crashes = pool.crashes()
+                _drop_pool(pool)
+                if task_id in crashes:
+                    results[i] = crashes[task_id]
+                elif i not in retried:
+                    retried.add(i)                       # caught up in another task's crash
+                    pending.append(i)
+                else:
+                    results[i] = FormulaCrash("; ".join(map(str, crashes.values())) or str(e))
+            except Exception as e:
+                results[i] = e
+    return results
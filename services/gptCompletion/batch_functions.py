@@ -0,0 +1,216 @@
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+
+from openai import NOT_GIVEN, RateLimitError
+
+import jobstore_functions
+import json_functions
+import ratelimit_functions
+
+from . import openai_functions
+
+# one JSON file per submitted OpenAI Batch; whichever worker is alive picks the
+# files up again after a restart. Point OPENAI_BASE_URL at a local mock to test.
+GPT_BATCH_DIR          = os.getenv("GPT_BATCH_DIR", os.path.join(tempfile.gettempdir(), "ssfs-gpt-batches"))
+GPT_BATCH_POLL_SECONDS = float(os.getenv("GPT_BATCH_POLL_SECONDS", 60))
+GPT_BATCH_WINDOW       = os.getenv("GPT_BATCH_WINDOW", "24h")
+
+DONE_STATES = ("completed", "failed", "expired", "cancelled")
+
+_poller: threading.Thread | None = None
+_poller_lock = threading.Lock()
+_on_complete = None
+
+
+def _retried(fn, *args, **kwargs):
+    """fn(*args, **kwargs) with backoff on the errors a completion is retried on –
+    the shared client has the SDK's own retries off."""
+    for attempt in range(openai_functions.OPENAI_MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except openai_functions.RETRYABLE as e:
+            if attempt == openai_functions.OPENAI_MAX_RETRIES or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            retry_after = None
+            if isinstance(e, RateLimitError):
+                with contextlib.suppress(TypeError, ValueError):
+                    retry_after = float(e.response.headers.get("retry-after"))
+            print(f"OpenAI batch call failed (attempt {attempt + 1}), retrying:", e)
+            time.sleep(ratelimit_functions.backoff(attempt, retry_after=retry_after))
+
+
+def _state_path(batch_id: str) -> str:
+    return os.path.join(GPT_BATCH_DIR, f"{batch_id}.json")
+
+
+def _write_state(state: dict):
+    os.makedirs(GPT_BATCH_DIR, exist_ok=True)
+    tmp = os.path.join(GPT_BATCH_DIR, f".{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, _state_path(state["batch_id"]))      # atomic: never a half-written state
+
+
+def _submitted(job_id: str) -> tuple[str, bool] | None:
+    """The OpenAI batch an earlier run of this job-store job created, if any →
+    (batch id, whether it still needs a state file for the poller to finish it)."""
+    if os.path.isdir(GPT_BATCH_DIR):
+        for name in os.listdir(GPT_BATCH_DIR):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(GPT_BATCH_DIR, name), encoding="utf-8") as f:
+                    state = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if state.get("job") == job_id:
+                return state["batch_id"], False
+    # no state file: either the worker died before writing it, or the batch is done
+    # and its callback went out (the poller removes the file) – don't send it twice
+    for batch in _retried(openai_functions.client.batches.list, limit=100).data:
+        if (batch.metadata or {}).get("ssfs_job") == job_id:
+            return batch.id, batch.status not in DONE_STATES
+    return None
+
+
+def submitBatch(data: json_functions.Payload, timestamp: str, leads: list[dict],
+                job: jobstore_functions.Job | None = None) -> str:
+    """Upload the leads as one JSONL Batch job, persist its state, return the batch id.
+
+    A resumed job-store job adopts the batch its earlier run created instead of paying for a second one."""
+    found = _submitted(job.id) if job is not None and job.attempts > 1 else None
+    if found is not None and not found[1]:
+        print(f"OpenAI batch {found[0]} was already submitted for job {job.id}")
+        return found[0]
+    batch_id = found[0] if found is not None else _create(leads, job.id if job is not None else None)
+
+    _write_state({
+        "batch_id":  batch_id,
+        "job":       job.id if job is not None else None,
+        "timestamp": timestamp,
+        "submitted": time.time(),
+        "request":   data.raw.decode("utf-8"),   # callbackUrl/token + original payload for the logs
+        "leads":     leads,
+    })
+    _ensure_poller()
+    return batch_id
+
+
+def _create(leads: list[dict], job_id: str | None) -> str:
+    lines = []
+    for i, inp in enumerate(leads):
+        if inp.get("error"):            # bad inputs – answered with the error when the batch is done
+            continue
+        lines.append(json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": openai_functions.request_body(inp["system"], inp["user"], inp["model"],
+                                                  inp["temperature"], inp["max_tokens"])
+        }, ensure_ascii=False))
+
+    client = openai_functions.client
+    upload = _retried(client.files.create, file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = _retried(client.batches.create, input_file_id=upload.id, endpoint="/v1/chat/completions",
+                     completion_window=GPT_BATCH_WINDOW,
+                     metadata={"ssfs_job": job_id} if job_id else NOT_GIVEN)
+    return batch.id
+
+
+def _read_results(file_id: str | None, answers: list[tuple[str, str]]):
+    if not file_id:
+        return
+    text = _retried(openai_functions.client.files.content, file_id).text
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        i = int(item["custom_id"])
+        if not 0 <= i < len(answers):
+            continue
+        resp = item.get("response") or {}
+        if item.get("error") or resp.get("status_code") != 200:
+            answers[i] = ("", json.dumps(item.get("error") or resp.get("body")))
+        else:
+            answers[i] = (resp["body"]["choices"][0]["message"]["content"].strip(), "")
+
+
+def _collect(state: dict, batch) -> list[tuple[str, str]]:
+    """(answer, error) per lead, in lead order."""
+    n = len(state["leads"])
+    if batch.status != "completed":
+        answers = [("", f"OpenAI batch {batch.id} {batch.status}")] * n
+    else:
+        answers = [("", f"No result in OpenAI batch {batch.id}")] * n
+        _read_results(batch.output_file_id, answers)
+        _read_results(batch.error_file_id, answers)
+    for i, inp in enumerate(state["leads"]):
+        if inp.get("error"):
+            answers[i] = ("", inp["error"])
+    return answers
+
+
+def _check(path: str):
+    # a non-blocking flock makes sure only one worker finishes a given batch
+    fd = os.open(path, os.O_RDWR)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        if not os.path.exists(path):          # finished by another worker meanwhile
+            return
+        with open(path, encoding="utf-8") as f:
+            state = json.load(f)
+
+        batch = _retried(openai_functions.client.batches.retrieve, state["batch_id"])
+        if batch.status not in DONE_STATES:
+            return
+
+        _on_complete(state, _collect(state, batch))
+        os.remove(path)
+    finally:
+        os.close(fd)
+
+
+def pollOnce():
+    if not os.path.isdir(GPT_BATCH_DIR):
+        return
+    for name in sorted(os.listdir(GPT_BATCH_DIR)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            _check(os.path.join(GPT_BATCH_DIR, name))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("OpenAI batch poll error:", name, e, traceback.format_exc())
+
+
+def _poll_forever():
+    while True:
+        pollOnce()
+        time.sleep(GPT_BATCH_POLL_SECONDS)
+
+
+def _ensure_poller():
+    global _poller
+    with _poller_lock:
+        if _poller is None and _on_complete is not None:
+            _poller = threading.Thread(target=_poll_forever, name="gpt-batch-poller", daemon=True)
+            _poller.start()
+
+
+def start_poller(on_complete):
+    """Register the (state, answers) handler; resume polling if batches are pending."""
+    global _on_complete
+    _on_complete = on_complete
+    if os.path.isdir(GPT_BATCH_DIR) and any(n.endswith(".json") for n in os.listdir(GPT_BATCH_DIR)):
+        _ensure_poller()
@@ -1,14 +1,425 @@
-from openai import OpenAI
+import asyncio
+import contextlib
+import itertools
 import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+import httpx
+from openai import (
+    APIConnectionError,
+    APIError,
+    APITimeoutError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 
+import cache_functions
+import jobs_functions
+import json_functions
+import metrics_functions
+import ratelimit_functions
+import tracing_functions
 
-def getCompletion(system_msg: str, user_msg: str, model: str, temperature: float, max_tokens: int) -> str:
+OPENAI_RPM         = float(os.getenv("OPENAI_RPM", 500))       # starting budget per model,
+OPENAI_TPM         = float(os.getenv("OPENAI_TPM", 200_000))   # replaced by x-ratelimit-* headers
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 6))
+OPENAI_TIMEOUT     = float(os.getenv("OPENAI_TIMEOUT", 60))
+OPENAI_ASYNC_CONNECTIONS = int(os.getenv("OPENAI_ASYNC_CONNECTIONS", 1000))   # main_asgi, per process
 
-    resp = client.chat.completions.create( model=model,temperature=temperature,max_tokens=max_tokens,
-        messages=[
-                    {"role": "system", "content": system_msg},
-                    {"role": "user",   "content": user_msg}
-                ])
-    return resp.choices[0].message.content.strip()
+# opt-in completion cache: GPT_CACHE=memory (per worker) or sqlite (shared by the instance)
+GPT_CACHE      = os.getenv("GPT_CACHE", "")
+GPT_CACHE_SIZE = int(os.getenv("GPT_CACHE_SIZE", 10_000))
+GPT_CACHE_TTL  = float(os.getenv("GPT_CACHE_TTL", 24 * 3600))
+GPT_CACHE_PATH = os.getenv("GPT_CACHE_PATH", os.path.join(tempfile.gettempdir(), "ssfs-gpt-cache.sqlite"))
+
+# completions are streamed when a lead has a max length or stop pattern (so generation
+# stops as soon as the field is full) or always with GPT_STREAM=true, for the timings
+GPT_STREAM = os.getenv("GPT_STREAM", "").strip().lower() in ("true", "1", "yes", "y")
+STOP_PATTERN_LOOKBACK = 256        # chars before the new text a stop-pattern match may start at
+
+# per-call timeout so one slow lead can't hold a pool slot for the SDK's 10 min default;
+# SDK retries are off because getCompletion retries through the shared limiter instead
+client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT, max_retries=0)
+_async_clients: list[AsyncOpenAI] = []             # main_asgi only; bound to its event loop
+_next_async_client = None
+
+_limiters: dict[str, ratelimit_functions.TokenBucket] = {}
+
+_cache = cache_functions.make_cache(GPT_CACHE, GPT_CACHE_SIZE, GPT_CACHE_TTL, GPT_CACHE_PATH)
+_inflight: dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+_inflight_async: dict[str, asyncio.Future] = {}
+
+
+def _limiter(model: str) -> ratelimit_functions.TokenBucket:
+    # OpenAI limits are per model, so is the bucket
+    if model not in _limiters:
+        _limiters[model] = ratelimit_functions.TokenBucket(
+            f"openai-{model}", {"requests": OPENAI_RPM, "tokens": OPENAI_TPM})
+    return _limiters[model]
+
+
+def _estimate_tokens(system_msg: str, user_msg: str, max_tokens: int) -> int:
+    # ~4 chars per token for the prompt; OpenAI counts max_tokens against TPM up front
+    return (len(system_msg or "") + len(user_msg or "")) // 4 + max_tokens
+
+
+def _header_float(headers, name: str) -> float | None:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def _reported_limits(headers) -> tuple[dict, dict]:
+    """x-ratelimit-* headers → (limits, remaining) for TokenBucket.update / drain."""
+    limits, remaining = {}, {}
+    for dim in ("requests", "tokens"):
+        limit = _header_float(headers, f"x-ratelimit-limit-{dim}")
+        left = _header_float(headers, f"x-ratelimit-remaining-{dim}")
+        if limit is not None:
+            limits[dim] = limit
+        if left is not None:
+            remaining[dim] = left
+    return limits, remaining
+
+
+def cache_stats() -> dict:
+    return _cache.stats() if _cache else {}
+
+
+def _cache_get(key: str) -> str | None:
+    # a broken or busy cache (e.g. a locked SQLite file) is a miss, not a failed lead
+    try:
+        return _cache.get(key)
+    except Exception as e:
+        print("GPT cache read error:", e)
+        return None
+
+
+def _cache_set(key: str, answer: str):
+    # the answer is already paid for – losing the cache entry is fine, losing the answer isn't
+    try:
+        _cache.set(key, answer)
+    except Exception as e:
+        print("GPT cache write error:", e)
+
+
+def _lookup(outcome: str):
+    metrics_functions.cache_lookup("gpt", outcome)
+    tracing_functions.set_attributes(**{"gpt.cache": outcome})
+
+
+def getCompletion(system_msg: str, user_msg: str, model: str, temperature: float, max_tokens: int,
+                  max_length: int = 0, stop_pattern: str = "") -> tuple[str, dict]:
+    """(answer, timing) – the answer cut to max_length chars / before stop_pattern (0 / "" = off);
+    timing is {} for answers from the cache or an identical call, else see _Generation.result."""
+    call = _Call(system_msg, user_msg, model, temperature, max_tokens, max_length, stop_pattern)
+    if _cache is None:
+        return _complete(call)
+
+    key = call.key()
+    answer = _cache_get(key)
+    if answer is not None:
+        _lookup("hit")
+        return answer, {}
+
+    # identical prompts already in flight (e.g. the same batch) wait for that one call
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        leader = fut is None
+        if leader:
+            fut = _inflight[key] = Future()
+    if not leader:
+        _lookup("shared")
+        return fut.result(), {}
+    _lookup("miss")
+
+    try:
+        answer, timing = _complete(call)
+        _cache_set(key, answer)
+        fut.set_result(answer)
+        return answer, timing
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+
+def truncate(text: str, max_length: int = 0, stop_pattern: str = "") -> tuple[str, str]:
+    """Strip an answer and cut it before the first stop_pattern match, then to max_length
+    chars → (answer, what cut it: "stop-pattern", "max-length" or "")."""
+    reason = ""
+    if stop_pattern:
+        match = re.search(stop_pattern, text)
+        if match:
+            text, reason = text[:match.start()], "stop-pattern"
+    text = text.strip()
+    if max_length and len(text) > max_length:
+        text, reason = text[:max_length].rstrip(), "max-length"
+    return text, reason
+
+
+class _Generation:
+    """One attempt's answer, streamed or not, with its timings."""
+
+    def __init__(self, model: str, max_length: int, stop_pattern: str):
+        self.model = model
+        self.max_length = max_length
+        self.stop_pattern = stop_pattern
+        self._pattern = re.compile(stop_pattern) if stop_pattern else None
+        self.text = ""
+        self.finish_reason = None
+        self.start = time.perf_counter()
+        self.first_token: float | None = None
+
+    def read(self, response: httpx.Response):
+        """Read a streamed answer until it's complete, long enough or hit the stop pattern.
+        Leaving early closes the connection, which stops the generation (and its billing)."""
+        try:
+            for line in response.iter_lines():
+                if self._add(line, response):
+                    break
+        finally:
+            response.close()
+
+    async def read_async(self, response: httpx.Response):
+        try:
+            async for line in response.aiter_lines():
+                if self._add(line, response):
+                    break
+        finally:
+            await response.aclose()
+
+    def _add(self, line: str, response: httpx.Response) -> bool:
+        # the event stream is parsed here rather than by the SDK, whose per-chunk
+        # models cost more CPU than the rest of a lead when thousands stream at once
+        if not line.startswith("data:"):
+            return False
+        data = line[5:].strip()
+        if data == "[DONE]":
+            return True
+        event = json_functions.loads(data)
+        if event.get("error"):
+            error = event["error"]
+            message = error.get("message") if isinstance(error, dict) else None
+            raise APIError(message or "An error occurred during streaming", response.request, body=error)
+        if not event.get("choices"):
+            return False
+        choice = event["choices"][0]
+        self.finish_reason = choice.get("finish_reason") or self.finish_reason
+        content = (choice.get("delta") or {}).get("content")
+        if not content:
+            return False
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        seen = len(self.text)
+        self.text += content
+        if self._pattern is not None and self._pattern.search(self.text, max(0, seen - STOP_PATTERN_LOOKBACK)):
+            return True
+        return bool(self.max_length) and len(self.text.lstrip()) > self.max_length
+
+    def set(self, choice):
+        """The whole (non-streamed) answer."""
+        self.text = choice.message.content or ""
+        self.finish_reason = choice.finish_reason
+
+    def result(self) -> tuple[str, dict]:
+        """(answer, {"ttft_ms", "generation_ms", "truncated"}); ttft_ms is None unless streamed,
+        truncated is "max-length", "stop-pattern", "output-tokens" (hit max_tokens) or ""."""
+        answer, reason = truncate(self.text, self.max_length, self.stop_pattern)
+        if not reason and self.finish_reason == "length":
+            reason = "output-tokens"
+        now = time.perf_counter()
+        timing = {
+            "ttft_ms": round((self.first_token - self.start) * 1000, 1) if self.first_token is not None else None,
+            "generation_ms": round((now - self.start) * 1000, 1),
+            "truncated": reason,
+        }
+        metrics_functions.generation(self.model, timing["ttft_ms"], timing["generation_ms"], reason)
+        tracing_functions.set_attributes(**{"gen_ai.response.ttft_ms": timing["ttft_ms"],
+                                            "gen_ai.response.generation_ms": timing["generation_ms"],
+                                            "gen_ai.response.truncated": reason})
+        return answer, timing
+
+
+# httpx errors only reach us from a stream that broke mid-answer; the SDK wraps the rest
+RETRYABLE = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError, httpx.TransportError)
+
+
+def request_body(system_msg: str, user_msg: str, model: str, temperature: float, max_tokens: int,
+                 stream: bool = False) -> dict:
+    """Chat completion parameters, as sent by the SDK calls and in OpenAI Batch files."""
+    body = {
+        "model": model,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "messages": [
+            {"role": "system", "content": system_msg},
+            {"role": "user",   "content": user_msg}
+        ]
+    }
+    if stream:
+        body["stream"] = True
+    return body
+
+
+def _streamed(max_length: int, stop_pattern: str) -> bool:
+    return GPT_STREAM or bool(max_length) or bool(stop_pattern)
+
+
+class _Call:
+    """One completion: the request, its rate-limit cost and the retry policy.
+
+    _complete and _completeAsync only do the I/O around it."""
+
+    def __init__(self, system_msg: str, user_msg: str, model: str, temperature: float, max_tokens: int,
+                 max_length: int = 0, stop_pattern: str = ""):
+        if stop_pattern:
+            re.compile(stop_pattern)          # a bad pattern fails the lead before it costs anything
+        self.model = model
+        self.max_length = max_length
+        self.stop_pattern = stop_pattern
+        self.stream = _streamed(max_length, stop_pattern)
+        self.limiter = _limiter(model)
+        self.cost = {"requests": 1, "tokens": _estimate_tokens(system_msg, user_msg, max_tokens)}
+        self.request = request_body(system_msg, user_msg, model, temperature, max_tokens, self.stream)
+        self._key = (system_msg, user_msg, model, temperature, max_tokens, max_length, stop_pattern)
+
+    def key(self) -> str:
+        return cache_functions.make_key(*self._key)
+
+    def attempts(self) -> range:
+        return range(OPENAI_MAX_RETRIES + 1)
+
+    @contextlib.contextmanager
+    def attempt(self, attempt: int):
+        """A fresh _Generation, with the attempt's metrics and trace span around it."""
+        with metrics_functions.provider_call("openai"), \
+             tracing_functions.span("openai.chat.completions", attempt=attempt, stream=self.stream):
+            yield _Generation(self.model, self.max_length, self.stop_pattern)
+
+    def retry(self, e: Exception, attempt: int) -> tuple[float, tuple[dict, dict] | None]:
+        """(seconds to wait, limits to drain the bucket with – None to leave it) before
+        retrying after `e`; re-raises it when retrying is pointless."""
+        if isinstance(e, RateLimitError):
+            metrics_functions.rate_limited("openai")
+            # out of credit isn't going to fix itself – fail the lead
+            if e.code == "insufficient_quota" or attempt == OPENAI_MAX_RETRIES:
+                raise e
+            return (ratelimit_functions.backoff(attempt, retry_after=_header_float(e.response.headers, "retry-after")),
+                    _reported_limits(e.response.headers))
+        if attempt == OPENAI_MAX_RETRIES:
+            raise e
+        return ratelimit_functions.backoff(attempt), None
+
+
+def _complete(call: _Call) -> tuple[str, dict]:
+    for attempt in call.attempts():
+        call.limiter.acquire(**call.cost)
+        try:
+            with call.attempt(attempt) as gen:
+                raw = client.chat.completions.with_raw_response.create(**call.request)
+                call.limiter.update(*_reported_limits(raw.headers))
+                if call.stream:
+                    gen.read(raw.http_response)
+                else:
+                    gen.set(raw.parse().choices[0])
+                return gen.result()
+        except RETRYABLE as e:
+            delay, reported = call.retry(e, attempt)
+            if reported is not None:
+                call.limiter.drain(*reported)
+            time.sleep(delay)
+
+
+# ---------- asyncio (main_asgi) ----------
+def _get_async_client() -> AsyncOpenAI:
+    global _next_async_client
+    if not _async_clients:
+        shards = jobs_functions.pool_shards(OPENAI_ASYNC_CONNECTIONS)
+        size = -(-OPENAI_ASYNC_CONNECTIONS // shards)
+        _async_clients.extend(
+            AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), timeout=OPENAI_TIMEOUT, max_retries=0,
+                        http_client=DefaultAsyncHttpxClient(
+                            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size)))
+            for _ in range(shards))
+        _next_async_client = itertools.cycle(_async_clients)
+    return next(_next_async_client)
+
+
+async def close_async():
+    for c in _async_clients:
+        await c.close()
+    _async_clients.clear()
+
+
+async def _cache_async(fn, *args):
+    # the SQLite cache does file I/O – keep it off the event loop
+    if isinstance(_cache, cache_functions.SQLiteCache):
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+async def getCompletionAsync(system_msg: str, user_msg: str, model: str, temperature: float, max_tokens: int,
+                             max_length: int = 0, stop_pattern: str = "") -> tuple[str, dict]:
+    """getCompletion for the event loop: same cache, single-flight, limiter and retries."""
+    call = _Call(system_msg, user_msg, model, temperature, max_tokens, max_length, stop_pattern)
+    if _cache is None:
+        return await _completeAsync(call)
+
+    key = call.key()
+    fut = _inflight_async.get(key)
+    if fut is None:
+        answer = await _cache_async(_cache_get, key)
+        if answer is not None:
+            _lookup("hit")
+            return answer, {}
+        fut = _inflight_async.get(key)          # another task may have started it meanwhile
+    if fut is not None:
+        _lookup("shared")
+        return await asyncio.shield(fut), {}
+    _lookup("miss")
+
+    fut = _inflight_async[key] = asyncio.get_running_loop().create_future()
+    try:
+        answer, timing = await _completeAsync(call)
+        await _cache_async(_cache_set, key, answer)
+        fut.set_result(answer)
+        return answer, timing
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()               # nobody may be waiting – don't log it as unretrieved
+        raise
+    finally:
+        _inflight_async.pop(key, None)
+        if not fut.done():            # leader was cancelled (shutdown) – so are its waiters
+            fut.cancel()
+
+
+async def _completeAsync(call: _Call) -> tuple[str, dict]:
+    for attempt in call.attempts():
+        await call.limiter.acquire_async(**call.cost)
+        try:
+            with call.attempt(attempt) as gen:
+                raw = await _get_async_client().chat.completions.with_raw_response.create(**call.request)
+                await call.limiter.update_async(*_reported_limits(raw.headers))
+                if call.stream:
+                    await gen.read_async(raw.http_response)
+                else:
+                    gen.set(raw.parse().choices[0])
+                return gen.result()
+        except RETRYABLE as e:
+            delay, reported = call.retry(e, attempt)
+            if reported is not None:
+                await call.limiter.drain_async(*reported)
+            await asyncio.sleep(delay)
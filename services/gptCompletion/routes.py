@@ -1,344 +1,393 @@
-# services/hearAbout/routes.py
-from flask import Blueprint, request, jsonify, Response, send_file, send_from_directory
-from datetime import datetime
-import os, requests, pandas as pd, json, traceback, pytz
-import googlesheets_functions
-from . import openai_functions
+# services/gptCompletion/routes.py
+import asyncio
+import os
+import re
+import traceback
 
-base = "gptCompletion"
-bp = Blueprint(base, __name__, url_prefix=f"/{base}")
+from openai import APIError
+
+import json_functions
+import ssfs_functions
+import tracing_functions
+
+from . import batch_functions, openai_functions
 
 # ---------- CONFIG ----------
-SHEET_LEADS   = f"{base}Leads"
-SHEET_BATCHES = f"{base}Batches"
-SPREADSHEET_ID = "xxx" #change this
-pacific        = pytz.timezone("America/Los_Angeles")
-MAX_CELL = 50000          # Sheets’ absolute limit
-SAFE_SLICE = 48000        # leave UTF-8 head-room
-
-# ---------- AUTH ----------
-def _check_auth(username, password):
-    return username == os.getenv("MARKETO_USER") and password == os.getenv("MARKETO_PASSWORD")
-
-def _split_long_text(col_name: str, value: str | None) -> dict[str, str]:
-    """Return {col_name: value} unless it would overflow a Sheets cell.
-       Long UTF-8 strings are sliced into N columns:  request, request_2 …"""
-    if not value:
-        return {col_name: ""}
-    b = value.encode("utf-8")
-    if len(b) <= MAX_CELL:
-        return {col_name: value}
-
-    chunks = [b[i:i+SAFE_SLICE].decode("utf-8", "ignore")
-              for i in range(0, len(b), SAFE_SLICE)]
-    return {f"{col_name}{'' if i == 0 else '_'+str(i+1)}": s
-            for i, s in enumerate(chunks)}
-
-@bp.before_app_request       # runs for every request in the whole app
-def require_basic_auth():
-    if request.path in (
-        f"/{base}/install",
-        f"/{base}/serviceIcon",
-        f"/{base}/brandIcon",
-    ):
-        return
-    if request.path.startswith(f"/{base}/status") or \
-       request.path.startswith(f"/{base}/submitAsyncAction"):
-        auth = request.authorization
-        if not auth or not _check_auth(auth.username, auth.password):
-            return Response(
-                "Authentication required",
-                401,
-                {"WWW-Authenticate": 'Basic realm=Workflow Pro GPT Completion'}
-            )
-
-# ---------- STATIC ICONS ----------
-@bp.route("/serviceIcon")
-def service_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
-
-@bp.route("/brandIcon")
-def brand_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
-
-# ---------- SSFS ENDPOINTS ----------
-@bp.route("/submitAsyncAction", methods=["POST"])
-def submit_async_action():
-    timestamp = datetime.now(pacific).strftime("%Y-%m-%d %H:%M:%S")
-    rows_leads: list[dict] = []        # (optional) logging
-    cb_response = ""
-    data = request.get_json(force=True)
-    
-    try:
-        
-        callback_objects: list[dict] = []
-        for obj in data.get("objectData", []):
-            octx          = obj.get("objectContext", {})
-            lead_id      = octx.get("id")
-
-            # ── flow-step inputs (all are strings except the two numerics) ──
-            ctx          = obj.get("flowStepContext", {})
-            sys_prompt   = ctx.get("system", "")          # mapped in UI
-            usr_prompt   = ctx.get("user",   "")
-            model_name   = ctx.get("model",  "gpt-4o-mini")
-            temp         = float(ctx.get("temperature", 0.5))
-            max_tokens   = int(float(ctx.get("output-tokens", 256)))
-            resp_field   = ctx.get("field")      # **API-name** only!
-            answer = ""
-            error = ""
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", 8))   # 1 = one lead at a time
+# defaults for flow steps without a Max Length / Stop Pattern; either one streams the answer
+GPT_MAX_LENGTH   = int(os.getenv("GPT_MAX_LENGTH", 0))    # chars, e.g. 255 for a Marketo string field; 0 = off
+GPT_STOP_PATTERN = os.getenv("GPT_STOP_PATTERN", "")      # regex; the answer ends before its first match
 
-            try:
-                answer = openai_functions.getCompletion(sys_prompt, usr_prompt, model_name, temp, max_tokens)
-
-                single_cb = {
-                    "leadData": { "id": lead_id , resp_field: answer},
-                    "activityData": {
-                        "system": sys_prompt,
-                        "user-prompt":    usr_prompt,
-                        "model": model_name,
-                        "temperature": temp,
-                        "output-tokens": max_tokens,
-                        "field": resp_field,
-                        "gpt-response": answer,
-                        "success":   True
-                    }
-                }
+def _truthy(value) -> bool:
+    return str(value).strip().lower() in ("true", "1", "yes", "y")
 
-            except Exception as e:
-                # still send a callback entry so the step doesn’t stall
-                error = f"{e}\n{traceback.format_exc()}",
-                single_cb = {
-                    "leadData": { "id": lead_id },
-                    "activityData": {
-                        "gpt-error": error,
-                        "success":   False
-                    }
-                }
+def _lead_inputs(obj: dict) -> dict:
+    """Flow-step inputs for one lead, as Marketo sent them; _parse_numerics converts the numerics."""
+    ctx = obj.get("flowStepContext", {})
+    return {
+        "lead_id":    obj.get("objectContext", {}).get("id"),
+        "system":     ctx.get("system", ""),          # mapped in UI
+        "user":       ctx.get("user",   ""),
+        "model":      ctx.get("model",  "gpt-4o-mini"),
+        "temperature": ctx.get("temperature", 0.5),
+        "max_tokens": ctx.get("output-tokens", 256),
+        "field":      ctx.get("field"),               # **API-name** only!
+        "max_length": ctx.get("max-length") or GPT_MAX_LENGTH,
+        "stop_pattern": ctx.get("stop-pattern") or GPT_STOP_PATTERN,
+    }
 
-            callback_objects.append(single_cb)
-            
-            # ---- (optional) log one row per lead -----------
-            rows_leads.append({
-                "timestamp":    timestamp,
-                "lead_id":      f"https://app-ab20.marketo.com/leadDatabase/loadLeadDetail?leadId={lead_id}",
-                "system":       sys_prompt,
-                "user_prompt":          usr_prompt,
-                "model":        model_name,
-                "temperature":  temp,
-                "max_tokens":   max_tokens,
-                "response_field": resp_field,
-                "gpt_response": answer,
-                "error": error,
-                "callback_objects": str(single_cb)
-            })
-
-        # ─────────── ONE callback back to Marketo ────────────
-        r = requests.post(
-            data["callbackUrl"],
-            headers={
-                "x-api-key":        data["apiCallBackKey"],
-                "x-callback-token": data["token"],
-                "Content-Type":     "application/json"
-            },
-            json={ "munchkinId": "123", "objectData": callback_objects },
-            timeout=10
-        )
+def _parse_numerics(inp: dict) -> dict:
+    """Convert the numeric inputs in place; a ValueError naming the bad one fails only this lead."""
+    for key, name, kind in (("temperature", "temperature", float), ("max_tokens", "output-tokens", int),
+                            ("max_length", "max-length", int)):
+        try:
+            inp[key] = kind(float(inp[key]))
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f"{name} must be a number, not {inp[key]!r}") from None
+    return inp
+
+def _batch_inputs(obj: dict) -> dict:
+    """_lead_inputs for an OpenAI Batch; a lead with bad numerics carries its "error" and isn't sent."""
+    inp = _lead_inputs(obj)
+    try:
+        _parse_numerics(inp)
+    except ValueError as e:
+        inp["error"] = str(e)
+    return inp
+
+async def _aiter(items):
+    for item in items:
+        yield item
 
-        cb_response = r.text
+def _completion_span(data: dict, inp: dict):
+    return tracing_functions.span("openai.getCompletion", **{"marketo.token": data["token"],
+                                                             "gen_ai.request.model": inp["model"],
+                                                             "gen_ai.request.max_tokens": inp["max_tokens"]})
 
-        # -------- 3️⃣  one batch-summary row (no width-matching) -------------
-        batch_row = {
-            "timestamp":   timestamp,
-            "error":       "" if r.ok else f"Callback HTTP {r.status_code}",
-            "cb_response": cb_response
+def _lead_result(inp: dict, answer: str, error: str, timestamp: str, timing: dict | None = None) -> tuple[dict, dict]:
+    """(callback object, Sheets log row) for one lead; timing as returned by getCompletion."""
+    timing = timing or {}
+    lead_id = inp["lead_id"]
+    if not error:
+        single_cb = {
+            "leadData": { "id": lead_id , inp["field"]: answer},
+            "activityData": {
+                "system": inp["system"],
+                "user-prompt":    inp["user"],
+                "model": inp["model"],
+                "temperature": inp["temperature"],
+                "output-tokens": inp["max_tokens"],
+                "field": inp["field"],
+                "gpt-response": answer,
+                "success":   True
+            }
+        }
+    else:
+        # still send a callback entry so the step doesn’t stall
+        single_cb = {
+            "leadData": { "id": lead_id },
+            "activityData": {
+                "gpt-error": error,
+                "success":   False
+            }
         }
 
-        # request JSON can be huge → fan it out so every cell stays <50 kB
-        batch_row.update(_split_long_text("request", json.dumps(data)))
+    # ---- (optional) log one row per lead -----------
+    row = {
+        "timestamp":    timestamp,
+        "lead_id":      ssfs_functions.lead_url(lead_id),
+        "system":       inp["system"],
+        "user_prompt":          inp["user"],
+        "model":        inp["model"],
+        "temperature":  inp["temperature"],
+        "max_tokens":   inp["max_tokens"],
+        "response_field": inp["field"],
+        "gpt_response": answer,
+        "error": error,
+        "callback_objects": str(single_cb),
+        # appended after the original columns: rows2values writes by position, not by header
+        "ttft_ms":      timing.get("ttft_ms"),
+        "generation_ms": timing.get("generation_ms"),
+        "truncated":    timing.get("truncated"),
+    }
 
-        # ------------ (optional) write logs -----------------
-        try:
-            df_leads   = pd.DataFrame(rows_leads)
-            df_batches = pd.DataFrame([batch_row])
-            googlesheets_functions.writeDF2Sheet(df_leads,   SHEET_LEADS,   SPREADSHEET_ID)
-            googlesheets_functions.writeDF2Sheet(df_batches, SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets logging error:", gs_err)
-
-        return ("", 202) if r.ok else (jsonify({"error": r.text}), 500)
-
-    except Exception as e:
-        fail_row = {
-            "timestamp": timestamp,
-            "error": f"{e}\n{traceback.format_exc()}",
-            "cb_response": cb_response
+    return single_cb, row
+
+# ---------- SERVICE DEFINITION ----------
+SERVICE_DEFINITION = {
+    "apiName": "gpt-completion",
+    "i18n": {
+        "en_US": {
+            "name": "GPT Completion",
+            "description": "Makes a request to the OpenAI completion endpoint",
+            "triggerName": "GPT Completion is Made",
+            "filterName":  "GPT Completion was Made"
         }
+    },
+    "primaryAttribute": "user",
 
-        fail_row |= _split_long_text("request", json.dumps(data, ensure_ascii=False))
-        
-        try:
-            googlesheets_functions.writeDF2Sheet(pd.DataFrame([fail_row]), SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets error while logging fatal failure:", gs_err)
-    
-        return jsonify({"error": "server error"}), 500
-
-@bp.route("/getServiceDefinition")
-def get_service_definition():
-    return jsonify({
-        "apiName": "gpt-completion",
-        "i18n": {
-            "en_US": {
-                "name": "GPT Completion",
-                "description": "Makes a request to the OpenAI completion endpoint",
-                "triggerName": "GPT Completion is Made",
-                "filterName":  "GPT Completion was Made"
+    "invocationPayloadDef": {
+        "flowAttributes": [
+            {
+                "apiName":  "user",
+                "dataType": "text",
+                "description": "Open‑text field containing the user message",
+                "i18n": {
+                    "en_US": {
+                        "name": "User"
+                    }
+                }
+            },
+            {
+                "apiName":  "system",
+                "dataType": "text",
+                "description": "Open‑text field containing the system message",
+                "i18n": {
+                    "en_US": {
+                        "name": "System"
+                    }
+                }
+            },
+            {
+                "apiName":  "model",
+                "dataType": "string",
+                "description": "OpenAI model",
+                "i18n": {
+                    "en_US": {
+                        "name": "Model"
+                    }
+                }
+            },
+            {
+                "apiName":  "field",
+                "dataType": "string",
+                "description": "Field to store the GPT response",
+                "i18n": {
+                    "en_US": {
+                        "name": "Response Field"
+                    }
+                }
+            },
+            {
+                "apiName":  "output-tokens",
+                "dataType": "integer",
+                "description": "Number of output tokens to restrict the response",
+                "i18n": {
+                    "en_US": {
+                        "name": "Output Tokens"
+                    }
+                }
+            },
+            {
+                "apiName":  "temperature",
+                "dataType": "float",
+                "description": "Temperature of the completion",
+                "i18n": {
+                    "en_US": {
+                        "name": "Temperature"
+                    }
+                }
+            },
+            {
+                "apiName":  "batch-mode",
+                "dataType": "boolean",
+                "description": "Send the whole batch as one OpenAI Batch job (cheaper, answers can take up to 24h)",
+                "i18n": {
+                    "en_US": {
+                        "name": "Batch Mode"
+                    }
+                }
+            },
+            {
+                "apiName":  "max-length",
+                "dataType": "integer",
+                "description": ("Stop generating once the response is longer than this many characters "
+                                "(the field's length)"),
+                "i18n": {
+                    "en_US": {
+                        "name": "Max Length"
+                    }
+                }
+            },
+            {
+                "apiName":  "stop-pattern",
+                "dataType": "string",
+                "description": "Regular expression; the response ends before its first match",
+                "i18n": {
+                    "en_US": {
+                        "name": "Stop Pattern"
+                    }
+                }
             }
-        },
-        "primaryAttribute": "user",
+        ],
+        "userDrivenMapping": False, #causes the outgoing mapping to appear when installing in the UI
+        "fields": []
+    },
 
-        "invocationPayloadDef": {
-            "flowAttributes": [
+    "callbackPayloadDef": {
+            "attributes": [                    
                 {
-                    "apiName":  "user",
+                    "apiName":  "user-prompt",
                     "dataType": "text",
-                    "description": "Open‑text field containing the user message",
                     "i18n": {
                         "en_US": {
-                            "name": "User"
+                            "name":        "User message",
+                            "description": "User message"
                         }
                     }
                 },
                 {
                     "apiName":  "system",
                     "dataType": "text",
-                    "description": "Open‑text field containing the system message",
                     "i18n": {
                         "en_US": {
-                            "name": "System"
+                            "name":        "System message",
+                            "description": "System message"
                         }
                     }
                 },
                 {
                     "apiName":  "model",
                     "dataType": "string",
-                    "description": "OpenAI model",
                     "i18n": {
                         "en_US": {
-                            "name": "Model"
+                            "name":        "Model",
+                            "description": "Model"
                         }
                     }
                 },
                 {
-                    "apiName":  "field",
-                    "dataType": "string",
-                    "description": "Field to store the GPT response",
-                    "i18n": {
-                        "en_US": {
-                            "name": "Response Field"
-                        }
-                    }
-                },
+                      "apiName": "field",
+                      "dataType": "string",
+                      "i18n": { "en_US": { "name": "Response Field",
+                                           "description": "Field to store the GPT response" } }
+                    },
                 {
-                    "apiName":  "output-tokens",
-                    "dataType": "integer",
-                    "description": "Number of output tokens to restrict the response",
-                    "i18n": {
-                        "en_US": {
-                            "name": "Output Tokens"
-                        }
-                    }
+                      "apiName": "temperature",
+                      "dataType": "float",
+                      "i18n": { "en_US": { "name": "Temperature",
+                                           "description": "Temperature" } }
                 },
-                {
-                    "apiName":  "temperature",
-                    "dataType": "float",
-                    "description": "Temperature of the completion",
-                    "i18n": {
-                        "en_US": {
-                            "name": "Temperature"
-                        }
-                    }
+                {     "apiName": "output-tokens",        
+                      "dataType": "integer",
+                      "i18n": { "en_US": { "name": "Output Tokens",
+                                          "description": "Output token constraint" } }
                 }
+                ,
+                {     "apiName": "gpt-response",        
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "GPT Response",
+                                          "description": "GPT Response" } }
+                },
+                {     "apiName": "gpt-error",        
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "GPT Error",
+                                          "description": "GPT Error" } }
+                },
+
             ],
-            "userDrivenMapping": False, #causes the outgoing mapping to appear when installing in the UI
-            "fields": []
-        },
-
-        "callbackPayloadDef": {
-                "attributes": [                    
-                    {
-                        "apiName":  "user-prompt",
-                        "dataType": "text",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "User message",
-                                "description": "User message"
-                            }
-                        }
-                    },
-                    {
-                        "apiName":  "system",
-                        "dataType": "text",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "System message",
-                                "description": "System message"
-                            }
-                        }
-                    },
-                    {
-                        "apiName":  "model",
-                        "dataType": "string",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "Model",
-                                "description": "Model"
-                            }
-                        }
-                    },
-                    {
-                          "apiName": "field",
-                          "dataType": "string",
-                          "i18n": { "en_US": { "name": "Response Field",
-                                               "description": "Field to store the GPT response" } }
-                        },
-                    {
-                          "apiName": "temperature",
-                          "dataType": "float",
-                          "i18n": { "en_US": { "name": "Temperature",
-                                               "description": "Temperature" } }
-                    },
-                    {     "apiName": "output-tokens",        
-                          "dataType": "integer",
-                          "i18n": { "en_US": { "name": "Output Tokens",                                                                                          
-                                              "description": "Output token constraint" } }
-                    }
-                    ,
-                    {     "apiName": "gpt-response",        
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "GPT Response",                                                                                          
-                                              "description": "GPT Response" } }
-                    },
-                    {     "apiName": "gpt-error",        
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "GPT Error",                                                                                          
-                                              "description": "GPT Error" } }
-                    },
+            "fields": [],
+            "userDrivenMapping": True
+        }
+    }
 
-                ],
-                "fields": [],
-                "userDrivenMapping": True
-            }
-        })
-
-@bp.route("/status")
-def status():
-    return jsonify({"status": "ok"})
-
-@bp.route("/install")
-def serve_openapi():
-    return send_from_directory(
-        directory=os.path.dirname(__file__),
-        path="swagger.json",
-        mimetype="application/json"
-    )
+class GPTCompletion(ssfs_functions.Service):
+    base = "gptCompletion"
+    realm = "Workflow Pro GPT Completion"
+    directory = os.path.dirname(__file__)
+    definition = SERVICE_DEFINITION
+    concurrency = GPT_CONCURRENCY
+
+    def handle_lead(self, obj: dict, data: dict, timestamp: str) -> tuple[dict, dict]:
+        inp = _lead_inputs(obj)
+        answer = ""
+        error = ""
+        timing = None
+
+        try:
+            _parse_numerics(inp)
+            with _completion_span(data, inp):
+                answer, timing = openai_functions.getCompletion(inp["system"], inp["user"], inp["model"],
+                                                                inp["temperature"], inp["max_tokens"],
+                                                                inp["max_length"], inp["stop_pattern"])
+        except Exception as e:
+            error = f"{e}\n{traceback.format_exc()}"
+
+        return _lead_result(inp, answer, error, timestamp, timing)
+
+    async def handle_lead_async(self, obj: dict, data: dict, timestamp: str) -> tuple[dict, dict]:
+        inp = _lead_inputs(obj)
+        answer = ""
+        error = ""
+        timing = None
+
+        try:
+            _parse_numerics(inp)
+            with _completion_span(data, inp):
+                answer, timing = await openai_functions.getCompletionAsync(inp["system"], inp["user"], inp["model"],
+                                                                           inp["temperature"], inp["max_tokens"],
+                                                                           inp["max_length"], inp["stop_pattern"])
+        except Exception as e:
+            error = f"{e}\n{traceback.format_exc()}"
+
+        return _lead_result(inp, answer, error, timestamp, timing)
+
+    def _batch_mode(self, data) -> bool:
+        # flow step set to batch mode → one OpenAI Batch job, callback sent by the poller
+        first = next(data.leads(), None)
+        return first is not None and _truthy(first.get("flowStepContext", {}).get("batch-mode"))
+
+    def _submit_batch(self, data: dict, timestamp: str, job=None):
+        leads = [_batch_inputs(obj) for obj in data.leads()]
+        if all(inp.get("error") for inp in leads):
+            # nothing to send to OpenAI – every lead fails right away
+            return [_lead_result(inp, "", inp["error"], timestamp) for inp in leads]
+        try:
+            batch_functions.submitBatch(data, timestamp, leads, job)
+        except APIError as e:
+            # OpenAI didn't take the batch, even after retries – every lead gets the error
+            error = f"OpenAI batch submission failed: {e}"
+            return [_lead_result(inp, "", inp.get("error") or error, timestamp) for inp in leads]
+        return None
+
+    def results(self, data: dict, timestamp: str, job=None):
+        if self._batch_mode(data):
+            return self._submit_batch(data, timestamp, job)
+
+        return super().results(data, timestamp, job)
+
+    async def results_async(self, data: dict, timestamp: str, job=None):
+        if self._batch_mode(data):
+            # uploads a file and creates the job through the sync SDK – keep it off the event loop
+            results = await asyncio.to_thread(self._submit_batch, data, timestamp, job)
+            return None if results is None else _aiter(results)
+
+        return await super().results_async(data, timestamp, job)
+
+    def finish_openai_batch(self, state: dict, answers: list[tuple[str, str]]):
+        """Poller hook: map a finished OpenAI Batch back into the usual callback + logs."""
+        raw = state["request"].encode("utf-8")       # the request text as Marketo sent it
+        timestamp = state["timestamp"]
+
+        def result(inp: dict, answer: str, error: str) -> tuple[dict, dict]:
+            if error:
+                return _lead_result(inp, "", error, timestamp)
+            # a Batch job can't be stopped early, so its answers are cut here
+            try:
+                answer, truncated = openai_functions.truncate(answer, inp["max_length"], inp["stop_pattern"])
+            except re.error as e:
+                answer, truncated, error = "", "", f"Invalid stop pattern: {e}"
+            return _lead_result(inp, answer, error, timestamp, {"truncated": truncated})
+
+        leads = zip(state["leads"], answers, strict=True)
+        self.send_results(json_functions.parse_payload(raw), timestamp,
+                          (result(inp, answer, error) for inp, (answer, error) in leads))
+
+    def status(self) -> dict:
+        cache = openai_functions.cache_stats()
+        return {"status": "ok", "cache": cache} if cache else {"status": "ok"}
+
+service = GPTCompletion()
+bp = service.bp
+
+batch_functions.start_poller(service.finish_openai_batch)
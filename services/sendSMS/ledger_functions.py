@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# ledger of sent messages so a Marketo retry of the same invocation never texts a
+# lead twice; one SQLite file in WAL mode is shared by all workers on the instance
+SMS_LEDGER_PATH = os.getenv("SMS_LEDGER_PATH", os.path.join(tempfile.gettempdir(), "ssfs-sms-ledger.sqlite"))
+SMS_LEDGER_TTL  = float(os.getenv("SMS_LEDGER_TTL", 7 * 24 * 3600))
+COMPACT_EVERY   = 1000             # claims between TTL compactions
+# a claim with no response is renewed right before each Telnyx attempt; one older than
+# this (a worker died mid-send) may be taken over: the call's timeout twice plus a backoff
+SMS_CLAIM_LEASE = float(os.getenv("SMS_CLAIM_LEASE", 2 * float(os.getenv("SMS_TIMEOUT", 30)) + 30))
+
+_local = threading.local()
+_claims = 0
+_held: dict[str, float] = {}       # key → claimed_at of the claims this process holds
+
+
+class InProgress(Exception):
+    """Another live delivery of this request is sending the lead right now; retry later."""
+
+    def __init__(self):
+        super().__init__("Already being sent by another delivery of this request – retry later")
+
+
+def _db() -> sqlite3.Connection:
+    # one connection per thread; the primary key index makes each claim a single b-tree probe
+    db = getattr(_local, "db", None)
+    if db is None:
+        db = _local.db = sqlite3.connect(SMS_LEDGER_PATH, timeout=10, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS sent (
+                          key TEXT PRIMARY KEY, response TEXT, created REAL NOT NULL, claimed_at REAL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS sent_created ON sent(created)")
+    return db
+
+
+def make_key(token: str, lead_id, to_phone: str, from_phone: str, message: str) -> str:
+    message_hash = hashlib.sha256(f"{from_phone}\x1f{to_phone}\x1f{message}".encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{token}\x1f{lead_id}\x1f{message_hash}".encode("utf-8")).hexdigest()
+
+
+def claim(key: str):
+    """Atomically reserve `key`. Returns None if this caller should send, else the
+    earlier response to replay; raises InProgress while a live claim is sending it."""
+    global _claims
+    db = _db()
+    now = time.time()
+    cur = db.execute("INSERT OR IGNORE INTO sent (key, response, created, claimed_at) VALUES (?, NULL, ?, ?)",
+                     (key, now, now))
+    _claims += 1
+    if _claims % COMPACT_EVERY == 0:
+        compact()
+    if cur.rowcount == 1:
+        _held[key] = now
+        return None
+    # a claim whose owner died mid-send is ours once its lease is up
+    cur = db.execute("""UPDATE sent SET claimed_at = ? WHERE key = ? AND response IS NULL
+                          AND (claimed_at IS NULL OR claimed_at < ?)""", (now, key, now - SMS_CLAIM_LEASE))
+    if cur.rowcount == 1:
+        _held[key] = now
+        return None
+    row = db.execute("SELECT response FROM sent WHERE key = ?", (key,)).fetchone()
+    if row is None:                 # compacted between the statements – ours now
+        return claim(key)
+    if row[0] is None:
+        raise InProgress()
+    return json.loads(row[0])
+
+
+def renew(key: str):
+    """Restart the lease right before a send; raises InProgress if it was taken over meanwhile."""
+    now = time.time()
+    cur = _db().execute("UPDATE sent SET claimed_at = ? WHERE key = ? AND response IS NULL AND claimed_at = ?",
+                        (now, key, _held.get(key)))
+    if cur.rowcount != 1:
+        _held.pop(key, None)
+        raise InProgress()
+    _held[key] = now
+
+
+def record(key: str, response):
+    _held.pop(key, None)
+    _db().execute("UPDATE sent SET response = ? WHERE key = ?", (json.dumps(response, default=str), key))
+
+
+def release(key: str):
+    """Forget a claim whose send failed, so a retry can try again."""
+    _db().execute("DELETE FROM sent WHERE key = ? AND response IS NULL AND claimed_at = ?", (key, _held.pop(key, None)))
+
+
+def compact():
+    _db().execute("DELETE FROM sent WHERE created < ?", (time.time() - SMS_LEDGER_TTL,))
@@ -1,290 +1,242 @@
-# services/hearAbout/routes.py
-from flask import Blueprint, request, jsonify, Response, send_file, send_from_directory
-from datetime import datetime
-import os, requests, pandas as pd, json, traceback, pytz
-import googlesheets_functions
-from . import telnyx_functions
+# services/sendSMS/routes.py
+import asyncio
+import os
+import traceback
 
-base = "sendSMS"
-bp = Blueprint(base, __name__, url_prefix=f"/{base}")
+import ssfs_functions
+import tracing_functions
 
-# ---------- CONFIG ----------
-SHEET_LEADS   = f"{base}Leads"
-SHEET_BATCHES = f"{base}Batches"
-SPREADSHEET_ID = "xxx" #change this
-pacific        = pytz.timezone("America/Los_Angeles")
-MAX_CELL  = 50_000
-SAFE_SLICE = 48_000          # leave UTF-8 head-room
-
-# ---------- AUTH ----------
-def _check_auth(username, password):
-    return username == os.getenv("MARKETO_USER") and password == os.getenv("MARKETO_PASSWORD")
-
-def _split_long_text(col_name: str, value: str) -> dict[str, str]:
-    if not value:
-        return {col_name: ""}
-    b = value.encode("utf-8")
-    if len(b) <= MAX_CELL:
-        return {col_name: value}
-
-    pieces = [b[i:i+SAFE_SLICE].decode("utf-8", "ignore")
-              for i in range(0, len(b), SAFE_SLICE)]
-    return {f"{col_name}{'' if i==0 else '_'+str(i+1)}": txt
-            for i, txt in enumerate(pieces)}
-
-@bp.before_app_request       # runs for every request in the whole app
-def require_basic_auth():
-    if request.path in (
-        f"/{base}/install",
-        f"/{base}/serviceIcon",
-        f"/{base}/brandIcon",
-    ):
-        return
-    if request.path.startswith(f"/{base}/status") or \
-       request.path.startswith(f"/{base}/submitAsyncAction"):
-        auth = request.authorization
-        if not auth or not _check_auth(auth.username, auth.password):
-            return Response(
-                "Authentication required",
-                401,
-                {"WWW-Authenticate": 'Basic realm=Workflow Pro Send SMS'}
-            )
-
-# ---------- STATIC ICONS ----------
-@bp.route("/serviceIcon")
-def service_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
-
-@bp.route("/brandIcon")
-def brand_icon():
-    return send_file("wfp_logo_pink.png", mimetype="image/png")
+from . import ledger_functions, telnyx_functions
 
-# ---------- SSFS ENDPOINT ----------
-@bp.route("/submitAsyncAction", methods=["POST"])
-def submit_async_action():
-    ts  = datetime.now(pacific).strftime("%Y-%m-%d %H:%M:%S")
-    rows_leads:   list[dict] = []
-    callback_objects: list[dict] = []
-    cb_response = ""
-    data = request.get_json(force=True)
-
-    try:
-
-        for obj in data.get("objectData", []):
-            ctx_lead   = obj.get("objectContext", {})
-            ctx_step   = obj.get("flowStepContext", {})
-            from_phone   = ctx_step.get("from_phone", "")
-            to_phone   = ctx_step.get("to_phone", "")
-            message    = ctx_step.get("message", "")
-            lead_id    = ctx_lead.get("id")
-
-            row = {
-                "timestamp": ts,
-                "lead_id": (f"https://app-ab20.marketo.com/leadDatabase/"
-                            f"loadLeadDetail?leadId={lead_id}"),
-                "from_phone":from_phone,
-                "to_phone":to_phone,
-                "message":message,
-                "sms_response": "",
-                "error": ""
+# ---------- CONFIG ----------
+SMS_CONCURRENCY = int(os.getenv("SMS_CONCURRENCY", 16))   # 1 = one lead at a time
+
+def _lead_inputs(obj: dict, data: dict, timestamp: str) -> dict:
+    """Flow-step inputs for one lead, its ledger key and its (still empty) Sheets log row."""
+    ctx_lead   = obj.get("objectContext", {})
+    ctx_step   = obj.get("flowStepContext", {})
+    from_phone   = ctx_step.get("from_phone", "")
+    to_phone   = ctx_step.get("to_phone", "")
+    message    = ctx_step.get("message", "")
+    lead_id    = ctx_lead.get("id")
+
+    row = {
+        "timestamp": timestamp,
+        "lead_id": ssfs_functions.lead_url(lead_id),
+        "from_phone":from_phone,
+        "to_phone":to_phone,
+        "message":message,
+        "sms_response": "",
+        "error": "",
+        "replayed": False
+    }
+
+    return {
+        "lead_id": lead_id, "from_phone": from_phone, "to_phone": to_phone, "message": message, "row": row,
+        "key": ledger_functions.make_key(data["token"], lead_id, to_phone, from_phone, message),
+    }
+
+def _replay(inp: dict):
+    """The earlier response if this lead was already sent, else None – and the lead is ours to send.
+
+    Raises ledger_functions.InProgress (→ a failed lead) while another delivery is sending it."""
+    previous = ledger_functions.claim(inp["key"])
+    if previous is not None:
+        inp["row"]["replayed"] = True
+        tracing_functions.set_attributes(**{"sms.replayed": True})
+    return previous
+
+def _send_span(data: dict, inp: dict):
+    number_type = telnyx_functions.number_type(inp["from_phone"])
+    return tracing_functions.span("telnyx.sendSMS", **{"marketo.token": data["token"], "sms.number_type": number_type})
+
+def _lead_result(inp: dict, response, error: Exception | None = None) -> tuple[dict, dict]:
+    """(callback object, Sheets log row) for one lead; call from the except block on error."""
+    row = inp["row"]
+    if error is None:
+        single_cb = {
+            "leadData": {
+                "id":         inp["lead_id"]
+            },
+            "activityData": {
+                "from_phone": inp["from_phone"],
+                "to_phone_value":  inp["to_phone"],
+                "message":  inp["message"],
+                "sms_response": response,
+                "success":           True
             }
-
-            try:
-                response = telnyx_functions.sendSMS(to_phone,from_phone, message)
-
-                callback_objects.append({
-                    "leadData": {
-                        "id":         lead_id
-                    },
-                    "activityData": {
-                        "from_phone": from_phone,
-                        "to_phone_value":  to_phone,
-                        "message":  message,
-                        "sms_response": response,
-                        "success":           True
-                    }
-                })
-
-                row["sms_response"] = response
-
-            except Exception as per_lead_err:
-                # still return an entry so the batch keeps going
-                callback_objects.append({
-                    "leadData": { "id": lead_id },
-                    "activityData": {
-                        "from_phone": from_phone,
-                        "to_phone_value":  to_phone,
-                        "message":  message,
-                        "sms_error": str(per_lead_err),
-                        "success": False,
+        }
+        row["sms_response"] = response
+    else:
+        # still return an entry so the batch keeps going
+        single_cb = {
+            "leadData": { "id": inp["lead_id"] },
+            "activityData": {
+                "from_phone": inp["from_phone"],
+                "to_phone_value":  inp["to_phone"],
+                "message":  inp["message"],
+                "sms_error": str(error),
+                "success": False,
+            }
+        }
+        row["error"] = f"{error}\n{traceback.format_exc()}"
+
+    return single_cb, row
+
+# ---------- SERVICE DEFINITION ----------
+SERVICE_DEFINITION = {
+    "apiName": "send-sms",
+    "i18n": {
+        "en_US": {
+            "name": "Send SMS",
+            "description": "Uses the Telnyx SMS API to send an SMS message",
+            "triggerName": "SMS is Sent",
+            "filterName":  "SMS was Sent"
+        }
+    },
+    "primaryAttribute": "to_phone",
+
+    "invocationPayloadDef": {
+        "flowAttributes": [
+            {
+                "apiName":  "to_phone",
+                "dataType": "string",
+                "description": "The phone number that should receive the text",
+                "i18n": {
+                    "en_US": {
+                        "name": "To Phone"
                     }
-                })
-                row["error"] = f"{per_lead_err}\n{traceback.format_exc()}"
-
-            rows_leads.append(row)
-
-        # ---------- single callback ----------
-        r = requests.post(
-            data["callbackUrl"],
-            headers={
-                "x-api-key":        data["apiCallBackKey"],
-                "x-callback-token": data["token"],
-                "Content-Type":     "application/json",
+                }
             },
-            json={
-                "munchkinId": "123",
-                "objectData": callback_objects
+            {
+                "apiName":  "from_phone",
+                "dataType": "string",
+                "description": "The phone number that should send the text",
+                "i18n": {
+                    "en_US": {
+                        "name": "From Phone"
+                    }
+                }
             },
-            timeout=10,
-        )
-
-        cb_response =r.text
-
-        # ---------- batch summary ----------
-        batch_row = {
-            "timestamp": ts,
-            "error": "" if r.ok else f"Callback HTTP {r.status_code}",
-            "cb_response": cb_response
-        }
-        # split the potentially huge *request* JSON
-        batch_row |= _split_long_text("request", json.dumps(data, ensure_ascii=False))
-
-        # ---------- write to Sheets once ----------
-        try:
-            if rows_leads:
-                googlesheets_functions.writeDF2Sheet(pd.DataFrame(rows_leads), SHEET_LEADS, SPREADSHEET_ID)
-
-            googlesheets_functions.writeDF2Sheet(pd.DataFrame([batch_row]), SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets logging error:", gs_err)
-
-        return ("", 202) if r.ok else (jsonify({"error": r.text}), 500)
-
-    except Exception as e:
-        fail_row = {
-            "timestamp": ts,
-            "error": f"{e}\n{traceback.format_exc()}",
-            "cb_response": cb_response,
-        }
-
-        fail_row |= _split_long_text("request", json.dumps(data, ensure_ascii=False))
-
-        try:
-            googlesheets_functions.writeDF2Sheet(pd.DataFrame([fail_row]), SHEET_BATCHES, SPREADSHEET_ID)
-        except Exception as gs_err:
-            print("Sheets error while logging fatal failure:", gs_err)
-
-        return jsonify({"error": "server error"}), 500
-
-@bp.route("/getServiceDefinition")
-def get_service_definition():
-    return jsonify({
-        "apiName": "send-sms",
-        "i18n": {
-            "en_US": {
-                "name": "Send SMS",
-                "description": "Uses the Telnyx SMS API to send an SMS message",
-                "triggerName": "SMS is Sent",
-                "filterName":  "SMS was Sent"
+            {
+                "apiName":  "message",
+                "dataType": "text",
+                "description": "The message to be sent",
+                "i18n": {
+                    "en_US": {
+                        "name": "Message"
+                    }
+                }
             }
-        },
-        "primaryAttribute": "to_phone",
+        ],
+        "userDrivenMapping": False,
+        "fields": []
+    },
 
-        "invocationPayloadDef": {
-            "flowAttributes": [
+    "callbackPayloadDef": {
+            "attributes": [                    
                 {
-                    "apiName":  "to_phone",
+                    "apiName":  "to_phone_value",
                     "dataType": "string",
-                    "description": "The phone number that should receive the text",
                     "i18n": {
                         "en_US": {
-                            "name": "To Phone"
+                            "name":        "To Phone Value",
+                            "description": "The phone number value that should receive the text"
                         }
                     }
                 },
                 {
                     "apiName":  "from_phone",
                     "dataType": "string",
-                    "description": "The phone number that should send the text",
                     "i18n": {
                         "en_US": {
-                            "name": "From Phone"
+                            "name":        "From Phone",
+                            "description": "The phone number that should send the text"
                         }
                     }
                 },
                 {
                     "apiName":  "message",
                     "dataType": "text",
-                    "description": "The message to be sent",
                     "i18n": {
                         "en_US": {
-                            "name": "Message"
+                            "name":        "Message",
+                            "description": "The message to be sent"
                         }
                     }
+                },
+                {
+                      "apiName": "sms_response",
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "SMS Response",
+                                           "description": "Response from Telnyx SMS API" } }
+                },
+                {
+                      "apiName": "sms_error",
+                      "dataType": "text",
+                      "i18n": { "en_US": { "name": "SMS Error",
+                                           "description": "Error from Replit script" } }
                 }
             ],
-            "userDrivenMapping": False,
-            "fields": []
-        },
+            "fields": [ ],
+            "userDrivenMapping": False
+        }
+    }
 
-        "callbackPayloadDef": {
-                "attributes": [                    
-                    {
-                        "apiName":  "to_phone_value",
-                        "dataType": "string",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "To Phone Value",
-                                "description": "The phone number value that should receive the text"
-                            }
-                        }
-                    },
-                    {
-                        "apiName":  "from_phone",
-                        "dataType": "string",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "From Phone",
-                                "description": "The phone number that should send the text"
-                            }
-                        }
-                    },
-                    {
-                        "apiName":  "message",
-                        "dataType": "text",
-                        "i18n": {
-                            "en_US": {
-                                "name":        "Message",
-                                "description": "The message to be sent"
-                            }
-                        }
-                    },
-                    {
-                          "apiName": "sms_response",
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "SMS Response",
-                                               "description": "Response from Telnyx SMS API" } }
-                    },
-                    {
-                          "apiName": "sms_error",
-                          "dataType": "text",
-                          "i18n": { "en_US": { "name": "SMS Error",
-                                               "description": "Error from Replit script" } }
-                    }
-                ],
-                "fields": [ ],
-                "userDrivenMapping": False
-            }
-        })
+class SendSMS(ssfs_functions.Service):
+    base = "sendSMS"
+    realm = "Workflow Pro Send SMS"
+    directory = os.path.dirname(__file__)
+    definition = SERVICE_DEFINITION
+    concurrency = SMS_CONCURRENCY
 
-@bp.route("/status")
-def status():
-    return jsonify({"status": "ok"})
+    def handle_lead(self, obj: dict, data: dict, timestamp: str) -> tuple[dict, dict]:
+        """Send one lead's SMS → (callback object, Sheets log row).
 
-@bp.route("/install")
-def serve_openapi():
-    return send_from_directory(
-        directory=os.path.dirname(__file__),
-        path="swagger.json",
-        mimetype="application/json"
-    )
+        A lead already sent for this Marketo token is skipped and its earlier
+        Telnyx response replayed."""
+        inp = _lead_inputs(obj, data, timestamp)
+
+        try:
+            response = _replay(inp)
+            if response is None:
+                try:
+                    with _send_span(data, inp):
+                        response = telnyx_functions.sendSMS(inp["to_phone"], inp["from_phone"], inp["message"],
+                                                            lambda: ledger_functions.renew(inp["key"]))
+                except Exception:
+                    ledger_functions.release(inp["key"])
+                    raise
+                ledger_functions.record(inp["key"], response)
+            return _lead_result(inp, response)
+
+        except Exception as per_lead_err:
+            return _lead_result(inp, None, per_lead_err)
+
+    async def handle_lead_async(self, obj: dict, data: dict, timestamp: str) -> tuple[dict, dict]:
+        inp = _lead_inputs(obj, data, timestamp)
+
+        # the ledger is SQLite shared with the other workers – its calls wait on worker threads
+        try:
+            response = await asyncio.to_thread(_replay, inp)
+            if response is None:
+                try:
+                    with _send_span(data, inp):
+                        response = await telnyx_functions.sendSMSAsync(inp["to_phone"], inp["from_phone"],
+                                                                       inp["message"],
+                                                                       lambda: ledger_functions.renew(inp["key"]))
+                except asyncio.CancelledError:
+                    # shutting down: release it so a redelivery can send it, without awaiting again
+                    ledger_functions.release(inp["key"])
+                    raise
+                except Exception:
+                    await asyncio.to_thread(ledger_functions.release, inp["key"])
+                    raise
+                await asyncio.to_thread(ledger_functions.record, inp["key"], response)
+            return _lead_result(inp, response)
+
+        except Exception as per_lead_err:
+            return _lead_result(inp, None, per_lead_err)
+
+service = SendSMS()
+bp = service.bp
@@ -1,10 +1,116 @@
-from pandas.core import resample
-import telnyx, os
+import asyncio
+import itertools
+import os
+import re
+import time
+
+import httpx
+import telnyx
+
+import jobs_functions
+import metrics_functions
+import ratelimit_functions
 
 telnyx.api_key = os.environ['TELNYX_API_KEY']
+if os.getenv("TELNYX_API_BASE"):                 # e.g. a local fake Telnyx for load tests
+  telnyx.api_base = os.environ["TELNYX_API_BASE"]
+
+# carrier throughput per sending number, in messages per second
+SMS_MPS = {
+  "long_code":  float(os.getenv("SMS_MPS_LONG_CODE", 1)),
+  "toll_free":  float(os.getenv("SMS_MPS_TOLL_FREE", 20)),
+  "short_code": float(os.getenv("SMS_MPS_SHORT_CODE", 100)),
+}
+SMS_MAX_RETRIES = int(os.getenv("SMS_MAX_RETRIES", 3))
+SMS_TIMEOUT = float(os.getenv("SMS_TIMEOUT", 30))
+SMS_ASYNC_CONNECTIONS = int(os.getenv("SMS_ASYNC_CONNECTIONS", 200))   # main_asgi's pool to Telnyx
+
+# the ledger's claim lease assumes no send outlasts SMS_TIMEOUT (the library's default is 80 s)
+telnyx.default_http_client = telnyx.http_client.RequestsClient(timeout=SMS_TIMEOUT)
+
+TOLL_FREE = re.compile(r"^\+?1?(800|833|844|855|866|877|888)\d{7}$")
+
+_limiters: dict[str, ratelimit_functions.TokenBucket] = {}
+_async_http: list[httpx.AsyncClient] = []
+_next_async_http = None
+
+def number_type(from_phone: str) -> str:
+  digits = re.sub(r"[^\d+]", "", from_phone or "")
+  if re.fullmatch(r"\d{5,6}", digits):
+    return "short_code"
+  if TOLL_FREE.match(digits):
+    return "toll_free"
+  return "long_code"
+
+def _limiter(from_phone: str) -> ratelimit_functions.TokenBucket:
+  # one bucket per sending number, shared by every gunicorn worker
+  if from_phone not in _limiters:
+    _limiters[from_phone] = ratelimit_functions.TokenBucket(
+      f"sms-{from_phone}", {"messages": SMS_MPS[number_type(from_phone)]}, period=1.0)
+  return _limiters[from_phone]
+
+def sendSMS(to_phone: str, from_phone: str, message: str, before_send=None):
+  """Send one SMS; before_send() runs right before each attempt (after the rate limiter)."""
+
+  limiter = _limiter(from_phone)
+  for attempt in range(SMS_MAX_RETRIES + 1):
+    limiter.acquire(messages=1)
+    if before_send is not None:
+      before_send()
+    try:
+      with metrics_functions.provider_call("telnyx"):
+        return telnyx.Message.create(from_= from_phone,to= to_phone, text= message)
+    except telnyx.error.TelnyxError as e:
+      if getattr(e, "http_status", None) != 429 or attempt == SMS_MAX_RETRIES:
+        raise
+      metrics_functions.rate_limited("telnyx")
+      limiter.drain()
+      time.sleep(ratelimit_functions.backoff(attempt))
+
+# ---------- asyncio (main_asgi) ----------
+def _get_async_http() -> httpx.AsyncClient:
+  global _next_async_http
+  if not _async_http:
+    shards = jobs_functions.pool_shards(SMS_ASYNC_CONNECTIONS)
+    size = -(-SMS_ASYNC_CONNECTIONS // shards)
+    _async_http.extend(
+      httpx.AsyncClient(base_url=telnyx.api_base, timeout=SMS_TIMEOUT,
+                        headers={"Authorization": f"Bearer {telnyx.api_key}"},
+                        limits=httpx.Limits(max_connections=size, max_keepalive_connections=size))
+      for _ in range(shards))
+    _next_async_http = itertools.cycle(_async_http)
+  return next(_next_async_http)
+
+async def close_async():
+  for c in _async_http:
+    await c.aclose()
+  _async_http.clear()
+
+def _api_error(r: httpx.Response) -> telnyx.error.APIError:
+  try:
+    body = r.json()
+  except ValueError:
+    body = None
+  errors = body.get("errors") if isinstance(body, dict) else None
+  return telnyx.error.APIError(errors or r.text, http_status=r.status_code, http_body=r.text,
+                               json_body=body, http_headers=dict(r.headers))
 
-def sendSMS(to_phone: str, from_phone: str, message: str):
-  
-  response = telnyx.Message.create(from_= from_phone,to= to_phone, text= message)
+async def sendSMSAsync(to_phone: str, from_phone: str, message: str, before_send=None) -> dict:
+  """sendSMS for the event loop, straight against the v2 REST API; returns the message `data`.
+  before_send is synchronous and runs on a worker thread."""
+  limiter = _limiter(from_phone)
+  for attempt in range(SMS_MAX_RETRIES + 1):
+    await limiter.acquire_async(messages=1)
+    if before_send is not None:
+      await asyncio.to_thread(before_send)
+    with metrics_functions.provider_call("telnyx"):
+      r = await _get_async_http().post("/v2/messages", json={"from": from_phone, "to": to_phone, "text": message})
+    if r.status_code == 429 and attempt < SMS_MAX_RETRIES:
+      metrics_functions.rate_limited("telnyx")
+      await limiter.drain_async()
+      await asyncio.sleep(ratelimit_functions.backoff(attempt))
+      continue
+    if r.is_error:
+      raise _api_error(r)
+    return r.json()["data"]
 
-  return response
\ No newline at end of file
@@ -0,0 +1,535 @@
+"""Shared plumbing for Marketo Self-Service Flow Step (SSFS) services.
+
+A service subclasses `Service`, sets its `base`, `realm` and service
+definition, and implements `handle_lead`. Everything else – auth, icons,
+/install, queuing, concurrency, chunked callbacks and Sheets logging – is
+done here once for every service, and every accepted batch is kept in the
+job store until its callback is out. Implementing `handle_lead_async` as well
+lets main_asgi run the service's batches on its event loop."""
+import asyncio
+import base64
+import binascii
+import contextlib
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import AsyncIterator, Iterable
+
+import pytz
+from flask import Blueprint, Flask, Response, g, jsonify, request, send_file
+
+import googlesheets_functions
+import jobs_functions
+import jobstore_functions
+import json_functions
+import marketo_functions
+import metrics_functions
+import tracing_functions
+
+# ---------- CONFIG ----------
+SPREADSHEET_ID = "xxx" #change this
+pacific        = pytz.timezone("America/Los_Angeles")
+MAX_CELL = 50000          # Sheets’ absolute limit
+SAFE_SLICE = 48000        # leave UTF-8 head-room
+ICON_FILE = "wfp_logo_pink.png"
+
+GZIP_MIN_BYTES = 1024    # smaller static responses aren't worth compressing
+
+# endpoints Marketo calls with basic auth; the rest are open
+PROTECTED = ("status", "submitAsyncAction")
+METRICS_REALM = "Workflow Pro Metrics"
+
+# leads in flight per service and process under main_asgi (provider calls are awaited, not threaded)
+ASYNC_CONCURRENCY = int(os.getenv("SSFS_ASYNC_CONCURRENCY", 1000))
+
+_services: dict[str, "Service"] = {}
+
+
+def _check_auth(username, password):
+    return username == os.getenv("MARKETO_USER") and password == os.getenv("MARKETO_PASSWORD")
+
+
+def check_basic_auth(header: str | None) -> bool:
+    """_check_auth for a raw Authorization header, where Flask's request.authorization isn't available."""
+    scheme, _, credentials = (header or "").partition(" ")
+    if scheme.lower() != "basic":
+        return False
+    try:
+        username, _, password = base64.b64decode(credentials, validate=True).decode("utf-8").partition(":")
+    except (binascii.Error, UnicodeDecodeError):
+        return False
+    return _check_auth(username, password)
+
+
+def pacific_now() -> str:
+    return datetime.now(pacific).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def split_long_text(col_name: str, value: str | bytes | None) -> dict[str, str]:
+    """Return {col_name: value} unless it would overflow a Sheets cell.
+       Long UTF-8 strings are sliced into N columns:  request, request_2 …
+       Bytes are taken as UTF-8 and sliced without encoding them again."""
+    if not value:
+        return {col_name: ""}
+    b = value if isinstance(value, bytes) else value.encode("utf-8")
+    if len(b) <= MAX_CELL:
+        return {col_name: b.decode("utf-8", "replace") if isinstance(value, bytes) else value}
+
+    chunks = [b[i:i+SAFE_SLICE].decode("utf-8", "ignore")
+              for i in range(0, len(b), SAFE_SLICE)]
+    return {f"{col_name}{'' if i == 0 else '_'+str(i+1)}": s
+            for i, s in enumerate(chunks)}
+
+
+def validate(data) -> str:
+    """Return an error message if the Marketo payload can't be processed."""
+    if not isinstance(data, dict):
+        return "Request body must be a JSON object"
+    missing = [k for k in ("callbackUrl", "apiCallBackKey", "token") if not data.get(k)]
+    if missing:
+        return f"Missing {', '.join(missing)}"
+    if not isinstance(data.get("objectData", []), list):
+        return "objectData must be a list"
+    return ""
+
+
+def lead_url(lead_id) -> str:
+    return f"https://app-ab20.marketo.com/leadDatabase/loadLeadDetail?leadId={lead_id}"
+
+
+class StaticResponse:
+    """A response body encoded once – plain and gzipped – with a strong ETag."""
+
+    def __init__(self, body: bytes, mimetype: str = "application/json"):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        # mtime=0 keeps the gzip bytes identical across workers and restarts
+        packed = gzip.compress(body, compresslevel=9, mtime=0)
+        self.gzipped = packed if len(body) >= GZIP_MIN_BYTES and len(packed) < len(body) else None
+
+    @classmethod
+    def from_json(cls, value) -> "StaticResponse":
+        return cls(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    def send(self) -> Response:
+        # a strong ETag names exact bytes, so the gzipped body gets its own
+        use_gzip = self.gzipped is not None and bool(request.accept_encodings["gzip"])
+        etag = f"{self.etag}-gz" if use_gzip else self.etag
+
+        if request.method in ("GET", "HEAD") and request.if_none_match.contains(etag):
+            resp = Response(status=304)
+        elif use_gzip:
+            resp = Response(self.gzipped, mimetype=self.mimetype, headers={"Content-Encoding": "gzip"})
+        else:
+            resp = Response(self.body, mimetype=self.mimetype)
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "no-cache"          # always revalidate; a 304 is cheap
+        if self.gzipped is not None:
+            resp.vary.add("Accept-Encoding")
+        return resp
+
+
+def _schema_type_ok(value, schema: dict, components: dict) -> bool:
+    if "$ref" in schema:
+        schema = components["schemas"][schema["$ref"].rsplit("/", 1)[-1]]
+    expected = {"object": dict, "string": str, "array": list, "boolean": bool}.get(schema.get("type"))
+    return expected is None or isinstance(value, expected)
+
+
+def check_definition(definition: dict, swagger: dict):
+    """Raise ValueError if a service definition doesn't match swagger.json's serviceDefinition.
+
+    Only the top level is enforced: the nested schemas there describe the
+    callback Marketo receives, not the callbackPayloadDef we advertise."""
+    components = swagger.get("components", {})
+    schema = components.get("schemas", {}).get("serviceDefinition")
+    if schema is None:
+        raise ValueError("swagger.json has no serviceDefinition schema")
+
+    problems = [f"missing '{k}'" for k in schema.get("required", []) if k not in definition]
+    problems += [f"'{k}' is not {sub.get('type') or sub.get('$ref')}"
+                 for k, sub in schema.get("properties", {}).items()
+                 if k in definition and not _schema_type_ok(definition[k], sub, components)]
+
+    attributes = {a.get("apiName") for a in definition.get("invocationPayloadDef", {}).get("flowAttributes", [])}
+    if definition.get("primaryAttribute") not in attributes:
+        problems.append(f"primaryAttribute '{definition.get('primaryAttribute')}' is not a flow attribute")
+
+    if problems:
+        raise ValueError(f"{definition.get('apiName')}: " + "; ".join(problems))
+
+
+def get_service(base: str) -> "Service | None":
+    return _services.get(base)
+
+
+def require_basic_auth():
+    # one hook for the whole app: /<base>/<endpoint> → that service's realm
+    parts = request.path.strip("/").split("/", 2)
+    if parts == ["metrics"]:
+        base, realm = "metrics", METRICS_REALM
+    elif len(parts) < 2 or parts[1] not in PROTECTED or parts[0] not in _services:
+        return
+    else:
+        base, realm = parts[0], _services[parts[0]].realm
+
+    with metrics_functions.stage(base, "auth"), tracing_functions.span("ssfs.auth"):
+        auth = request.authorization
+        ok = auth and _check_auth(auth.username, auth.password)
+    if not ok:
+        return Response(
+            "Authentication required",
+            401,
+            {"WWW-Authenticate": f"Basic realm={realm}"}
+        )
+
+
+def metrics():
+    rendered = metrics_functions.render()
+    if rendered is None:
+        return Response("prometheus_client is not installed\n", 501, mimetype="text/plain")
+    body, content_type = rendered
+    return Response(body, content_type=content_type)
+
+
+def _begin_trace():
+    rule = request.url_rule.rule if request.url_rule else request.path
+    g.trace = tracing_functions.begin(f"{request.method} {rule}", **{"http.method": request.method,
+                                                                      "http.target": request.path})
+
+
+def _trace_status(response):
+    tracing_functions.set_attributes(**{"http.status_code": response.status_code})
+    return response
+
+
+def _end_trace(error):
+    tracing_functions.end(g.pop("trace", None), error)
+
+
+def init_app(app: Flask, services: list["Service"]):
+    for service in services:
+        app.register_blueprint(service.bp)
+    app.add_url_rule("/metrics", "metrics", metrics)
+    # the request span is opened first so auth is traced inside it
+    app.before_request(_begin_trace)
+    app.before_request(require_basic_auth)
+    app.after_request(_trace_status)
+    app.teardown_request(_end_trace)
+    threading.Thread(target=resume_jobs, name="resume-jobs", daemon=True).start()
+
+
+def resume_jobs():
+    """Queue the batches a dead process left unfinished; runs once per worker at startup."""
+    for job in jobstore_functions.orphans(list(_services)):
+        service = _services[job.service]
+        data = json_functions.parse_payload(job.request)
+        if job.attempts > jobstore_functions.JOBSTORE_MAX_ATTEMPTS:
+            # it keeps taking its worker down with it
+            service.log_failure(data, job.timestamp,
+                                RuntimeError(f"Batch given up after {job.attempts - 1} interrupted runs"))
+            job.finish()
+            continue
+
+        print(f"Resuming {job.service} batch {job.id}: {job.delivered} lead(s) already delivered, "
+              f"{len(job.done)} more finished")
+        while not jobs_functions.stopping():
+            try:
+                jobs_functions.submit(service.process_batch, data, job.timestamp, job)
+                break
+            except jobs_functions.QueueFull:
+                time.sleep(1)
+
+
+class Service:
+    base: str = ""                 # URL prefix and Sheets tab prefix
+    realm: str = ""                # basic-auth realm shown by Marketo
+    directory: str = ""            # folder holding this service's swagger.json
+    definition: dict = {}          # getServiceDefinition payload
+    picklists: dict[str, list] = {}
+    concurrency: int = 1           # leads in flight per batch pool; 1 = serial
+    async_concurrency: int = ASYNC_CONCURRENCY
+
+    def __init__(self):
+        self.sheet_leads = f"{self.base}Leads"
+        self.sheet_batches = f"{self.base}Batches"
+        # shared by every batch in this worker, so `concurrency` is a per-process cap
+        self._pool = ThreadPoolExecutor(max_workers=max(self.concurrency, 1),
+                                        thread_name_prefix=self.base) if self.concurrency > 1 else None
+        self._async_slots = asyncio.Semaphore(max(self.async_concurrency, 1))   # binds to the loop on first use
+        self._static()
+        self.bp = self._blueprint()
+        _services[self.base] = self
+
+    def _static(self):
+        # everything below is fixed for the life of the process → encode it once
+        with open(os.path.join(self.directory, "swagger.json"), "rb") as f:
+            swagger_bytes = f.read()
+        check_definition(self.definition, json.loads(swagger_bytes))
+
+        attributes = {a["apiName"] for a in self.definition["invocationPayloadDef"].get("flowAttributes", [])}
+        unknown = set(self.picklists) - attributes
+        if unknown:
+            raise ValueError(f"{self.base}: picklists for unknown flow attributes {sorted(unknown)}")
+
+        self._definition_response = StaticResponse.from_json(self.definition)
+        self._install_response = StaticResponse(swagger_bytes)
+        self._picklist_responses = {name: StaticResponse.from_json({"choices": choices})
+                                    for name, choices in self.picklists.items()}
+
+    # ---------- per-service hooks ----------
+    def handle_lead(self, obj: dict, data: json_functions.Payload, timestamp: str) -> tuple[dict, dict]:
+        """One lead → (callback object, Sheets log row). Must not raise for per-lead errors."""
+        raise NotImplementedError
+
+    def results(self, data: json_functions.Payload, timestamp: str,
+                job: jobstore_functions.Job | None = None) -> Iterable[tuple[dict, dict]] | None:
+        """(callback object, log row) per lead in lead order; None if the callback is sent later.
+
+        With a resumed `job`, delivered leads are skipped and stored results reused."""
+        first = job.delivered if job is not None else 0
+        leads = enumerate(data.leads(first), first)
+
+        def fn(item):
+            index, obj = item
+            if job is not None and index in job.done:
+                return job.done[index]
+            lead_id = obj.get("objectContext", {}).get("id")
+            with metrics_functions.stage(self.base, "lead"), \
+                 tracing_functions.span(f"{self.base}.lead", **{"marketo.token": data.get("token"),
+                                                              "marketo.lead_id": lead_id}):
+                result = self.handle_lead(obj, data, timestamp)
+            if job is not None:
+                job.record(index, result)
+            return result
+
+        fn = tracing_functions.wrap(fn)       # pool threads don't inherit the batch span
+
+        if self._pool is None:
+            return map(fn, leads)
+        return jobs_functions.imap_ordered(self._pool, fn, leads, window=self.concurrency * 4)
+
+    def status(self) -> dict:
+        return {"status": "ok"}
+
+    async def handle_lead_async(self, obj: dict, data: json_functions.Payload, timestamp: str) -> tuple[dict, dict]:
+        """handle_lead for the event loop (main_asgi). Optional; must not raise for per-lead errors."""
+        raise NotImplementedError
+
+    async def results_async(self, data: json_functions.Payload, timestamp: str,
+                            job: jobstore_functions.Job | None = None) -> AsyncIterator[tuple[dict, dict]] | None:
+        """results() for the event loop: every lead is a task, `async_concurrency` at a time per process."""
+        async def fn(obj):
+            lead_id = obj.get("objectContext", {}).get("id")
+            async with self._async_slots:
+                with metrics_functions.stage(self.base, "lead"), \
+                     tracing_functions.span(f"{self.base}.lead", **{"marketo.token": data.get("token"),
+                                                                  "marketo.lead_id": lead_id}):
+                    return await self.handle_lead_async(obj, data, timestamp)
+
+        async def recorded(item):
+            index, obj = item
+            result = await fn(obj)
+            if job is not None:
+                job.record(index, result)
+            return result
+
+        # main_asgi only runs fresh batches; resumed ones go through results()
+        return jobs_functions.amap_ordered(recorded, enumerate(data.leads()), window=self.async_concurrency)
+
+    @property
+    def supports_async(self) -> bool:
+        return type(self).handle_lead_async is not Service.handle_lead_async
+
+    # ---------- pipeline ----------
+    @contextlib.contextmanager
+    def _batch(self, data: json_functions.Payload, job: jobstore_functions.Job | None):
+        """Metrics, trace span and job bookkeeping around one batch, for both pipelines."""
+        with metrics_functions.stage(self.base, "batch"), \
+             tracing_functions.span(f"{self.base}.batch", **{"marketo.token": data.get("token"),
+                                                            "ssfs.leads": data.lead_count}):
+            yield
+            # reached only if this process lived to the end – else the job gets resumed
+            if job is not None:
+                job.finish()
+
+    def process_batch(self, data: json_functions.Payload, timestamp: str, job: jobstore_functions.Job | None = None):
+        with self._batch(data, job):
+            try:
+                results = self.results(data, timestamp, job)
+            except Exception as e:
+                self.log_failure(data, timestamp, e)
+                return
+            if results is not None:
+                self.send_results(data, timestamp, results, job)
+
+    async def process_batch_async(self, data: json_functions.Payload, timestamp: str,
+                                  job: jobstore_functions.Job | None = None):
+        with self._batch(data, job):
+            try:
+                results = await self.results_async(data, timestamp, job)
+            except Exception as e:
+                self.log_failure(data, timestamp, e)
+                return
+            if results is not None:
+                await self.send_results_async(data, timestamp, results, job)
+
+    def _lead_done(self, row: dict, rows_leads: list[dict]):
+        metrics_functions.lead_done(self.base, bool(row.get("error")))
+        rows_leads.append(row)
+
+    def _chunk_sent(self, rows_leads: list[dict]):
+        # chunk is with Marketo – its rows go to the log sink so nothing piles up
+        googlesheets_functions.logRows2Sheet(rows_leads, self.sheet_leads, SPREADSHEET_ID)
+        rows_leads.clear()
+
+    def send_results(self, data: json_functions.Payload, timestamp: str, results: Iterable[tuple[dict, dict]],
+                     job: jobstore_functions.Job | None = None):
+        """Stream (callback object, log row) pairs to Marketo chunk by chunk, then log the batch."""
+        stream = marketo_functions.CallbackStream(data)
+        rows_leads: list[dict] = []
+
+        try:
+            for single_cb, row in results:
+                self._lead_done(row, rows_leads)
+                if stream.add(single_cb):
+                    self._chunk_sent(rows_leads)
+                    if job is not None:
+                        job.deliver(stream.sent)
+            stream.close()
+            self.log_batch(data, timestamp, stream, rows_leads)
+
+        except Exception as e:
+            stream.close()          # whatever finished still reaches Marketo
+            self.log_failure(data, timestamp, e, stream.text)
+
+    async def send_results_async(self, data: json_functions.Payload, timestamp: str,
+                                 results: AsyncIterator[tuple[dict, dict]], job: jobstore_functions.Job | None = None):
+        stream = marketo_functions.AsyncCallbackStream(data)
+        rows_leads: list[dict] = []
+
+        try:
+            async for single_cb, row in results:
+                self._lead_done(row, rows_leads)
+                if await stream.add(single_cb):
+                    self._chunk_sent(rows_leads)
+                    if job is not None:
+                        await asyncio.to_thread(job.deliver, stream.sent)     # a synchronous commit
+            await stream.close()
+            self.log_batch(data, timestamp, stream, rows_leads)
+
+        except Exception as e:
+            await stream.close()
+            self.log_failure(data, timestamp, e, stream.text)
+
+    def log_batch(self, data: json_functions.Payload, timestamp: str,
+                  stream: marketo_functions.CallbackStream, rows_leads: list[dict]):
+        # -------- one batch-summary row (no width-matching) -------------
+        batch_row = {
+            "timestamp":   timestamp,
+            "error":       "; ".join(stream.errors),
+            "cb_response": stream.text
+        }
+
+        # request JSON can be huge → fan it out so every cell stays <50 kB
+        batch_row |= split_long_text("request", data.raw)
+
+        # ------------ (optional) write logs -----------------
+        try:
+            googlesheets_functions.logRows2Sheet(rows_leads,  self.sheet_leads,   SPREADSHEET_ID)
+            googlesheets_functions.logRows2Sheet([batch_row], self.sheet_batches, SPREADSHEET_ID)
+        except Exception as gs_err:
+            print("Sheets logging error:", gs_err)
+
+    def log_failure(self, data: json_functions.Payload, timestamp: str, e: Exception, cb_response: str = ""):
+        fail_row = {
+            "timestamp": timestamp,
+            "error": f"{e}\n{traceback.format_exc()}",
+            "cb_response": cb_response
+        }
+
+        fail_row |= split_long_text("request", data.raw)
+
+        try:
+            googlesheets_functions.logRows2Sheet([fail_row], self.sheet_batches, SPREADSHEET_ID)
+        except Exception as gs_err:
+            print("Sheets error while logging fatal failure:", gs_err)
+
+    # ---------- endpoints ----------
+    def parse_submission(self, raw: bytes) -> tuple[json_functions.Payload | None, str]:
+        """submitAsyncAction body → (payload, "") or (None, the 400 error message)."""
+        # only the top-level fields are parsed here; leads are parsed one by one
+        # as the job worker gets to them, and the raw bytes are what gets logged
+        with metrics_functions.stage(self.base, "parse"), tracing_functions.span("ssfs.parse"):
+            try:
+                data = json_functions.parse_payload(raw)
+            except ValueError as e:
+                return None, f"Request body must be a JSON object: {e}"
+
+        error = validate(data)
+        if error:
+            return None, error
+        tracing_functions.set_attributes(**{"marketo.token": data["token"], "ssfs.leads": data.lead_count})
+        return data, ""
+
+    def submit_async_action(self):
+        timestamp = pacific_now()
+        data, error = self.parse_submission(request.get_data(cache=False))
+        if error:
+            return jsonify({"error": error}), 400
+
+        # ack right away – the batch + Marketo callback run on a job worker,
+        # traced as a child of this request; the job store has it before Marketo gets the 202
+        run = tracing_functions.wrap(self.process_batch)
+        try:
+            with metrics_functions.stage(self.base, "enqueue"), tracing_functions.span("ssfs.enqueue"):
+                job = jobstore_functions.add(self.base, data.raw, timestamp)
+                try:
+                    jobs_functions.submit(run, data, timestamp, job)
+                except jobs_functions.QueueFull:
+                    if job is not None:
+                        job.finish()
+                    raise
+        except jobs_functions.QueueFull as e:
+            return jsonify({"error": str(e)}), 503
+
+        return "", 202
+
+    def get_picklist(self):
+        try:
+            payload = request.get_json(force=True) or {}
+            field_name = (payload.get("name") or "").strip()
+
+            if not field_name:
+                return jsonify({"error": "Missing 'name' in request body"}), 400
+            if field_name not in self._picklist_responses:
+                return jsonify({"error": f"Unknown field name '{field_name}'"}), 400
+
+            return self._picklist_responses[field_name].send()
+
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
+    def _blueprint(self) -> Blueprint:
+        bp = Blueprint(self.base, __name__, url_prefix=f"/{self.base}")
+
+        bp.add_url_rule("/serviceIcon", "service_icon",
+                        lambda: send_file(ICON_FILE, mimetype="image/png"))
+        bp.add_url_rule("/brandIcon", "brand_icon",
+                        lambda: send_file(ICON_FILE, mimetype="image/png"))
+        bp.add_url_rule("/submitAsyncAction", "submit_async_action",
+                        self.submit_async_action, methods=["POST"])
+        bp.add_url_rule("/getServiceDefinition", "get_service_definition",
+                        self._definition_response.send)
+        bp.add_url_rule("/status", "status", lambda: jsonify(self.status()))
+        bp.add_url_rule("/install", "serve_openapi", self._install_response.send)
+        if self.picklists:
+            bp.add_url_rule("/getPicklist", "get_picklist", self.get_picklist, methods=["POST"])
+        return bp
@@ -0,0 +1,129 @@
+"""gptCompletion batch mode end to end: upload → create → poll → callback,
+against the bench's fake OpenAI files/batches endpoints and fake Marketo."""
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import pytest
+
+# every ledger, state file and rate-limit bucket goes to a scratch directory
+tempfile.tempdir = tempfile.mkdtemp(prefix="ssfs-test-")
+
+from bench import fakes_functions  # noqa: E402
+
+_openai = fakes_functions.FakeOpenAI(words=20)
+_marketo = fakes_functions.FakeMarketo(keep_objects=True)
+_sheets = fakes_functions.FakeSheets()
+os.environ |= {"OPENAI_API_KEY": "test", "OPENAI_BASE_URL": f"{_openai.url}/v1",
+               "SHEETS_API_ENDPOINT": _sheets.url, "GPT_BATCH_POLL_SECONDS": "0.1"}
+
+import jobstore_functions  # noqa: E402
+import json_functions  # noqa: E402
+from services.gptCompletion import batch_functions, routes  # noqa: E402
+
+STEP = {"user": "Hi", "model": "gpt-4o-mini", "output-tokens": 64, "field": "gptAnswer", "batch-mode": True}
+TIMESTAMP = "2026-01-01 00:00:00"
+
+
+def _request(token: str, steps: list[dict]) -> json_functions.Payload:
+    raw = json.dumps({"token": token, "callbackUrl": _marketo.url, "apiCallBackKey": "test",
+                      "objectData": [{"objectContext": {"id": i}, "flowStepContext": step}
+                                     for i, step in enumerate(steps)]}).encode("utf-8")
+    return json_functions.parse_payload(raw)
+
+
+def _pending_states() -> list[str]:
+    if not os.path.isdir(batch_functions.GPT_BATCH_DIR):
+        return []
+    return [n for n in os.listdir(batch_functions.GPT_BATCH_DIR) if n.endswith(".json")]
+
+
+def _wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_batch_mode_answers_reach_marketo():
+    token = uuid.uuid4().hex
+    data = _request(token, [STEP, STEP | {"max-length": 20}, STEP | {"stop-pattern": "-character"}])
+    batches = len(_openai.batches)
+
+    routes.service.process_batch(data, TIMESTAMP)
+
+    assert len(_openai.batches) == batches + 1
+    assert _marketo.wait({token: 3}, timeout=10)
+    objects = sorted(_marketo.objects[token], key=lambda o: o["leadData"]["id"])
+    assert [o["activityData"]["success"] for o in objects] == [True, True, True]
+    answers = [o["leadData"]["gptAnswer"] for o in objects]
+    assert answers[0].startswith("Fake answer to a 2-character prompt. lorem")
+    assert answers[1] == "Fake answer to a 2-c"
+    assert answers[2] == "Fake answer to a 2"
+    assert _wait_for(lambda: not _pending_states())
+
+
+def test_resumed_job_adopts_its_batch(monkeypatch):
+    token = uuid.uuid4().hex
+    data = _request(token, [STEP, STEP])
+    job = jobstore_functions.add(routes.service.base, data.raw, TIMESTAMP)
+    batches = len(_openai.batches)
+
+    # the worker dies after OpenAI created the batch, before its state file is written
+    def die(_state):
+        raise RuntimeError("worker died")
+    monkeypatch.setattr(batch_functions, "_write_state", die)
+    with pytest.raises(RuntimeError):
+        routes.service.results(data, TIMESTAMP, job)
+    monkeypatch.undo()
+
+    resumed = jobstore_functions.Job(job.id, job.service, job.timestamp, job.request, None, attempts=2)
+    routes.service.process_batch(data, TIMESTAMP, resumed)
+    routes.service.process_batch(data, TIMESTAMP, resumed)      # and again: its state file exists by now
+
+    assert len(_openai.batches) == batches + 1
+    assert _marketo.wait({token: 2}, timeout=10)
+    assert _wait_for(lambda: not _pending_states())
+    routes.service.process_batch(data, TIMESTAMP, resumed)      # done and delivered
+    assert len(_openai.batches) == batches + 1
+    assert _marketo.received(token) == 2
+
+
+def test_bad_numeric_input_fails_only_its_lead():
+    token = uuid.uuid4().hex
+    data = _request(token, [STEP | {"output-tokens": "lots"}, STEP])
+
+    routes.service.process_batch(data, TIMESTAMP)
+
+    assert _marketo.wait({token: 2}, timeout=10)
+    objects = sorted(_marketo.objects[token], key=lambda o: o["leadData"]["id"])
+    assert [o["activityData"]["success"] for o in objects] == [False, True]
+    assert objects[0]["activityData"]["gpt-error"] == "output-tokens must be a number, not 'lots'"
+    assert _wait_for(lambda: not _pending_states())
+
+    # and the same lead outside batch mode
+    lead = {"objectContext": {"id": 1}, "flowStepContext": STEP | {"batch-mode": False, "temperature": "warm"}}
+    callback, row = routes.service.handle_lead(lead, data, TIMESTAMP)
+    assert callback["activityData"]["success"] is False
+    assert row["error"].startswith("temperature must be a number, not 'warm'")
+
+
+def test_failed_submission_answers_every_lead(monkeypatch):
+    token = uuid.uuid4().hex
+    data = _request(token, [STEP, STEP])
+    job = jobstore_functions.add(routes.service.base, data.raw, TIMESTAMP)
+    monkeypatch.setattr(_openai, "behaviour", fakes_functions.Behaviour(error_rate=1.0))
+    monkeypatch.setattr(batch_functions.ratelimit_functions, "backoff", lambda *_, **__: 0)
+    calls = _openai.counters.calls
+
+    routes.service.process_batch(data, TIMESTAMP, job)
+
+    assert _openai.counters.calls - calls == batch_functions.openai_functions.OPENAI_MAX_RETRIES + 1
+    assert _marketo.wait({token: 2}, timeout=10)
+    objects = _marketo.objects[token]
+    assert [o["activityData"]["success"] for o in objects] == [False, False]
+    assert all(o["activityData"]["gpt-error"].startswith("OpenAI batch submission failed") for o in objects)
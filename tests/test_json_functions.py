@@ -0,0 +1,120 @@
+"""parse_payload's hand-written objectData scanner against json.loads, with and
+without orjson."""
+import codecs
+import json
+
+import pytest
+
+import json_functions
+
+LEADS = [
+    {"id": 1, "name": "plain"},
+    {"id": 2, "note": "brackets ] } [ { and \"quotes\" and \\ inside"},
+    {"id": 3, "text": "héllo wörld 😀 漢字", "nested": {"list": [1, [2, {"x": None}]], "ok": True}},
+    {},
+    {"id": 5, "score": -1.5e3, "tags": []},
+]
+
+
+def _body(leads=LEADS, **fields) -> dict:
+    return {"token": "t", "callbackUrl": "https://example.test/cb", **fields, "objectData": leads}
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def decoder(request, monkeypatch):
+    if request.param == "orjson":
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(json_functions, "orjson", None)
+
+
+@pytest.mark.parametrize("raw", [
+    json.dumps(_body()).encode("utf-8"),
+    json.dumps(_body(), ensure_ascii=False).encode("utf-8"),
+    json.dumps(_body(), ensure_ascii=False, indent=2).encode("utf-8"),
+    codecs.BOM_UTF8 + json.dumps(_body(), ensure_ascii=False).encode("utf-8"),
+    b' \r\n{ "token" : "t" ,"objectData":[ {"a":"\xc3\xa9"} ,\n{ } ] , "callbackUrl":"u"}\n ',
+])
+@pytest.mark.usefixtures("decoder")
+def test_leads_match_json_loads(raw):
+    expected = json.loads(raw.decode("utf-8-sig"))
+    data = json_functions.parse_payload(raw)
+
+    assert data.lead_count == len(expected["objectData"])
+    assert list(data.leads()) == expected["objectData"]
+    assert dict(data) == {k: v for k, v in expected.items() if k != "objectData"}
+    assert data.raw is raw
+
+
+@pytest.mark.usefixtures("decoder")
+def test_first_skips_leads():
+    raw = codecs.BOM_UTF8 + json.dumps(_body(), ensure_ascii=False).encode("utf-8")
+    data = json_functions.parse_payload(raw)
+
+    for first in range(len(LEADS) + 1):
+        assert list(data.leads(first)) == LEADS[first:]
+    assert list(data.leads(len(LEADS) + 3)) == []
+
+
+@pytest.mark.parametrize("raw", [
+    b'{"token": "t"}',
+    b'{}',
+    b'{"objectData": []}',
+    b'{"objectData": [ ]}',
+])
+@pytest.mark.usefixtures("decoder")
+def test_no_leads(raw):
+    data = json_functions.parse_payload(raw)
+    assert data.lead_count == 0
+    assert list(data.leads()) == []
+
+
+@pytest.mark.usefixtures("decoder")
+def test_duplicate_keys_last_wins():
+    raw = b'{"token": "a", "objectData": [{"id": 1}], "token": "b", "objectData": [{"id": 2}, {"id": 3, "id": 4}]}'
+    expected = json.loads(raw)
+    data = json_functions.parse_payload(raw)
+
+    assert data["token"] == expected["token"] == "b"
+    assert list(data.leads()) == expected["objectData"] == [{"id": 2}, {"id": 4}]
+
+
+@pytest.mark.parametrize("raw", [
+    b'',
+    b'[]',
+    b'{"objectData": {"id": 1}}',
+    b'{"objectData": [{"id": 1}, 2]}',
+    b'{"objectData": [{"id": 1},]}',
+    b'{"objectData": [{"id": 1}',
+    b'{"objectData": [{"id": 1} {"id": 2}]}',
+    b'{"token": "t"} {}',
+    b'{"token": "t",}',
+    b'{1: "t"}',
+    b'{"token" "t"}',
+])
+@pytest.mark.usefixtures("decoder")
+def test_malformed_payloads_are_rejected(raw):
+    with pytest.raises(ValueError):
+        json_functions.parse_payload(raw)
+
+
+@pytest.mark.parametrize("lead", [
+    b'{"name": "cut \\ud83d"}',        # an emoji cut in half by the sender
+    b'{"score": NaN}',
+    b'{"score": Infinity}',
+])
+def test_leads_orjson_would_reject_fail_at_submit(lead):
+    pytest.importorskip("orjson")
+    raw = b'{"token": "t", "objectData": [{"id": 1}, %s]}' % lead
+    with pytest.raises(ValueError, match="objectData item 1"):
+        json_functions.parse_payload(raw)
+
+
+def test_stdlib_accepts_what_it_can_parse_later(monkeypatch):
+    monkeypatch.setattr(json_functions, "orjson", None)
+    raw = b'{"token": "t", "objectData": [{"name": "cut \\ud83d", "score": NaN}]}'
+    data = json_functions.parse_payload(raw)
+
+    (lead,) = data.leads()
+    assert lead["name"] == "cut \ud83d"
+    assert lead["score"] != lead["score"]
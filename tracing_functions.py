@@ -0,0 +1,140 @@
+"""OpenTelemetry spans for the submit pipeline and every provider call.
+
+Off unless TRACE_EXPORTER is set and the opentelemetry packages are installed
+(poetry install -E tracing: opentelemetry-sdk and the OTLP/HTTP exporter):
+  file    – one JSON span per line in TRACE_FILE ({pid} → one file per worker)
+  otlp    – OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT (default http://localhost:4318)
+  console – stdout
+Traces are sampled by TRACE_SAMPLE_RATIO at the root, so a batch and its leads
+are either all kept or all dropped; spans are exported from a background thread."""
+import contextlib
+import multiprocessing
+import os
+import tempfile
+
+# ---------- CONFIG ----------
+TRACE_EXPORTER     = os.getenv("TRACE_EXPORTER", "").strip().lower()
+TRACE_FILE         = os.getenv("TRACE_FILE", os.path.join(tempfile.gettempdir(), "ssfs-traces-{pid}.jsonl"))
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", 0.1))
+TRACE_QUEUE_SIZE   = int(os.getenv("TRACE_QUEUE_SIZE", 8192))     # spans buffered before new ones are dropped
+SERVICE_NAME       = os.getenv("OTEL_SERVICE_NAME", "marketo-ssfs")
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+
+class _NoopSpan:
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def record_exception(self, exception, *args, **kwargs):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+_NOOP = contextlib.nullcontext(_NoopSpan())
+
+
+def _exporter():
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    if TRACE_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if TRACE_EXPORTER == "file":
+        out = open(TRACE_FILE.format(pid=os.getpid()), "a", encoding="utf-8")   # noqa: SIM115 - open for the process lifetime
+        return ConsoleSpanExporter(out=out, formatter=lambda s: s.to_json(indent=None) + "\n")
+    if TRACE_EXPORTER == "console":
+        return ConsoleSpanExporter()
+    raise ValueError(f"Unknown TRACE_EXPORTER '{TRACE_EXPORTER}' (file, otlp or console)")
+
+
+def _setup():
+    if not TRACE_EXPORTER:
+        return None
+    if trace is None:
+        print("TRACE_EXPORTER is set but opentelemetry is not installed – tracing off")
+        return None
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+
+    provider = TracerProvider(resource=Resource.create({"service.name": SERVICE_NAME}),
+                              sampler=ParentBased(TraceIdRatioBased(TRACE_SAMPLE_RATIO)))
+    provider.add_span_processor(BatchSpanProcessor(_exporter(), max_queue_size=TRACE_QUEUE_SIZE))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer("ssfs")
+
+
+# spawned helpers (the formula sandbox) report through their parent instead
+_tracer = _setup() if multiprocessing.parent_process() is None else None
+
+
+def _clean(attributes: dict) -> dict:
+    # OTel only takes str/bool/int/float (or lists of them); None means "not known"
+    return {k: v if isinstance(v, (str, bool, int, float)) else str(v)
+            for k, v in attributes.items() if v is not None}
+
+
+def span(name: str, **attributes):
+    """Context manager for a child of the current span; yields the span."""
+    if _tracer is None:
+        return _NOOP
+    return _tracer.start_as_current_span(name, attributes=_clean(attributes))
+
+
+def set_attributes(**attributes):
+    if _tracer is not None:
+        trace.get_current_span().set_attributes(_clean(attributes))
+
+
+def record(name: str, start_ns: int, end_ns: int, **attributes):
+    """A finished child span whose times were measured elsewhere, e.g. in another process."""
+    if _tracer is not None:
+        _tracer.start_span(name, start_time=start_ns, attributes=_clean(attributes)).end(end_time=end_ns)
+
+
+def begin(name: str, **attributes):
+    """Start a span and make it current until end(); for hooks that can't use `with`."""
+    if _tracer is None:
+        return None
+    s = _tracer.start_span(name, attributes=_clean(attributes))
+    return s, otel_context.attach(trace.set_span_in_context(s))
+
+
+def end(handle, error: BaseException | None = None, **attributes):
+    if handle is None:
+        return
+    s, token = handle
+    otel_context.detach(token)
+    s.set_attributes(_clean(attributes))
+    if error is not None:
+        s.record_exception(error)
+        s.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+    s.end()
+
+
+def wrap(fn):
+    """fn bound to the caller's trace context, for running it on another thread."""
+    if _tracer is None:
+        return fn
+    ctx = otel_context.get_current()
+
+    def run(*args, **kwargs):
+        token = otel_context.attach(ctx)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            otel_context.detach(token)
+
+    return run